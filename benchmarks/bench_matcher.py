@@ -0,0 +1,144 @@
+"""
+Rule matching benchmark for large rule sets.
+
+Compares matching every rule with its own query (one scan per rule) with the RuleIndex, which
+matches all the eq and contains rules in one pass over the messages, e.g.
+
+    poetry run python -m benchmarks.bench_matcher --rows 100000 --rules 10,100,500 --output matcher.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_rows import SEED_MESSAGES, populate
+from benchmarks.fake_service import SENDERS, SUBJECTS, FakeGMailService
+from mail_actions.gmail.mailbox import MailBox
+from mail_actions.matcher import RuleIndex
+from mail_actions.ruleengine import CompiledRule, bind_params, compile_rule
+
+DEFAULT_ROWS = 100_000
+DEFAULT_RULES = "10,100,500"
+
+
+def build_rules(count: int, seed: int = 0) -> list[CompiledRule]:
+    """
+    Builds `count` rules like "from eq X" and "subject contains Y", the values of one rule in
+    ten occur in the fake mailbox.
+    """
+    rng = random.Random(seed)
+    words = sorted(
+        {word for subject in SUBJECTS for word in subject.split() if "{" not in word}
+    )
+    rules = []
+    for i in range(count):
+        known = i % 10 == 0
+        if i % 2 == 0:
+            value = rng.choice(SENDERS)[1] if known else f"sender{i}@example.org"
+            filters = [{"field": "from", "operator": "eq", "value": value}]
+        else:
+            value = rng.choice(words) if known else f"topic {i}"
+            filters = [{"field": "subject", "operator": "contains", "value": value}]
+        rules.append(
+            compile_rule(
+                {
+                    "name": f"Rule {i}",
+                    "match": "all",
+                    "filters": filters,
+                    "actions": [{"type": "read"}],
+                }
+            )
+        )
+    return rules
+
+
+def measure(mailbox: MailBox, rules: list[CompiledRule]) -> dict:
+    """
+    Matches the rules with a query per rule, then with the RuleIndex.
+    """
+    start = time.perf_counter()
+    per_rule = 0
+    for compiled in rules:
+        params = bind_params(compiled["params"])
+        per_rule += sum(1 for _ in mailbox.get_messages_sql(compiled["sql"], params))
+    queries = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = RuleIndex(rules)
+    matches = index.match(mailbox)
+    indexed = time.perf_counter() - start
+    return {
+        "rules": len(rules),
+        "matches": per_rule,
+        "index_matches": sum(len(ids) for ids in matches.values()),
+        "query_seconds": round(queries, 6),
+        "index_seconds": round(indexed, 6),
+        "speedup": round(queries / indexed, 2) if indexed else None,
+    }
+
+
+def run(rows: int, rule_counts: list[int], workdir: str) -> list[dict]:
+    """
+    Measures both strategies on a mailbox of `rows` messages for every rule count.
+    """
+    mailbox = MailBox(
+        FakeGMailService(min(rows, SEED_MESSAGES)),
+        db_path=os.path.join(workdir, "matcher.db"),
+        scan_limit=0,
+    )
+    mailbox.init_db()
+    populate(mailbox, rows)
+    try:
+        return [
+            {"rows": rows, **measure(mailbox, build_rules(count))}
+            for count in rule_counts
+        ]
+    finally:
+        mailbox.close()
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--rows", type=int, default=DEFAULT_ROWS, help="Messages in the mailbox"
+    )
+    parser.add_argument(
+        "--rules", default=DEFAULT_RULES, help="Comma separated rule set sizes"
+    )
+    parser.add_argument("--output", help="Write JSON results to this file")
+    args = parser.parse_args(argv)
+
+    report = {
+        "benchmark": "matcher",
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": [],
+    }
+    counts = [int(count) for count in args.rules.split(",")]
+    with tempfile.TemporaryDirectory() as workdir:
+        for result in run(args.rows, counts, workdir):
+            print(
+                f"rules={result['rules']:<5} n={result['rows']:<8} "
+                f"queries {result['query_seconds']:>8.3f}s "
+                f"index {result['index_seconds']:>8.3f}s",
+                file=sys.stderr,
+            )
+            report["results"].append(result)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Row representation benchmark for rules matching many messages.
+
+Compares reading the rows of a rule query as compact MessageRow tuples with building the nested
+Message dicts (MessageRow.to_dict()), in time per row and peak Python memory, e.g.
+
+    poetry run python -m benchmarks.bench_rows --rows 100000 --output rows.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.fake_service import FakeGMailService
+from mail_actions.gmail.mailbox import MailBox
+from mail_actions.ruleengine import build_sql
+
+DEFAULT_ROWS = 100_000
+# messages synced from the fake service, copied with new IDs up to the requested row count
+SEED_MESSAGES = 2_000
+
+MATCH_ALL_RULE = {
+    "name": "Every message",
+    "match": "all",
+    "filters": [{"field": "size", "operator": "gte", "value": "0"}],
+    "actions": [],
+}
+
+REPRESENTATIONS = {
+    "row": lambda row: row,
+    "dict": lambda row: row.to_dict(),
+}
+
+
+def populate(mailbox: MailBox, rows: int):
+    """
+    Fills the mailbox with `rows` messages: a sync of its fake service of SEED_MESSAGES
+    messages, then copies of the synced messages under new IDs.
+    """
+    seed = min(rows, SEED_MESSAGES)
+    with contextlib.redirect_stdout(io.StringIO()):
+        mailbox.sync()
+    with mailbox.connection() as conn:
+        copy = 1
+        while seed * copy < rows:
+            conn.execute(
+                "INSERT INTO messages SELECT id || '-' || ?, "
+                + ", ".join(f'"{column}"' for column in columns(conn)[1:])
+                + " FROM messages WHERE instr(id, '-') = 0 LIMIT ?",
+                (copy, rows - seed * copy),
+            )
+            copy += 1
+
+
+def columns(conn) -> list[str]:
+    return [row[1] for row in conn.execute("PRAGMA table_info(messages)")]
+
+
+def measure(mailbox: MailBox, name: str, memory: bool) -> dict:
+    """
+    Reads every message through the rule query, keeping the rows as `name` representations.
+    """
+    (sql, args) = build_sql(MATCH_ALL_RULE)
+    convert = REPRESENTATIONS[name]
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    rows = [convert(row) for row in mailbox.get_messages_sql(sql, args)]
+    elapsed = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    count = len(rows)
+    return {
+        "representation": name,
+        "rows": count,
+        "seconds": round(elapsed, 6),
+        "microseconds_per_row": round(elapsed / count * 1e6, 3) if count else 0,
+        "peak_memory_bytes": peak,
+        "bytes_per_row": round(peak / count, 1) if peak and count else None,
+    }
+
+
+def run(rows: int, workdir: str, memory: bool = True) -> list[dict]:
+    """
+    Measures every representation on a mailbox of `rows` messages.
+    """
+    mailbox = MailBox(
+        FakeGMailService(min(rows, SEED_MESSAGES)),
+        db_path=os.path.join(workdir, "rows.db"),
+        scan_limit=0,
+    )
+    mailbox.init_db()
+    populate(mailbox, rows)
+    try:
+        return [measure(mailbox, name, memory) for name in REPRESENTATIONS]
+    finally:
+        mailbox.close()
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--rows", type=int, default=DEFAULT_ROWS, help="Messages matched by the rule"
+    )
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Skip tracemalloc, which slows both representations down",
+    )
+    parser.add_argument("--output", help="Write JSON results to this file")
+    args = parser.parse_args(argv)
+
+    report = {
+        "benchmark": "rows",
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for result in run(args.rows, workdir, not args.no_memory):
+            print(
+                f"{result['representation']:<6} n={result['rows']:<8} "
+                f"{result['microseconds_per_row']:>8.2f}us/row "
+                f"{result['bytes_per_row'] or 0:>10.1f}B/row",
+                file=sys.stderr,
+            )
+            report["results"].append(result)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Startup time benchmark for the CLI.
+
+Measures, in fresh interpreters, how long it takes to import the CLI, to answer `--help`, and
+to import and build the Gmail client up to the first request. Exits with status 1 when the
+median `--help` time exceeds the target, e.g.
+
+    poetry run python -m benchmarks.bench_startup --runs 10 --target-ms 250
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+# prints the milliseconds spent importing GMailService and building a first request
+FIRST_REQUEST = """
+import time
+start = time.perf_counter()
+from google.oauth2.credentials import Credentials
+from mail_actions.gmail.service import GMailService
+service = GMailService(Credentials(token="bench"))
+service.service.users().getProfile(userId="me")
+print((time.perf_counter() - start) * 1000)
+"""
+
+SCENARIOS = {
+    "interpreter": [sys.executable, "-c", "pass"],
+    "import_cli": [sys.executable, "-c", "import mail_actions.cli"],
+    "cli_help": [sys.executable, "-m", "mail_actions.cli", "--help"],
+}
+
+
+def measure(command: list[str], runs: int) -> list[float]:
+    """
+    Runs the command `runs` times and returns the wall time of each run in milliseconds.
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def measure_first_request(runs: int) -> list[float]:
+    """
+    Returns the in-process time from importing GMailService to a built first request, per run.
+    """
+    timings = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", FIRST_REQUEST],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        timings.append(float(out.stdout.strip()))
+    return timings
+
+
+def summarize(name: str, timings: list[float]) -> dict:
+    return {
+        "scenario": name,
+        "runs": len(timings),
+        "median_ms": round(statistics.median(timings), 3),
+        "min_ms": round(min(timings), 3),
+        "max_ms": round(max(timings), 3),
+    }
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="Runs per scenario")
+    parser.add_argument(
+        "--target-ms",
+        type=float,
+        default=250.0,
+        help="Maximum median milliseconds for `cli --help`",
+    )
+    parser.add_argument("--output", help="Write JSON results to this file")
+    args = parser.parse_args(argv)
+
+    results = [
+        summarize(name, measure(command, args.runs))
+        for name, command in SCENARIOS.items()
+    ]
+    results.append(summarize("first_request", measure_first_request(args.runs)))
+    cli_help = next(r for r in results if r["scenario"] == "cli_help")
+    report = {
+        "benchmark": "startup",
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "target_ms": args.target_ms,
+        "passed": cli_help["median_ms"] <= args.target_ms,
+        "results": results,
+    }
+    for result in results:
+        print(
+            f"{result['scenario']:<15} median {result['median_ms']:>9.1f}ms "
+            f"min {result['min_ms']:>9.1f}ms max {result['max_ms']:>9.1f}ms",
+            file=sys.stderr,
+        )
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    if not report["passed"]:
+        print(
+            f"cli --help took {cli_help['median_ms']}ms, over the {args.target_ms}ms target",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Offline throughput benchmarks for sync and rule application.
+
+Runs MailBox and RuleEngine against FakeGMailService and writes the results as JSON, e.g.
+
+    poetry run python -m benchmarks.bench_sync --sizes 10000 --output bench.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.fake_service import FakeGMailService
+from mail_actions.gmail.mailbox import MailBox
+from mail_actions.gmail.service import MAX_RETRIES
+from mail_actions.metrics import metrics
+from mail_actions.ruleengine import RuleEngine
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+
+BENCH_RULES = [
+    {
+        "name": "Mark GitHub notifications as read",
+        "match": "all",
+        "filters": [
+            {"field": "from", "operator": "contains", "value": "github.com"},
+        ],
+        "actions": [{"type": "read"}],
+    },
+    {
+        "name": "File receipts",
+        "match": "any",
+        "filters": [
+            {"field": "subject", "operator": "contains", "value": "Invoice"},
+            {"field": "from", "operator": "eq", "value": "order-update@amazon.in"},
+        ],
+        "actions": [{"type": "move", "value": "Receipts"}],
+    },
+]
+
+
+def timed(
+    name: str, size: int, service: FakeGMailService, fn, memory: bool = False
+) -> dict:
+    """
+    Runs fn once and returns a result record with the elapsed time and API calls made, the
+    injected errors, the retries they caused and the calls that still failed after them.
+    With memory, the peak Python heap allocated during the run is recorded as well.
+    """
+    service.calls.clear()
+    service.errors.clear()
+    metrics.reset()
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        count = fn()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    counters = metrics.to_dict()["counters"]
+    retries = per_method(counters, "gmail_api_retries_total")
+    errors = per_method(counters, "gmail_api_errors_total")
+    return {
+        "scenario": name,
+        "mailbox_size": size,
+        "items": count,
+        "seconds": round(elapsed, 6),
+        "items_per_second": round(count / elapsed, 2) if elapsed and count else 0,
+        "api_calls": dict(service.calls),
+        "api_errors": dict(service.errors),
+        "api_retries": retries,
+        "api_failures": {
+            method: errors[method] - retries.get(method, 0)
+            for method in errors
+            if errors[method] > retries.get(method, 0)
+        },
+        "phases": metrics.to_dict()["phases"],
+        "peak_memory_bytes": peak,
+    }
+
+
+def per_method(counters: dict, name: str) -> dict[str, int]:
+    """
+    Returns the values of a counter labelled by API method.
+    """
+    return {
+        series["labels"]["method"]: int(series["value"])
+        for series in counters.get(name, [])
+    }
+
+
+def count_messages(mailbox: MailBox) -> int:
+    return mailbox.get_stats()["totalMessages"]
+
+
+def run_size(
+    size: int,
+    latency: float,
+    error_rate: float,
+    workdir: str,
+    memory: bool = False,
+    max_retries: int = MAX_RETRIES,
+) -> list[dict]:
+    """
+    Runs every scenario against a fresh mailbox of the given size. A scenario failing after
+    max_retries retries of an injected error raises.
+    """
+    service = FakeGMailService(
+        size, latency=latency, error_rate=error_rate, max_retries=max_retries
+    )
+    mailbox = MailBox(
+        service, db_path=os.path.join(workdir, f"bench-{size}.db"), scan_limit=0
+    )
+    mailbox.init_db()
+    engine = RuleEngine(mailbox, service)
+    results = []
+
+    def full_sync():
+        mailbox.sync()
+        return count_messages(mailbox)
+
+    def incremental_sync():
+        delta = max(size // 100, 1)
+        service.add_messages(delta)
+        service.remove_messages(delta // 2)
+        before = count_messages(mailbox)
+        mailbox.sync()
+        return abs(count_messages(mailbox) - before) + delta
+
+    def bulk_delete():
+        ids = sorted(mailbox.scan_db())[: max(size // 10, 1)]
+        return mailbox.delete_messages(set(ids))
+
+    def apply_rules():
+        for rule in BENCH_RULES:
+            engine.apply_rule(rule)
+        return int(
+            sum(
+                series["value"]
+                for series in metrics.to_dict()["counters"].get(
+                    "rule_messages_matched_total", []
+                )
+            )
+        )
+
+    results.append(timed("full_sync", size, service, full_sync, memory))
+    results.append(timed("incremental_sync", size, service, incremental_sync, memory))
+    results.append(timed("apply_rules", size, service, apply_rules, memory))
+    results.append(timed("bulk_delete", size, service, bulk_delete, memory))
+    return results
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+        help="Comma separated mailbox sizes",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds added to every API call"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Probability of an API call failing with a 500",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=MAX_RETRIES,
+        help=f"Retries of a failed API call (default {MAX_RETRIES})",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="Record the peak Python memory of every scenario (slower)",
+    )
+    parser.add_argument("--output", help="Write JSON results to this file")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    report = {
+        "benchmark": "sync",
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "max_retries": args.max_retries,
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            for result in run_size(
+                size,
+                args.latency,
+                args.error_rate,
+                workdir,
+                args.memory,
+                args.max_retries,
+            ):
+                print(
+                    f"{result['scenario']:<18} n={size:<8} {result['seconds']:>10.3f}s "
+                    f"{result['items_per_second']:>12.1f}/s "
+                    f"retries={sum(result['api_retries'].values())}",
+                    file=sys.stderr,
+                )
+                report["results"].append(result)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,525 @@
+import base64
+import contextlib
+import json
+import random
+import re
+import time
+from collections import Counter
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from mail_actions.gmail.service import (
+    GMailService,
+    HistoryList,
+    Message,
+    MAX_RETRIES,
+    MessageList,
+    Profile,
+    Thread,
+)
+from mail_actions.tracing import traced
+
+SENDERS = [
+    ("GitHub", "notifications@github.com"),
+    ("Amazon.in", "order-update@amazon.in"),
+    ("LinkedIn", "messages-noreply@linkedin.com"),
+    ("Google", "no-reply@accounts.google.com"),
+    ("Swiggy", "noreply@swiggy.in"),
+    ("HDFC Bank", "alerts@hdfcbank.net"),
+    ("Jane Smith", "jane.smith@example.com"),
+    ("John Doe", "john.doe@example.com"),
+    ("Medium Daily Digest", "noreply@medium.com"),
+    ("Slack", "feedback@slack.com"),
+]
+
+SUBJECTS = [
+    "Your order has been shipped",
+    "[mail-actions] Pull request #{n} merged",
+    "Weekly digest: {n} new stories",
+    "Security alert for your account",
+    "Invoice #{n} for your subscription",
+    "Re: Meeting notes from Monday",
+    "You have {n} new connection requests",
+    "Transaction alert: INR {n} debited",
+    "Lunch tomorrow?",
+    "Important: action required on your account",
+]
+
+LABELS = [
+    {"id": "INBOX", "name": "INBOX", "type": "system"},
+    {"id": "UNREAD", "name": "UNREAD", "type": "system"},
+    {"id": "IMPORTANT", "name": "IMPORTANT", "type": "system"},
+    {"id": "SENT", "name": "SENT", "type": "system"},
+    {"id": "CATEGORY_PROMOTIONS", "name": "CATEGORY_PROMOTIONS", "type": "system"},
+    {"id": "CATEGORY_SOCIAL", "name": "CATEGORY_SOCIAL", "type": "system"},
+    {"id": "CATEGORY_UPDATES", "name": "CATEGORY_UPDATES", "type": "system"},
+    {"id": "Label_1", "name": "Receipts", "type": "user"},
+    {"id": "Label_2", "name": "Newsletters", "type": "user"},
+    {"id": "Label_3", "name": "Archive", "type": "user"},
+]
+
+OWNER = "me@example.com"
+# one message every 5 minutes starting ~10 years before FAKE_NOW_MS, so 1M messages span a decade
+FAKE_NOW_MS = 1_780_000_000_000
+FAKE_START_MS = FAKE_NOW_MS - 10 * 365 * 24 * 3600 * 1000
+INTERVAL_MS = 5 * 60 * 1000
+BASE_ID = 0x18F0000000000000
+
+
+def _encode(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip("=")
+
+
+class FakeGMailService(GMailService):
+    """
+    In-process stand-in for GMailService backed by a synthetic mailbox.
+
+    Messages are generated deterministically from their index, so only the ordered id list and
+    per message label overrides are kept in memory, which keeps a 1M message mailbox cheap.
+
+    Attributes:
+        latency (float): Seconds slept on every API call.
+        error_rate (float): Probability (0..1) that an API call fails with a 500 error. Failed
+            calls are retried like GMailService does, up to max_retries times, without backoff.
+        calls (Counter): Number of calls made per API method.
+        errors (Counter): Number of injected errors per API method.
+    """
+
+    def __init__(
+        self,
+        total: int,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 42,
+        max_retries: int = MAX_RETRIES,
+    ):
+        self.credentials = None
+        self.service = None
+        self.max_retries = max_retries
+        # retried at once, the benchmarks measure the work of the retries, not the waiting
+        self.backoff = 0.0
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.historyId = 1000
+        # index of every live message, newest first
+        self.indexes: list[int] = list(range(total - 1, -1, -1))
+        self.next_index = total
+        self.label_overrides: dict[int, list[str]] = {}
+        self.removed: set[int] = set()
+        # change records served by history.list, older ids than history_start are expired
+        self.history: list[dict] = []
+        self.history_start = self.historyId
+
+    def connection(self):
+        return contextlib.nullcontext()
+
+    def _call(self, method: str, handler) -> dict:
+        return self._execute(method, FakeRequest(self, method, handler))
+
+    def add_messages(self, count: int) -> list[str]:
+        """
+        Delivers new messages to the top of the mailbox.
+
+        Args:
+            count (int): Number of messages to add.
+
+        Returns:
+            list[str]: The ids of the new messages.
+        """
+        new = list(range(self.next_index + count - 1, self.next_index - 1, -1))
+        self.next_index += count
+        self.indexes = new + self.indexes
+        for index in reversed(new):
+            self.record_history("messagesAdded", index)
+        return [message_id(i) for i in new]
+
+    def remove_messages(self, count: int) -> list[str]:
+        """
+        Deletes the oldest messages from the mailbox.
+
+        Args:
+            count (int): Number of messages to delete.
+
+        Returns:
+            list[str]: The ids of the deleted messages.
+        """
+        removed = self.indexes[len(self.indexes) - count :]
+        self.indexes = self.indexes[: len(self.indexes) - count]
+        self.removed.update(removed)
+        for index in removed:
+            self.record_history("messagesDeleted", index)
+        return [message_id(i) for i in removed]
+
+    def record_history(self, kind: str, index: int, labelIds: list[str] = None):
+        self.historyId += 1
+        change = {
+            "message": {
+                "id": message_id(index),
+                "threadId": thread_id(index),
+                "labelIds": self.labels_of(index),
+            }
+        }
+        if labelIds is not None:
+            change["labelIds"] = labelIds
+        self.history.append({"id": str(self.historyId), kind: [change]})
+
+    def get_history(
+        self, startHistoryId: str, pageToken=None, maxResults=500
+    ) -> HistoryList | None:
+        if int(startHistoryId) < self.history_start:
+            self.calls["history.list"] += 1
+            return None
+
+        def page():
+            records = [r for r in self.history if int(r["id"]) > int(startHistoryId)]
+            start = int(pageToken) if pageToken else 0
+            resp = {
+                "history": records[start : start + maxResults],
+                "historyId": str(self.historyId),
+            }
+            if start + maxResults < len(records):
+                resp["nextPageToken"] = str(start + maxResults)
+            return resp
+
+        return self._call("history.list", page)
+
+    def get_profile(self) -> Profile:
+        return self._call(
+            "getProfile",
+            lambda: Profile(
+                emailAddress=OWNER,
+                historyId=str(self.historyId),
+                messagesTotal=len(self.indexes),
+                threadsTotal=len(self.indexes),
+            ),
+        )
+
+    def get_labels(self) -> dict:
+        return self._call("labels.list", lambda: {"labels": LABELS})
+
+    def get_message_list(self, maxResults=None, pageToken=None, q=None) -> MessageList:
+        def page():
+            indexes = self.indexes
+            if q:
+                indexes = [i for i in indexes if self.matches(q, i)]
+            return self.list_page(indexes, maxResults, pageToken)
+
+        return self._call("messages.list", page)
+
+    def matches(self, q: str, index: int) -> bool:
+        """
+        Evaluates the subset of the Gmail search syntax emitted by planner.build_query:
+        space separated terms (AND), one {} group (OR), - negation, quoted from:, to:,
+        subject: and filename: values, newer_than:/older_than:, after:/before: (dates or epoch
+        seconds), larger:/smaller: and has:attachment. Text values match case insensitive
+        substrings.
+        """
+        msg = self.build_message(index)
+        headers = {
+            h["name"].lower(): h["value"].lower() for h in msg["payload"]["headers"]
+        }
+        filenames = [
+            part.get("filename", "").lower() for part in msg["payload"].get("parts", [])
+        ]
+        received = int(msg["internalDate"]) / 1000
+        units = {"d": 86400, "m": 30 * 86400, "y": 365 * 86400}
+
+        def term_matches(term: str) -> bool:
+            if term.startswith("-"):
+                return not term_matches(term[1:])
+            (key, value) = term.split(":", 1)
+            value = value.strip('"').lower()
+            if key in ("from", "to", "subject"):
+                return value in headers.get(key, "")
+            if key == "filename":
+                return any(value in name for name in filenames)
+            if key in ("newer_than", "older_than"):
+                cutoff = time.time() - int(value[:-1]) * units[value[-1]]
+                return received > cutoff if key == "newer_than" else received < cutoff
+            if key in ("after", "before"):
+                if value.isdigit():
+                    day = int(value)
+                else:
+                    day = time.mktime(time.strptime(value, "%Y/%m/%d"))
+                return received > day if key == "after" else received < day
+            if key == "larger":
+                return msg["sizeEstimate"] > int(value)
+            if key == "smaller":
+                return msg["sizeEstimate"] < int(value)
+            if key == "has":
+                return any(filenames)
+            raise Exception(f"Unsupported search term: {term}")
+
+        terms = re.findall(r'\{[^}]*\}|-?\w+:"[^"]*"|\S+', q)
+        for term in terms:
+            if term.startswith("{"):
+                group = re.findall(r'-?\w+:"[^"]*"|\S+', term[1:-1])
+                if not any(term_matches(t) for t in group):
+                    return False
+            elif not term_matches(term):
+                return False
+        return True
+
+    def list_page(self, indexes: list[int], maxResults, pageToken) -> MessageList:
+        size = min(maxResults or 100, 500)
+        start = int(pageToken) if pageToken else 0
+        page = indexes[start : start + size]
+        resp = MessageList(
+            messages=[{"id": message_id(i), "threadId": thread_id(i)} for i in page],
+            resultSizeEstimate=len(indexes),
+        )
+        if start + size < len(indexes):
+            resp["nextPageToken"] = str(start + size)
+        return resp
+
+    @traced("gmail.get_message")
+    def get_message(self, messageId: str) -> Message:
+        def get():
+            index = index_of(messageId)
+            if index in self.removed or index >= self.next_index:
+                raise HttpError(
+                    httplib2.Response({"status": 404}), b'{"error": "Not Found"}'
+                )
+            return self.build_message(index)
+
+        return self._call("messages.get", get)
+
+    def update_labels(
+        self, messageId: str, addLabelIds: list[str], removeLabelIds: list[str]
+    ) -> Message:
+        def modify():
+            index = index_of(messageId)
+            self.modify_labels(index, addLabelIds, removeLabelIds)
+            return self.build_message(index)
+
+        return self._call("messages.modify", modify)
+
+    def batch_update_labels(
+        self, messageIds: list[str], addLabelIds: list[str], removeLabelIds: list[str]
+    ):
+        def modify():
+            for messageId in messageIds:
+                self.modify_labels(index_of(messageId), addLabelIds, removeLabelIds)
+            return {}
+
+        self._call("messages.batchModify", modify)
+
+    def thread_indexes(self, threadId: str) -> list[int]:
+        first = index_of(threadId)
+        return [
+            index
+            for index in range(first, first + 4)
+            if index < self.next_index and index not in self.removed
+        ]
+
+    def get_thread(self, threadId: str) -> Thread:
+        def get():
+            indexes = self.thread_indexes(threadId)
+            if not indexes:
+                raise HttpError(
+                    httplib2.Response({"status": 404}), b'{"error": "Not Found"}'
+                )
+            messages = [self.build_message(index) for index in indexes]
+            return Thread(
+                id=threadId,
+                historyId=str(self.historyId),
+                messages=messages,
+                snippet=messages[-1]["snippet"],
+            )
+
+        return self._call("threads.get", get)
+
+    def update_thread_labels(
+        self, threadId: str, addLabelIds: list[str], removeLabelIds: list[str]
+    ) -> Thread:
+        def modify():
+            indexes = self.thread_indexes(threadId)
+            for index in indexes:
+                self.modify_labels(index, addLabelIds, removeLabelIds)
+            return Thread(
+                id=threadId,
+                historyId=str(self.historyId),
+                messages=[
+                    {"id": message_id(i), "labelIds": self.labels_of(i)}
+                    for i in indexes
+                ],
+                snippet="",
+            )
+
+        return self._call("threads.modify", modify)
+
+    def modify_labels(
+        self, index: int, addLabelIds: list[str], removeLabelIds: list[str]
+    ):
+        before = self.labels_of(index)
+        labels = [label for label in before if label not in removeLabelIds]
+        labels.extend(label for label in addLabelIds if label not in labels)
+        self.label_overrides[index] = labels
+        added = [label for label in labels if label not in before]
+        removed = [label for label in before if label not in labels]
+        if added:
+            self.record_history("labelsAdded", index, added)
+        if removed:
+            self.record_history("labelsRemoved", index, removed)
+
+    def close(self):
+        pass
+
+    def labels_of(self, index: int) -> list[str]:
+        if index in self.label_overrides:
+            return list(self.label_overrides[index])
+        rng = random.Random(self.seed * 1_000_003 + index)
+        labels = []
+        if rng.random() < 0.6:
+            labels.append("INBOX")
+        if rng.random() < 0.3:
+            labels.append("UNREAD")
+        if rng.random() < 0.1:
+            labels.append("IMPORTANT")
+        labels.append(rng.choice(LABELS[4:])["id"])
+        return labels
+
+    def build_message(self, index: int) -> Message:
+        """
+        Builds the full message resource for the given index, shaped like messages.get(format=full).
+        """
+        rng = random.Random(self.seed * 1_000_003 + index)
+        name, sender = SENDERS[rng.randrange(len(SENDERS))]
+        subject = SUBJECTS[rng.randrange(len(SUBJECTS))].format(
+            n=rng.randrange(1, 9999)
+        )
+        internal = FAKE_START_MS + index * INTERVAL_MS
+        # time.strftime is locale independent enough for an RFC 2822 style Date header
+        date = time.strftime(
+            "%a, %d %b %Y %H:%M:%S +0000", time.gmtime(internal / 1000 - 30)
+        )
+        text = f"Hello,\n\n{subject}.\n\nRegards,\n{name}\n" * rng.randrange(1, 20)
+        html = f"<html><body><p>{text}</p></body></html>"
+        headers = [
+            {"name": "Delivered-To", "value": OWNER},
+            {"name": "Received", "value": "by 2002:a05:6a10:a0c1:0:0:0:0 with SMTP"},
+            {"name": "From", "value": f"{name} <{sender}>"},
+            {"name": "To", "value": OWNER},
+            {"name": "Subject", "value": subject},
+            {"name": "Date", "value": date},
+            {"name": "Message-ID", "value": f"<{index}.{self.seed}@mail.example.com>"},
+            {"name": "MIME-Version", "value": "1.0"},
+            {
+                "name": "Content-Type",
+                "value": 'multipart/alternative; boundary="000000000000abcdef"',
+            },
+        ]
+        payload = {
+            "partId": "",
+            "mimeType": "multipart/alternative",
+            "filename": "",
+            "headers": headers,
+            "body": {"size": 0},
+            "parts": [
+                {
+                    "partId": "0",
+                    "mimeType": "text/plain",
+                    "filename": "",
+                    "headers": [
+                        {
+                            "name": "Content-Type",
+                            "value": "text/plain; charset=UTF-8",
+                        }
+                    ],
+                    "body": {"size": len(text), "data": _encode(text)},
+                },
+                {
+                    "partId": "1",
+                    "mimeType": "text/html",
+                    "filename": "",
+                    "headers": [
+                        {
+                            "name": "Content-Type",
+                            "value": "text/html; charset=UTF-8",
+                        }
+                    ],
+                    "body": {"size": len(html), "data": _encode(html)},
+                },
+            ],
+        }
+        attachment_size = 0
+        # one message in ten carries a PDF, nested in multipart/mixed like real mail
+        if rng.random() < 0.1:
+            attachment_size = rng.randrange(10_000, 5_000_000)
+            payload["partId"] = "0"
+            payload = {
+                "partId": "",
+                "mimeType": "multipart/mixed",
+                "filename": "",
+                "headers": payload.pop("headers"),
+                "body": {"size": 0},
+                "parts": [
+                    payload,
+                    {
+                        "partId": "1",
+                        "mimeType": "application/pdf",
+                        "filename": f"document-{index}.pdf",
+                        "headers": [
+                            {"name": "Content-Type", "value": "application/pdf"}
+                        ],
+                        "body": {
+                            "attachmentId": f"ANGjdJ{index}",
+                            "size": attachment_size,
+                        },
+                    },
+                ],
+            }
+        return Message(
+            id=message_id(index),
+            threadId=thread_id(index),
+            historyId=str(self.historyId),
+            internalDate=str(internal),
+            labelIds=self.labels_of(index),
+            snippet=text[:100].replace("\n", " "),
+            sizeEstimate=len(text) + len(html) + attachment_size + 1200,
+            payload=payload,
+        )
+
+
+class FakeRequest:
+    """
+    Mimics googleapiclient's HttpRequest: the response is JSON encoded and decoded through
+    postproc, so the service sees the same decoding cost and response sizes as with the real API.
+    """
+
+    def __init__(self, service: FakeGMailService, method: str, handler):
+        self.service = service
+        self.method = method
+        self.handler = handler
+        self.postproc = lambda resp, content: json.loads(content)
+
+    def execute(self, http=None):
+        service = self.service
+        service.calls[self.method] += 1
+        if service.latency:
+            time.sleep(service.latency)
+        if service.error_rate and service.rng.random() < service.error_rate:
+            service.errors[self.method] += 1
+            raise HttpError(
+                httplib2.Response({"status": 500}), b'{"error": "Backend Error"}'
+            )
+        content = json.dumps(self.handler()).encode()
+        return self.postproc(httplib2.Response({"status": 200}), content)
+
+
+def message_id(index: int) -> str:
+    return format(BASE_ID + index, "x")
+
+
+def thread_id(index: int) -> str:
+    # every 4 consecutive messages form a conversation
+    return format(BASE_ID + index - index % 4, "x")
+
+
+def index_of(messageId: str) -> int:
+    return int(messageId, 16) - BASE_ID
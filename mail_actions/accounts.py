@@ -0,0 +1,295 @@
+import io
+import os as os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from typing import TypedDict
+
+import yaml as yaml
+
+from mail_actions.metrics import metrics
+
+# Gmail allows 250 quota units per user per second, a messages.get costs 5, so more than a few
+# parallel fetches per account only buys rate limit errors.
+MAX_CONCURRENCY_PER_ACCOUNT = 4
+
+
+class Account(TypedDict):
+    """
+    Represents a mailbox managed by the multi account runner.
+
+    Attributes:
+        name (str): The account name, used in logs and the summary.
+        token (str): The token file of the account.
+        db (str): The database file of the account.
+        rules (str): The rules file applied to the account.
+        concurrency (int): The number of parallel message fetches for the account.
+        storage (dict): The MailBox options of the account: cold database, retention and
+            sync window.
+        max_retries (int): The retries of a failed Gmail API request of the account.
+    """
+
+    name: str
+    token: str
+    db: str
+    rules: str
+    concurrency: int
+    storage: dict
+    max_retries: int
+
+
+class AccountSummary(TypedDict):
+    """
+    Represents the outcome of a run for one account.
+
+    Attributes:
+        name (str): The account name.
+        ok (bool): Whether the run completed.
+        error (str): The error message of a failed run.
+        seconds (float): The wall time of the run.
+        messages (int): The number of messages stored after the run.
+        new_messages (int): The number of messages added by the sync.
+        matched (int): The number of messages matched by the rules.
+        api_calls (int): The number of Gmail API calls made.
+        quota_units (int): The Gmail API quota units consumed.
+    """
+
+    name: str
+    ok: bool
+    error: str | None
+    seconds: float
+    messages: int
+    new_messages: int
+    matched: int
+    api_calls: int
+    quota_units: int
+
+
+def load_accounts(accounts_file: str) -> tuple[list[Account], int]:
+    """
+    Loads the accounts from a YAML file of the form
+
+    ```yaml
+    max_workers: 4          # accounts processed in parallel
+    rules: rules.yaml       # shared rules, default for every account
+    accounts:
+      - name: personal      # token defaults to personal.token.json, db to personal.db
+      - name: work
+        token: tokens/work.json
+        db: work.db
+        rules: work-rules.yaml
+        concurrency: 2      # parallel message fetches, capped at MAX_CONCURRENCY_PER_ACCOUNT
+        cold_db: work.cold.db     # the storage flags of a single account run, per account:
+        retention_days: 365       # --cold-db, --retention-days, --retention-mode,
+        retention_mode: cold      # --sync-window and --backfill-batch
+        sync_window: 30
+        backfill_batch: 1000
+        max_retries: 5            # --max-retries
+    ```
+
+    Returns:
+        tuple[list[Account], int]: The accounts and the number of worker processes.
+
+    Raises:
+        Exception: If the file is invalid or two accounts share a name, token or database.
+    """
+    from mail_actions.gmail.mailbox import BACKFILL_BATCH, RETENTION_MODES
+    from mail_actions.gmail.service import MAX_RETRIES
+
+    with open(accounts_file, "r") as stream:
+        config = yaml.safe_load(stream) or {}
+    if not isinstance(config.get("accounts"), list) or not config["accounts"]:
+        raise Exception("Invalid accounts file, no accounts found")
+
+    shared_rules = config.get("rules", "rules.yaml")
+    accounts = []
+    for entry in config["accounts"]:
+        if not isinstance(entry, dict) or not entry.get("name"):
+            raise Exception("Invalid accounts file, every account needs a name")
+        name = str(entry["name"])
+        retention_mode = entry.get("retention_mode", "cold")
+        if retention_mode not in RETENTION_MODES:
+            raise Exception(f"Invalid accounts file, unknown retention_mode of {name}")
+        if (
+            retention_mode == "cold"
+            and entry.get("retention_days")
+            and not entry.get("cold_db")
+        ):
+            raise Exception(f"Invalid accounts file, account {name} needs a cold_db")
+        accounts.append(
+            Account(
+                name=name,
+                token=entry.get("token", f"{name}.token.json"),
+                db=entry.get("db", f"{name}.db"),
+                rules=entry.get("rules", shared_rules),
+                concurrency=max(
+                    1,
+                    min(int(entry.get("concurrency", 1)), MAX_CONCURRENCY_PER_ACCOUNT),
+                ),
+                storage={
+                    "cold_db_path": entry.get("cold_db"),
+                    "retention_days": entry.get("retention_days"),
+                    "retention_mode": retention_mode,
+                    "sync_window_days": entry.get("sync_window"),
+                    "backfill_batch": int(entry.get("backfill_batch", BACKFILL_BATCH)),
+                },
+                max_retries=int(entry.get("max_retries", MAX_RETRIES)),
+            )
+        )
+    for key in ("name", "token", "db"):
+        values = [account[key] for account in accounts]
+        if len(values) != len(set(values)):
+            raise Exception(f"Invalid accounts file, duplicate account {key}")
+    cold = [account["storage"]["cold_db_path"] for account in accounts]
+    cold = [path for path in cold if path is not None]
+    if len(cold) != len(set(cold)):
+        raise Exception("Invalid accounts file, duplicate account cold_db")
+    return accounts, int(config.get("max_workers", os.cpu_count() or 1))
+
+
+def authorize_accounts(accounts: list[Account]):
+    """
+    Runs the interactive OAuth flow for accounts without a token file.
+    Workers run unattended, so this happens in the parent process, one account at a time.
+    """
+    import mail_actions.auth as auth
+
+    for account in accounts:
+        if not os.path.exists(account["token"]):
+            print(f"Authorize account {account['name']}")
+            auth.save_credentials(auth.get_credentials(), account["token"])
+
+
+def run_account(account: Account) -> AccountSummary:
+    """
+    Syncs one account, applies its rules, backfills mail older than its sync window and runs
+    the daily maintenance (retention, vacuum and ANALYZE). Runs in a worker process.
+
+    Returns:
+        AccountSummary: The outcome of the run, failures are reported instead of raised.
+    """
+    import mail_actions.auth as auth
+    from mail_actions.cli import backfill, is_sync_needed
+    from mail_actions.gmail.mailbox import MailBox
+    from mail_actions.gmail.service import MAX_RETRIES, GMailService
+    from mail_actions.rulecache import load_compiled_rules
+    from mail_actions.ruleengine import RuleEngine
+    from mail_actions.runlock import RunLock
+
+    metrics.reset()
+    start = time.perf_counter()
+    summary = AccountSummary(
+        name=account["name"],
+        ok=False,
+        error=None,
+        seconds=0.0,
+        messages=0,
+        new_messages=0,
+        matched=0,
+        api_calls=0,
+        quota_units=0,
+    )
+    mailbox = None
+    credentials = None
+    lock = RunLock(account["db"])
+    try:
+        # the rules output is only useful per account, the summary replaces it
+        with redirect_stdout(io.StringIO()):
+            rules = load_compiled_rules(account["rules"])
+            if not lock.try_acquire():
+                raise Exception(f"Database {account['db']} is in use by another run")
+            credentials = auth.CredentialManager(account["token"])
+            credentials.ensure_fresh()
+            credentials.start()
+            service = GMailService(
+                credentials.credentials,
+                max_retries=account.get("max_retries", MAX_RETRIES),
+            )
+            mailbox = MailBox(
+                service,
+                db_path=account["db"],
+                fetch_concurrency=account["concurrency"],
+                **(account.get("storage") or {}),
+            )
+            mailbox.init_db()
+            stats = mailbox.get_stats()
+            if is_sync_needed(service.get_profile(), stats):
+                mailbox.sync()
+            engine = RuleEngine(mailbox, service)
+            engine.apply_rules(rules)
+            backfill(mailbox, engine, rules)
+            mailbox.maintain()
+            summary["messages"] = mailbox.get_stats()["totalMessages"]
+            summary["new_messages"] = max(
+                summary["messages"] - stats["totalMessages"], 0
+            )
+        summary["ok"] = True
+    except Exception as e:
+        summary["error"] = str(e)
+    finally:
+        lock.release()
+        if credentials is not None:
+            credentials.stop()
+        if mailbox is not None:
+            mailbox.close()
+    counters = metrics.to_dict()["counters"]
+    summary["matched"] = counter_total(counters, "rule_messages_matched_total")
+    summary["api_calls"] = counter_total(counters, "gmail_api_calls_total")
+    summary["quota_units"] = counter_total(counters, "gmail_api_quota_units_total")
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+def counter_total(counters: dict, name: str) -> int:
+    return int(sum(series["value"] for series in counters.get(name, [])))
+
+
+def _init_worker():
+    # progress bars of parallel accounts would overwrite each other on the terminal
+    from progress import Infinite
+
+    Infinite.file = open(os.devnull, "w")
+
+
+def run_accounts(accounts: list[Account], max_workers: int) -> list[AccountSummary]:
+    """
+    Runs every account in a pool of worker processes, each account in its own process with its
+    own database and token, at most max_workers at a time.
+
+    Returns:
+        list[AccountSummary]: The summaries, in the order of the accounts.
+    """
+    workers = max(1, min(max_workers, len(accounts)))
+    summaries = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        futures = {pool.submit(run_account, account): account for account in accounts}
+        for future in as_completed(futures):
+            summary = future.result()
+            status = "done" if summary["ok"] else f"failed: {summary['error']}"
+            print(f"{summary['name']}: {status} in {summary['seconds']}s")
+            summaries[summary["name"]] = summary
+    return [summaries[account["name"]] for account in accounts]
+
+
+def print_summary(summaries: list[AccountSummary]):
+    """
+    Prints a table of the account summaries with a totals row.
+    """
+    columns = ["messages", "new_messages", "matched", "api_calls", "quota_units"]
+    header = f"{'account':<20} {'status':<8} {'seconds':>9} " + " ".join(
+        f"{column:>12}" for column in columns
+    )
+    print("\n" + header)
+    print("-" * len(header))
+    for summary in summaries:
+        status = "ok" if summary["ok"] else "FAILED"
+        print(
+            f"{summary['name']:<20} {status:<8} {summary['seconds']:>9.1f} "
+            + " ".join(f"{summary[column]:>12}" for column in columns)
+        )
+    failed = len([summary for summary in summaries if not summary["ok"]])
+    totals = " ".join(
+        f"{sum(summary[column] for summary in summaries):>12}" for column in columns
+    )
+    print("-" * len(header))
+    print(f"{'total':<20} {f'{failed} failed':<8} {'':>9} {totals}")
@@ -1,7 +1,14 @@
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.oauth2.credentials import Credentials
+import datetime as datetime
+import fcntl as fcntl
 import json as json
 import os as os
+import sys as sys
+import tempfile as tempfile
+import threading as threading
+from contextlib import contextmanager
+from mail_actions.metrics import metrics
 
 scope = [
     "https://www.googleapis.com/auth/gmail.modify",
@@ -34,11 +41,23 @@ def save_credentials(creds: Credentials, token_file: str):
     """
     Saves the provided credentials to a file named "token.json".
 
+    The file is replaced atomically, a crash or a concurrent reader never sees a partial token.
+
     Args:
         creds (Credentials): The credentials object to be saved.
     """
-    with open(token_file, "w") as token:
-        json.dump(json.loads(creds.to_json()), token)
+    directory = os.path.dirname(os.path.abspath(token_file))
+    # mkstemp creates the file readable by the owner only
+    (fd, tmp) = tempfile.mkstemp(dir=directory, prefix=".token-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as token:
+            json.dump(json.loads(creds.to_json()), token)
+            token.flush()
+            os.fsync(token.fileno())
+        os.replace(tmp, token_file)
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
 
 def get_saved_credentials(token_file: str) -> Credentials | None:
@@ -53,3 +72,176 @@ def get_saved_credentials(token_file: str) -> Credentials | None:
     with open(token_file, "r") as token:
         creds = json.load(token)
         return Credentials.from_authorized_user_info(creds)
+
+
+# refresh this long before the access token expires. google-auth treats a token as expired a
+# few minutes early, refreshing before that keeps requests from refreshing it themselves
+REFRESH_MARGIN = 300
+# seconds before a failed background refresh is retried
+REFRESH_RETRY = 30
+# seconds between checks of a token without an expiry
+REFRESH_IDLE = 3600
+
+
+@contextmanager
+def token_lock(token_file: str):
+    """
+    Holds an exclusive lock on the token file across processes, on a `.lock` file next to it.
+    """
+    with open(f"{token_file}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class CredentialManager:
+    """
+    Keeps the credentials of a token file fresh for long runs.
+
+    A background thread refreshes the access token ahead of its expiry, so requests never
+    stall on an expired token. Refreshes are shared: threads wait for the refresh in
+    progress, and processes using the same token file (workers, a daemon and a one-off run)
+    take a lock on it and reuse a token another process refreshed instead of refreshing
+    again. Refreshed tokens are saved to the token file atomically.
+
+    Use it as a context manager to run the background refresh:
+
+    ```python
+    with CredentialManager("token.json") as manager:
+        service = GMailService(manager.credentials)
+    ```
+
+    Attributes:
+        token_file (str): The token file.
+        credentials (Credentials): The credentials, refreshed in place.
+        margin (float): Seconds before the expiry the access token is refreshed.
+    """
+
+    def __init__(
+        self,
+        token_file: str,
+        credentials: Credentials | None = None,
+        margin: float = REFRESH_MARGIN,
+    ):
+        credentials = credentials or get_saved_credentials(token_file)
+        if credentials is None:
+            raise Exception(f"Token file {token_file} not found")
+        self.token_file = token_file
+        self.credentials = credentials
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self) -> "CredentialManager":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def expiring(self) -> bool:
+        """
+        Checks if the access token is missing, expired or expires within the margin.
+        """
+        if not self.credentials.valid:
+            return True
+        expiry = self.credentials.expiry
+        # google-auth keeps expiry as a naive UTC datetime
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (
+            expiry is not None
+            and expiry - datetime.timedelta(seconds=self.margin) <= now
+        )
+
+    def seconds_until_refresh(self) -> float:
+        """
+        Returns the seconds until the access token is due for a refresh.
+        """
+        if self.expiring():
+            return 0
+        if self.credentials.expiry is None:
+            return REFRESH_IDLE
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        due = self.credentials.expiry - datetime.timedelta(seconds=self.margin)
+        return max((due - now).total_seconds(), 0)
+
+    def ensure_fresh(self):
+        """
+        Refreshes the access token if it is due, once for all the threads calling it.
+        """
+        if not self.expiring():
+            return
+        with self._lock:
+            # another thread refreshed while this one waited for the lock
+            if not self.expiring():
+                return
+            with token_lock(self.token_file):
+                if self._adopt_saved():
+                    metrics.inc("auth_refreshes_total", source="token_file")
+                    return
+                from google.auth.transport.requests import Request
+
+                with metrics.timer("auth_refresh_seconds"):
+                    self.credentials.refresh(Request())
+                save_credentials(self.credentials, self.token_file)
+                metrics.inc("auth_refreshes_total", source="oauth")
+
+    def _adopt_saved(self) -> bool:
+        """
+        Takes over the access token of the token file if another process refreshed it.
+
+        Returns:
+            bool: True if the saved token is fresh and was taken over.
+        """
+        saved = get_saved_credentials(self.token_file)
+        if (
+            saved is None
+            or saved.token is None
+            or saved.token == self.credentials.token
+        ):
+            return False
+        current = (self.credentials.token, self.credentials.expiry)
+        self.credentials.token = saved.token
+        self.credentials.expiry = saved.expiry
+        if self.expiring():
+            (self.credentials.token, self.credentials.expiry) = current
+            return False
+        return True
+
+    def start(self):
+        """
+        Starts the background refresh thread.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._refresh_loop, name="credential-refresh", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background refresh thread.
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _refresh_loop(self):
+        delay = self.seconds_until_refresh()
+        while not self._stop.wait(delay):
+            try:
+                self.ensure_fresh()
+                # a token expiring within the margin is not refreshed in a tight loop
+                delay = max(self.seconds_until_refresh(), REFRESH_RETRY)
+            except Exception as e:
+                # requests still refresh an expired token themselves, keep trying
+                metrics.inc("auth_refresh_errors_total")
+                print(f"Credential refresh failed: {e}", file=sys.stderr)
+                delay = REFRESH_RETRY
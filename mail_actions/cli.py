@@ -1,11 +1,22 @@
+from __future__ import annotations
+
+import argparse
+import cProfile
 import os as os
+import pstats
+import sys
 import json as json
-from google.auth.transport.requests import Request
-from gmail.mailbox import MailBox, MailBoxStats
-from gmail.service import GMailService, Profile
-import auth as auth
-from ruleengine import RuleEngine
-import ruleparser as ruleparser
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+from mail_actions.metrics import metrics
+from mail_actions.tracing import tracer
+
+# The Google client libraries, jsonschema and the mailbox are imported inside the functions that
+# need them, so `--help`, argument errors and invalid rules files return without paying for them.
+if TYPE_CHECKING:
+    from mail_actions.gmail.mailbox import MailBoxStats
+    from mail_actions.gmail.service import Profile
+
 
 def is_sync_needed(profile: Profile, stats: MailBoxStats):
     """
@@ -18,9 +29,9 @@ def is_sync_needed(profile: Profile, stats: MailBoxStats):
     Returns:
         bool: True if synchronization is needed, False otherwise.
     """
-    return stats.get("lastHistoryId") is None or stats.get("lastHistoryId") != profile.get(
-        "historyId"
-    )
+    return stats.get("lastHistoryId") is None or stats.get(
+        "lastHistoryId"
+    ) != profile.get("historyId")
 
 
 def print_welcome(profile: Profile, stats: MailBoxStats):
@@ -28,45 +39,558 @@ def print_welcome(profile: Profile, stats: MailBoxStats):
     print(f"Total messages: {profile.get('messagesTotal')}")
 
     if is_sync_needed(profile, stats):
-        print(f"New Messages: {profile.get("messagesTotal") - stats.get('totalMessages')}")
+        print(
+            f"New Messages: {profile.get('messagesTotal') - stats.get('totalMessages')}"
+        )
         print(f"\nSYNC NEEDED\n")
     else:
         print("\nNo new messages\n")
 
+
 TOKEN_FILE = "token.json"
 RULES_FILE = "rules.yaml"
+DB_FILE = "store.db"
 
 
-def main():
-    creds = auth.get_saved_credentials(TOKEN_FILE)
-    if not creds:
-        # if creds not found, get creds
-        creds = auth.get_credentials()
-        auth.save_credentials(creds, TOKEN_FILE)
-    if not creds.valid:
-        # if creds are not valid, refresh creds
-        creds.refresh(Request())
-        auth.save_credentials(creds, TOKEN_FILE)
-
-    service = GMailService(creds)
-    mailbox = MailBox(service)
-    mailbox.init_db()
-    rule_engine = RuleEngine(mailbox, service)
-    stats = mailbox.get_stats()
-    profile = service.get_profile()
-    print_welcome(profile, stats)
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Sync Gmail to a local database and apply rules"
+    )
+    parser.add_argument(
+        "--metrics-json", metavar="FILE", help="Write run metrics as JSON to FILE"
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        metavar="FILE",
+        help="Write run metrics as a Prometheus textfile to FILE",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running, applying the rules to new messages as they arrive",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=30.0,
+        metavar="SECONDS",
+        help="Seconds between polls in --watch mode (default 30)",
+    )
+    parser.add_argument(
+        "--accounts",
+        metavar="FILE",
+        help="Run every account listed in FILE, see accounts.load_accounts for the format",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        metavar="N",
+        help="Accounts processed in parallel with --accounts (default max_workers from FILE)",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Skip the upfront full sync, run each rule locally or as a Gmail search, whichever is cheaper",
+    )
+    parser.add_argument(
+        "--import-mbox",
+        metavar="FILE",
+        help="Load a Google Takeout mbox export before syncing, so the sync only fetches newer mail",
+    )
+    parser.add_argument(
+        "--db",
+        metavar="FILE",
+        default=DB_FILE,
+        help=f"Database of the mailbox (default {DB_FILE}), a separate one with --replay",
+    )
+    parser.add_argument(
+        "--cold-db",
+        metavar="FILE",
+        help="Database the retention policy moves old messages to",
+    )
+    parser.add_argument(
+        "--retention-days",
+        type=int,
+        metavar="DAYS",
+        help="Archive messages older than DAYS once a day (default keep every message hot)",
+    )
+    parser.add_argument(
+        "--retention-mode",
+        choices=["cold", "metadata"],
+        default="cold",
+        help="Move archived messages to --cold-db (default), or keep only their metadata",
+    )
+    parser.add_argument(
+        "--sync-window",
+        type=int,
+        metavar="DAYS",
+        help="Only sync the mail of the last DAYS before applying the rules, older mail is "
+        "backfilled in batches afterwards (default sync the whole mailbox)",
+    )
+    parser.add_argument(
+        "--backfill-batch",
+        type=int,
+        default=1000,
+        metavar="N",
+        help="Older messages fetched per run, or per poll in --watch mode, with --sync-window "
+        "(default 1000)",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=10.0,
+        metavar="SECONDS",
+        help="Seconds to wait for a connection to the Gmail API (default 10)",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=60.0,
+        metavar="SECONDS",
+        help="Seconds to wait for Gmail API response data (default 60)",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        metavar="N",
+        help="Retries of a rate limited or failed (5xx) Gmail API request, with exponential "
+        "backoff (default 5)",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="FILE",
+        help="Record the sanitized Gmail API requests and responses of the run to FILE",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="FILE",
+        help="Answer the Gmail API requests from a FILE recorded with --record, offline",
+    )
+    parser.add_argument(
+        "--replay-latency",
+        type=float,
+        default=1.0,
+        metavar="FACTOR",
+        help="Scale the recorded response times with --replay, 0 to answer at once (default 1)",
+    )
+    parser.add_argument(
+        "--if-running",
+        choices=["wait", "exit", "read-only"],
+        default="exit",
+        help="When another run is using the database: wait for it, exit (default), or only "
+        "evaluate the rules on the stored messages without syncing or modifying them",
+    )
+    parser.add_argument(
+        "--lock-timeout",
+        type=float,
+        metavar="SECONDS",
+        help="Seconds to wait for the other run with --if-running wait (default no limit)",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="Profile the run with cProfile, writing stats to FILE and a span trace to FILE.trace.json",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="Write a span trace (Chrome trace event format) of the hot functions to FILE",
+    )
+    return parser.parse_args(argv)
 
-    if is_sync_needed(profile, stats):
-        mailbox.sync()
+
+def authenticate():
+    """
+    Loads the saved credentials, running the OAuth flow when there are none, and keeps them
+    fresh in the background for the rest of the process, a sync can outlive the access token.
+
+    Returns:
+        Credentials: The credentials, refreshed in place by an auth.CredentialManager.
+    """
+    import mail_actions.auth as auth
+
+    with metrics.phase("auth"):
+        if not os.path.exists(TOKEN_FILE):
+            # if creds not found, get creds
+            auth.save_credentials(auth.get_credentials(), TOKEN_FILE)
+        manager = auth.CredentialManager(TOKEN_FILE)
+        # refreshes expired credentials now, then ahead of their expiry in a daemon thread
+        manager.ensure_fresh()
+        manager.start()
+    return manager.credentials
+
+
+@contextmanager
+def run_lock(db_path: str, on_locked: str, timeout: float | None = None):
+    """
+    Holds the run lease of the database for the duration of the block, see runlock.RunLock.
+
+    Args:
+        db_path (str): The database of the run.
+        on_locked (str): What to do when another run holds the lease, one of runlock.ON_LOCKED.
+        timeout (float, optional): Seconds to wait for the lease with "wait", None for no limit.
+
+    Yields:
+        bool: True if the block must not modify the database, the lease is held by another run
+            and on_locked is "read-only".
+    """
+    from mail_actions.runlock import RunLock
+
+    lock = RunLock(db_path)
     try:
-        rules = ruleparser.load_rules(RULES_FILE)
+        with metrics.phase("lock"):
+            acquired = lock.try_acquire()
+            if not acquired:
+                holder = lock.holder()
+                owner = holder["owner"] if holder else "unknown"
+                print(f"Another run ({owner}) is using {db_path}")
+                if on_locked == "exit":
+                    raise SystemExit(0)
+                if on_locked == "wait":
+                    if not lock.acquire(timeout):
+                        raise SystemExit(f"Timed out waiting for the run of {owner}")
+                    acquired = True
+        yield not acquired
+    finally:
+        lock.release()
+
+
+def storage_options(args: argparse.Namespace) -> dict:
+    """
+    Returns the MailBox options of the database, retention and sync window flags.
+    """
+    if args.retention_mode == "cold" and args.retention_days and not args.cold_db:
+        raise SystemExit("--retention-mode cold needs a --cold-db")
+    if args.replay and os.path.abspath(args.db) == os.path.abspath(DB_FILE):
+        raise SystemExit(
+            f"--replay needs a separate --db, it must not write to {DB_FILE}"
+        )
+    if args.replay and args.cold_db:
+        raise SystemExit(
+            "--replay runs on the --db only, it can't be combined with --cold-db"
+        )
+    return {
+        "db_path": args.db,
+        "cold_db_path": args.cold_db,
+        "retention_days": args.retention_days,
+        "retention_mode": args.retention_mode,
+        "sync_window_days": args.sync_window,
+        "backfill_batch": args.backfill_batch,
+    }
+
+
+def http_options(args: argparse.Namespace) -> dict:
+    """
+    Returns the transport options of the timeout, retry, record and replay flags, see
+    open_transport and build_service.
+    """
+    if args.record and args.replay:
+        raise SystemExit("--record and --replay can't be combined")
+    return {
+        "connect_timeout": args.connect_timeout,
+        "read_timeout": args.read_timeout,
+        "max_retries": args.max_retries,
+        "record": args.record,
+        "replay": args.replay,
+        "replay_latency": args.replay_latency,
+    }
+
+
+def open_transport(http: dict | None = None):
+    """
+    Authenticates and builds the transport of the Gmail service: a transport.HttpPool, wrapped
+    in a cassette.RecordingTransport with "record", or a cassette.ReplayTransport with "replay",
+    which needs no credentials.
+
+    Returns:
+        tuple[Credentials, Transport]: The credentials and the transport.
+    """
+    from google.oauth2.credentials import Credentials
+    from mail_actions.gmail.cassette import RecordingTransport, ReplayTransport
+    from mail_actions.gmail.transport import HttpPool
+
+    options = dict(http or {})
+    # applies to the service, see build_service
+    options.pop("max_retries", None)
+    record = options.pop("record", None)
+    replay = options.pop("replay", None)
+    latency = options.pop("replay_latency", 1.0)
+    if replay:
+        return (Credentials(token="replay"), ReplayTransport(replay, latency))
+    creds = authenticate()
+    transport = HttpPool(creds, **options)
+    if record:
+        transport = RecordingTransport(transport, record)
+    return (creds, transport)
+
+
+def build_service(creds, transport, http: dict | None = None):
+    """
+    Builds the Gmail service of a run on a transport of open_transport, retrying failed
+    requests "max_retries" times, the GMailService default when it is None.
+    """
+    from mail_actions.gmail.service import MAX_RETRIES, GMailService
+
+    max_retries = (http or {}).get("max_retries")
+    return GMailService(
+        creds,
+        max_retries=MAX_RETRIES if max_retries is None else max_retries,
+        transport=transport,
+    )
+
+
+def save_snapshot(storage: dict | None, http: dict | None):
+    """
+    Stores the database alongside the cassette when recording, a replay of the cassette starts
+    from the database the recording started from.
+    """
+    from mail_actions.gmail.cassette import copy_database, snapshot_path
+
+    record = (http or {}).get("record")
+    if record:
+        copy_database((storage or {}).get("db_path", DB_FILE), snapshot_path(record))
+
+
+def restore_snapshot(args: argparse.Namespace):
+    """
+    Replaces the --db of a replay by the database snapshot stored alongside the cassette. The
+    run lease of the database is held during the copy, a database another run holds is left
+    alone. The snapshot has no leases, the lease is taken again for the replay.
+    """
+    from mail_actions.gmail.cassette import copy_database, snapshot_path
+    from mail_actions.runlock import RunLock
+
+    if not args.replay:
+        return
+    with RunLock(args.db) as lock:
+        if not lock.try_acquire():
+            raise SystemExit(
+                f"Another run is using {args.db}, the replay snapshot can't replace it"
+            )
+        copy_database(snapshot_path(args.replay), args.db)
+
+
+def watch(interval: float, storage: dict | None = None, http: dict | None = None):
+    """
+    Runs the daemon until SIGINT/SIGTERM. SIGUSR1 triggers an immediate poll.
+    """
+    from mail_actions.daemon import Daemon
+    from mail_actions.gmail.mailbox import MailBox
+
+    save_snapshot(storage, http)
+    (creds, transport) = open_transport(http)
+    with metrics.phase("startup"):
+        service = build_service(creds, transport, http)
+        mailbox = MailBox(service, **(storage or {}))
+        mailbox.init_db()
+    daemon = Daemon(mailbox, service, RULES_FILE, interval=interval)
+    daemon.install_signal_handlers()
+    daemon.run()
+
+
+def check_accounts_args(args: argparse.Namespace):
+    """
+    Rejects the flags of a single account run combined with --accounts, the storage options
+    are set per account in the accounts file instead.
+    """
+    flags = {
+        "--watch": args.watch,
+        "--plan": args.plan,
+        "--import-mbox": args.import_mbox,
+        "--db": args.db != DB_FILE,
+        "--cold-db": args.cold_db,
+        "--retention-days": args.retention_days,
+        "--retention-mode": args.retention_mode != "cold",
+        "--sync-window": args.sync_window,
+        "--max-retries": args.max_retries is not None,
+        "--record": args.record,
+        "--replay": args.replay,
+    }
+    used = [flag for (flag, value) in flags.items() if value]
+    if used:
+        raise SystemExit(
+            f"{', '.join(used)} can't be combined with --accounts, "
+            "set the storage options per account in the accounts file"
+        )
+
+
+def run_multi(accounts_file: str, workers: int | None):
+    """
+    Syncs and applies rules to every account of the accounts file in parallel worker processes.
+    """
+    from mail_actions.accounts import (
+        authorize_accounts,
+        load_accounts,
+        print_summary,
+        run_accounts,
+    )
+
+    accounts, max_workers = load_accounts(accounts_file)
+    authorize_accounts(accounts)
+    summaries = run_accounts(accounts, workers or max_workers)
+    print_summary(summaries)
+    if not all(summary["ok"] for summary in summaries):
+        sys.exit(1)
+
+
+def run(
+    plan: bool = False,
+    mbox: str | None = None,
+    storage: dict | None = None,
+    read_only: bool = False,
+    http: dict | None = None,
+):
+    from mail_actions.rulecache import load_compiled_rules
+    from mail_actions.gmail.mailbox import MailBox
+    from mail_actions.ruleengine import RuleEngine
+
+    # rules are validated before any API work, an invalid rules file fails without a sync
+    with metrics.phase("load_rules"):
+        rules = load_compiled_rules(RULES_FILE)
+
+    save_snapshot(storage, http)
+    (creds, transport) = open_transport(http)
+
+    with metrics.phase("startup"):
+        # the discovery client is only built by the first API call
+        service = build_service(creds, transport, http)
+        mailbox = MailBox(service, read_only=read_only, **(storage or {}))
+        if not read_only:
+            # the run holding the lease owns the schema, a read-only run only reads it
+            mailbox.init_db()
+        rule_engine = RuleEngine(mailbox, service, read_only)
+        stats = mailbox.get_stats()
+        profile = service.get_profile()
+    print_welcome(profile, stats)
+
+    if read_only:
+        # another run is syncing, the rules only report their matches in the stored messages
+        with metrics.phase("rules"):
+            rule_engine.apply_rules(rules)
+        return
+
+    if mbox:
+        import_export(mailbox, service, mbox)
+        stats = mailbox.get_stats()
+    if plan:
+        run_planned(rules, mailbox, service, rule_engine, profile)
+    else:
+        if is_sync_needed(profile, stats):
+            with metrics.phase("sync"):
+                mailbox.sync()
         if len(rules) == 0:
             print("No rules found")
-            return
-        for rule in rules:
-            rule_engine.apply_rule(rule)
-    except Exception as e:
-        raise e
+        with metrics.phase("rules"):
+            rule_engine.apply_rules(rules)
+    backfill(mailbox, rule_engine, rules)
+    # archives old messages and vacuums, at most once a day
+    with metrics.phase("maintenance"):
+        mailbox.maintain()
+
+
+def import_export(mailbox, service, mbox: str):
+    """
+    Bulk loads an mbox export into the mailbox, the following sync fetches only the difference.
+    """
+    from mail_actions.importer import import_mbox, user_labels
+
+    summary = import_mbox(mailbox, mbox, user_labels(service))
+    print(
+        f"Imported {summary['imported']} of {summary['read']} messages, "
+        f"{summary['existing']} already stored, {summary['skipped']} skipped"
+    )
+
+
+def backfill(mailbox, rule_engine, rules):
+    """
+    Fetches a batch of the mail older than the sync window, once the rules ran on the recent
+    mail, and applies the rules to it.
+    """
+    if not mailbox.backfill_pending():
+        return
+    with metrics.phase("backfill"):
+        ids = mailbox.backfill()
+    if ids:
+        with metrics.phase("rules"):
+            rule_engine.apply_rules(rules, set(ids))
+
+
+def run_planned(rules, mailbox, service, rule_engine, profile):
+    """
+    Runs each rule as planned by planner.Planner, syncing the mailbox only once a rule needs
+    to run locally.
+    """
+    from mail_actions.planner import Planner
+
+    planner = Planner(mailbox, service)
+    for rule in rules:
+        with metrics.phase("plan"):
+            plan = planner.plan(rule, profile)
+        print(f"Plan for {rule['rule']['name']}: {plan['mode']}, {plan['reason']}")
+        if plan["mode"] == "remote":
+            with metrics.phase("rules"):
+                rule_engine.apply_remote_rule(rule, plan["query"])
+            continue
+        if not planner.is_fresh(profile):
+            with metrics.phase("sync"):
+                mailbox.sync()
+        with metrics.phase("rules"):
+            rule_engine.apply_compiled_rule(rule)
+
+
+def print_profile_summary(profiler: cProfile.Profile, limit: int = 20):
+    """
+    Prints the functions with the highest cumulative time to stderr.
+    Use `python -m pstats FILE` or snakeviz on the stats file for the full profile.
+    """
+    stats = pstats.Stats(profiler, stream=sys.stderr)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+
+
+def main(argv: list[str] | None = None):
+    args = parse_args(argv)
+    trace_file = args.trace or (args.profile and f"{args.profile}.trace.json")
+    if trace_file:
+        tracer.start()
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        if profiler:
+            profiler.enable()
+        with metrics.phase("total"):
+            if args.accounts:
+                check_accounts_args(args)
+                run_multi(args.accounts, args.workers)
+            elif args.watch:
+                storage = storage_options(args)
+                restore_snapshot(args)
+                # a second daemon waits for the lease, as a standby of the first one
+                with run_lock(args.db, "wait", args.lock_timeout):
+                    watch(args.interval, storage, http_options(args))
+            else:
+                storage = storage_options(args)
+                restore_snapshot(args)
+                with run_lock(args.db, args.if_running, args.lock_timeout) as read_only:
+                    run(
+                        args.plan,
+                        args.import_mbox,
+                        storage,
+                        read_only,
+                        http_options(args),
+                    )
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print_profile_summary(profiler)
+        if trace_file:
+            tracer.stop()
+            tracer.write(trace_file)
+        # emit metrics for failed runs too, so they can be alerted on
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+        if args.metrics_prom:
+            metrics.write_prometheus(args.metrics_prom)
+
 
 if __name__ == "__main__":
     try:
@@ -74,4 +598,3 @@ if __name__ == "__main__":
     except KeyboardInterrupt as e:
         print("Exiting")
         pass
-    
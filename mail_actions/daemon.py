@@ -0,0 +1,141 @@
+import signal
+import threading
+
+from mail_actions.gmail.mailbox import MailBox
+from mail_actions.gmail.service import GMailService
+from mail_actions.metrics import metrics
+from mail_actions.rulecache import load_compiled_rules
+from mail_actions.ruleengine import CompiledRule, RuleEngine
+
+
+class Daemon:
+    """
+    Keeps the mailbox in sync and applies the rules to new mail until stopped.
+
+    The service, the database connection and the compiled rules stay warm between polls. Every
+    `interval` seconds, or as soon as notify() is called, the mailbox is synced from the Gmail
+    history and the rules are applied to the added or changed messages only. With a sync window
+    (see MailBox.sync_window_days) every poll also backfills a batch of older mail.
+
+    Attributes:
+        mailbox (MailBox): The mailbox to keep in sync.
+        service (GMailService): The Gmail service used by the mailbox.
+        rules_file (str): Path of the rules file, recompiled when it changes.
+        interval (float): Seconds between polls.
+    """
+
+    def __init__(
+        self,
+        mailbox: MailBox,
+        service: GMailService,
+        rules_file: str,
+        interval: float = 30.0,
+    ):
+        self.mailbox = mailbox
+        self.service = service
+        self.rules_file = rules_file
+        self.interval = interval
+        self.rule_engine = RuleEngine(mailbox, service)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def load_rules(self) -> list[CompiledRule]:
+        """
+        Returns the compiled rules, recompiling them only when the rules or schema file changed.
+        """
+        return load_compiled_rules(self.rules_file)
+
+    def notify(self, historyId: str | None = None):
+        """
+        Push notification hook: wakes the daemon to poll now instead of at the next interval.
+
+        Call it from a Gmail push (Pub/Sub) subscriber, SIGUSR1 triggers it as well.
+
+        Args:
+            historyId (str, optional): The history ID from the notification, unused for now as the
+                poll always syncs from the last stored history ID.
+        """
+        self._wake.set()
+
+    def stop(self):
+        """
+        Asks the daemon to exit. A poll in progress is completed first.
+        """
+        self._stop.set()
+        self._wake.set()
+
+    def install_signal_handlers(self):
+        """
+        Stops the daemon on SIGINT/SIGTERM and polls immediately on SIGUSR1.
+        Must be called from the main thread.
+        """
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.notify())
+
+    def poll(self) -> set[str] | None:
+        """
+        Syncs the mailbox and applies the rules to new or changed messages.
+
+        The first poll (or one whose stored history ID expired) runs a full sync and applies
+        the rules to all messages.
+
+        Returns:
+            set[str] | None: The IDs of the messages the rules were applied to, None for all messages.
+        """
+        changed = None
+        startHistoryId = self.mailbox.get_state("historyId")
+        with metrics.phase("sync"):
+            if startHistoryId is not None:
+                changed = self.mailbox.sync_history(startHistoryId)
+            if changed is None:
+                profile = self.service.get_profile()
+                self.mailbox.sync()
+                self.mailbox.set_state("historyId", profile["historyId"])
+        if changed is not None and len(changed) == 0:
+            return changed
+        with metrics.phase("load_rules"):
+            rules = self.load_rules()
+        with metrics.phase("rules"):
+            self.rule_engine.apply_rules(rules, changed)
+        return changed
+
+    def backfill(self) -> list[str]:
+        """
+        Fetches a batch of the mail older than the sync window and applies the rules to it.
+
+        Returns:
+            list[str]: The IDs of the fetched messages.
+        """
+        if not self.mailbox.backfill_pending():
+            return []
+        with metrics.phase("backfill"):
+            ids = self.mailbox.backfill()
+        if ids:
+            with metrics.phase("rules"):
+                self.rule_engine.apply_rules(self.load_rules(), set(ids))
+        return ids
+
+    def run(self):
+        """
+        Polls until stop() is called, then closes the database and service connections.
+        A failed poll is reported and retried at the next interval.
+        """
+        print(f"Watching for new messages every {self.interval} seconds")
+        while not self._stop.is_set():
+            self._wake.clear()
+            metrics.inc("daemon_polls_total")
+            try:
+                self.poll()
+                # new mail first, older mail in the time left until the next poll
+                self.backfill()
+                # archives old messages and vacuums, at most once a day
+                with metrics.phase("maintenance"):
+                    self.mailbox.maintain()
+            except Exception as e:
+                metrics.inc("daemon_poll_errors_total")
+                print(f"Poll failed: {e}")
+            self._wake.wait(self.interval)
+        print("Stopping")
+        self.mailbox.close()
+        self.service.close()
@@ -0,0 +1,189 @@
+import time
+from typing import TypedDict
+
+from mail_actions.gmail.mailbox import MailBox
+from mail_actions.gmail.service import GMailService
+from mail_actions.metrics import metrics
+from mail_actions.tracing import traced
+
+# messages.batchModify accepts at most 1000 message IDs per call
+MAX_BATCH_SIZE = 1000
+
+
+class DispatchSummary(TypedDict):
+    """
+    Represents the state of the outbox after a drain.
+
+    Attributes:
+        sent (int): The number of outbox entries sent in this drain.
+        pending (int): The number of entries waiting for a retry.
+        failed (int): The number of entries that ran out of attempts.
+    """
+
+    sent: int
+    pending: int
+    failed: int
+
+
+def coalesce(entries: list[tuple]) -> dict[tuple[str, str], tuple[set, set, list]]:
+    """
+    Folds the outbox entries of each message or thread, in order, into one net label change.
+
+    Adding then removing a label leaves only the removal, adding a label twice adds it once.
+
+    Args:
+        entries (list[tuple]): Outbox entries as returned by MailBox.pending_outbox.
+
+    Returns:
+        dict: (kind, target_id) -> (added labels, removed labels, outbox entry IDs).
+    """
+    net = {}
+    for entryId, kind, target, add, remove, _ in entries:
+        (added, removed, entryIds) = net.setdefault((kind, target), (set(), set(), []))
+        for label in add:
+            added.add(label)
+            removed.discard(label)
+        for label in remove:
+            removed.add(label)
+            added.discard(label)
+        entryIds.append(entryId)
+    return net
+
+
+class Dispatcher:
+    """
+    Sends the label changes recorded in the outbox to Gmail.
+
+    The changes of a message are coalesced into one net change, messages with the same net
+    change are sent together with messages.batchModify, threads with threads.modify. Failed
+    calls are retried with exponential backoff, entries are marked done only once Gmail
+    accepted them, so a crash never loses a change.
+
+    Attributes:
+        mailbox (MailBox): The mailbox holding the outbox.
+        service (GMailService): The Gmail service.
+        batch_size (int): The maximum number of messages per batchModify call.
+        max_attempts (int): Attempts before an entry is marked failed.
+        backoff (float): Seconds before the first retry, doubled on every attempt.
+        max_backoff (float): The maximum seconds between attempts.
+    """
+
+    def __init__(
+        self,
+        mailbox: MailBox,
+        service: GMailService,
+        batch_size: int = MAX_BATCH_SIZE,
+        max_attempts: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 300.0,
+    ):
+        self.mailbox = mailbox
+        self.service = service
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def drain(self, wait: bool = False) -> DispatchSummary:
+        """
+        Sends every due outbox entry.
+
+        Args:
+            wait (bool, optional): Sleep until scheduled retries are due and send them too,
+                until no entry is pending. Defaults to False, retries are left for a later drain.
+
+        Returns:
+            DispatchSummary: The number of entries sent and left in the outbox.
+        """
+        sent = 0
+        start = time.time()
+        while True:
+            # without wait, entries rescheduled by this drain are left for the next one
+            (handled, accepted) = self.dispatch_once(time.time() if wait else start)
+            sent += accepted
+            if handled:
+                continue
+            counts = self.mailbox.outbox_counts()
+            next_attempt_at = counts.get("next_attempt_at")
+            if not wait or next_attempt_at is None:
+                return DispatchSummary(
+                    sent=sent,
+                    pending=counts.get("pending", 0),
+                    failed=counts.get("failed", 0),
+                )
+            time.sleep(max(next_attempt_at - time.time(), 0))
+
+    def dispatch_once(self, now: float) -> tuple[int, int]:
+        """
+        Sends one page of the outbox entries due at `now`.
+
+        Returns:
+            tuple[int, int]: The number of outbox entries handled (sent or rescheduled) and sent.
+        """
+        entries = self.mailbox.pending_outbox(now, self.batch_size * 4)
+        if not entries:
+            return 0, 0
+        sent = 0
+        attempts = {entry[0]: entry[5] for entry in entries}
+        batches = {}
+        for (kind, target), (added, removed, entryIds) in coalesce(entries).items():
+            if not added and not removed:
+                self.mailbox.complete_outbox(entryIds, kind, [], [], [])
+                metrics.inc("outbox_coalesced_total", len(entryIds))
+                sent += len(entryIds)
+                continue
+            if kind == "thread":
+                sent += self.send(
+                    kind, [target], sorted(added), sorted(removed), entryIds, attempts
+                )
+                continue
+            batch = batches.setdefault(
+                (tuple(sorted(added)), tuple(sorted(removed))), []
+            )
+            batch.append((target, entryIds))
+        for (added, removed), targets in batches.items():
+            for start in range(0, len(targets), self.batch_size):
+                chunk = targets[start : start + self.batch_size]
+                sent += self.send(
+                    "message",
+                    [target for (target, _) in chunk],
+                    list(added),
+                    list(removed),
+                    [entryId for (_, entryIds) in chunk for entryId in entryIds],
+                    attempts,
+                )
+        return len(entries), sent
+
+    @traced("dispatcher.send")
+    def send(
+        self,
+        kind: str,
+        ids: list[str],
+        added: list[str],
+        removed: list[str],
+        entryIds: list[int],
+        attempts: dict[int, int],
+    ) -> int:
+        """
+        Sends one label change and records the outcome of its outbox entries.
+
+        Returns:
+            int: The number of outbox entries sent, 0 when the call failed.
+        """
+        try:
+            if kind == "thread":
+                self.service.update_thread_labels(ids[0], added, removed)
+            else:
+                self.service.batch_update_labels(ids, added, removed)
+        except Exception as e:
+            attempt = max(attempts[entryId] for entryId in entryIds) + 1
+            failed = attempt >= self.max_attempts
+            delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+            self.mailbox.retry_outbox(entryIds, str(e), time.time() + delay, failed)
+            metrics.inc(
+                "outbox_failed_total" if failed else "outbox_retries_total", kind=kind
+            )
+            return 0
+        self.mailbox.complete_outbox(entryIds, kind, ids, added, removed)
+        metrics.inc("outbox_sent_total", len(entryIds), kind=kind)
+        return len(entryIds)
@@ -0,0 +1,352 @@
+import base64
+import hashlib
+import json as json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import closing, contextmanager
+from email.utils import formataddr, getaddresses
+from typing import Iterator, TypedDict
+from urllib.parse import unquote
+
+import httplib2
+
+from mail_actions.gmail.transport import Transport
+from mail_actions.metrics import metrics
+
+# email addresses, replaced by a pseudonym keeping the domain, rules on domains still match.
+# A local part only starts after a character that can't be part of it, scanning a long base64
+# body would otherwise retry from every one of its characters, in quadratic time
+ADDRESS_RE = re.compile(
+    r"(?<![A-Za-z0-9._%+-])([A-Za-z0-9._%+-]+)@((?:[A-Za-z0-9-]+\.)+[A-Za-z]{2,})"
+)
+PSEUDONYM_RE = re.compile(r"user-[0-9a-f]{10}")
+# response fields holding message content, replaced by filler of the same size
+CONTENT_FIELDS = ("data", "raw")
+TEXT_FIELDS = ("snippet",)
+# message headers whose display names are replaced by the pseudonym of their address
+ADDRESS_HEADERS = ("from", "to", "cc", "bcc", "reply-to", "sender")
+# message headers dropped, they name the hosts and mailboxes a message went through
+HOP_HEADERS = (
+    "received",
+    "x-received",
+    "delivered-to",
+    "return-path",
+    "authentication-results",
+    "received-spf",
+    "x-original-to",
+    "x-forwarded-to",
+    "x-forwarded-for",
+)
+HOP_HEADER_PREFIXES = ("arc-", "dkim-", "x-google-", "x-gm-")
+# the OAuth token endpoints, their requests carry the refresh token and are never recorded
+TOKEN_URIS = ("oauth2.googleapis.com", "accounts.google.com")
+# the only response headers replayed, the client only reads the status and content type
+RECORDED_HEADERS = ("content-type",)
+
+
+class Interaction(TypedDict):
+    """
+    Represents one recorded request and its response, a line of a cassette file.
+
+    Attributes:
+        method (str): The HTTP method.
+        uri (str): The request URI, unquoted and sanitized.
+        body (str | None): The request body, sanitized.
+        status (int): The response status.
+        headers (dict[str, str]): The response headers of RECORDED_HEADERS.
+        content (str): The response content, sanitized.
+        seconds (float): How long the request took when recorded.
+    """
+
+    method: str
+    uri: str
+    body: str | None
+    status: int
+    headers: dict[str, str]
+    content: str
+    seconds: float
+
+
+def pseudonym(match: re.Match) -> str:
+    """
+    Returns the pseudonym of a matched address, `user-<hash>@domain`. Pseudonyms are kept.
+    """
+    (local, domain) = match.groups()
+    if PSEUDONYM_RE.fullmatch(local):
+        return match.group(0)
+    digest = hashlib.sha256(f"{local}@{domain}".lower().encode()).hexdigest()
+    return f"user-{digest[:10]}@{domain}"
+
+
+def sanitize_text(text: str) -> str:
+    """
+    Replaces the email addresses of a text by pseudonyms, the same address always gets the
+    same pseudonym so a replayed request matches its recording.
+    """
+    return ADDRESS_RE.sub(pseudonym, text)
+
+
+def sanitize_address_header(value: str) -> str:
+    """
+    Replaces the display names of an address header by the pseudonym of their address,
+    `"Jane Doe" <jane@example.com>` becomes `user-<hash> <user-<hash>@example.com>`.
+    """
+    addresses = []
+    for name, address in getaddresses([value]):
+        address = sanitize_text(address)
+        if name:
+            name = address.split("@")[0]
+        addresses.append(formataddr((name, address)))
+    return ", ".join(addresses)
+
+
+def sanitize_headers(headers: list) -> list:
+    """
+    Sanitizes the headers of a message payload: the hop headers are dropped and the display
+    names of the address headers are replaced by pseudonyms.
+    """
+    sanitized = []
+    for header in headers:
+        name = header.get("name", "").lower()
+        if name in HOP_HEADERS or name.startswith(HOP_HEADER_PREFIXES):
+            continue
+        if name in ADDRESS_HEADERS and isinstance(header.get("value"), str):
+            header = {**header, "value": sanitize_address_header(header["value"])}
+        sanitized.append(header)
+    return sanitized
+
+
+def sanitize_content(content: str) -> str:
+    """
+    Sanitizes a response: message bodies, raw messages and snippets are replaced by filler of
+    the same size, email addresses and display names by pseudonyms, and the hop headers
+    (Received, Delivered-To, ...) are dropped. Subjects and label names are kept.
+    """
+    try:
+        value = json.loads(content)
+    except ValueError:
+        return sanitize_text(content)
+
+    def redact(value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if key in CONTENT_FIELDS and isinstance(item, str):
+                    size = len(item) * 3 // 4
+                    value[key] = base64.urlsafe_b64encode(b"x" * size).decode()
+                elif key in TEXT_FIELDS and isinstance(item, str):
+                    value[key] = "x" * len(item)
+                elif key == "headers" and isinstance(item, list):
+                    value[key] = sanitize_headers(item)
+                else:
+                    redact(item)
+        elif isinstance(value, list):
+            for item in value:
+                redact(item)
+
+    redact(value)
+    return sanitize_text(json.dumps(value))
+
+
+def request_key(method: str, uri: str, body) -> tuple[str, str, str | None]:
+    """
+    Returns the key a request is recorded and replayed under.
+    """
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    return (
+        method,
+        sanitize_text(unquote(uri)),
+        None if body is None else sanitize_text(body),
+    )
+
+
+def snapshot_path(cassette: str) -> str:
+    """
+    Returns the path of the database snapshot stored alongside a cassette.
+    """
+    return f"{cassette}.db"
+
+
+def copy_database(source: str, target: str):
+    """
+    Copies a SQLite database with the backup API, consistent while another connection uses
+    the source. A missing source leaves an empty target. The run leases are not copied, the
+    copy is used by another run.
+    """
+    with closing(
+        sqlite3.connect(source if os.path.exists(source) else ":memory:")
+    ) as src, closing(sqlite3.connect(target)) as dst:
+        src.backup(dst)
+        dst.execute("DROP TABLE IF EXISTS run_leases")
+        dst.commit()
+
+
+class RecordingClient:
+    """
+    Wraps the client lent by a transport, recording the requests it executes.
+    """
+
+    def __init__(self, client, recorder: "RecordingTransport"):
+        self.client = client
+        self.recorder = recorder
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        start = time.perf_counter()
+        (resp, content) = self.client.request(
+            uri, method, body, headers, *args, **kwargs
+        )
+        seconds = time.perf_counter() - start
+        self.recorder.record(method, uri, body, resp, content, seconds)
+        return (resp, content)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class RecordingTransport:
+    """
+    Records the requests executed on another transport to a cassette, a JSON Lines file
+    of Interaction, to replay them offline with ReplayTransport.
+
+    Interactions are sanitized before they are written: request headers (with the access
+    token) are not recorded, neither are the requests of the OAuth token endpoints, message
+    bodies are replaced by filler of the same size, email addresses and display names by
+    pseudonyms, and hop headers are dropped. Subjects and label names are kept. Each interaction is written as it completes, an
+    interrupted run leaves a usable cassette.
+
+    Attributes:
+        transport (Transport): The transport executing the requests.
+        path (str): The cassette file, overwritten.
+    """
+
+    def __init__(self, transport: Transport, path: str):
+        self.transport = transport
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "w")
+
+    @contextmanager
+    def connection(self) -> Iterator[RecordingClient]:
+        """
+        Lends a recording client of the wrapped transport for one request.
+        """
+        with self.transport.connection() as client:
+            yield RecordingClient(client, self)
+
+    def record(self, method: str, uri: str, body, resp, content: bytes, seconds: float):
+        """
+        Sanitizes and appends an interaction to the cassette.
+        """
+        if any(host in uri for host in TOKEN_URIS):
+            return
+        (method, uri, body) = request_key(method, uri, body)
+        interaction = Interaction(
+            method=method,
+            uri=uri,
+            body=body,
+            status=resp.status,
+            headers={name: resp[name] for name in RECORDED_HEADERS if name in resp},
+            content=sanitize_content(content.decode("utf-8", "replace")),
+            seconds=round(seconds, 6),
+        )
+        line = json.dumps(interaction)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+        metrics.inc("cassette_interactions_total", mode="record")
+
+    def close(self):
+        """
+        Closes the wrapped transport and the cassette.
+        """
+        self.transport.close()
+        with self._lock:
+            self._file.close()
+
+
+class ReplayClient:
+    """
+    Serves the requests of one connection from the interactions of a ReplayTransport.
+    """
+
+    def __init__(self, replay: "ReplayTransport"):
+        self.replay = replay
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        interaction = self.replay.next_interaction(method, uri, body)
+        if self.replay.latency:
+            time.sleep(interaction["seconds"] * self.replay.latency)
+        resp = httplib2.Response(
+            {"status": interaction["status"], **interaction["headers"]}
+        )
+        return (resp, interaction["content"].encode("utf-8"))
+
+
+class ReplayTransport:
+    """
+    Serves the requests of a GMailService from a cassette recorded by RecordingTransport,
+    without network access or credentials.
+
+    A request is answered by the next unused interaction with the same method, URI and body,
+    in recording order, so repeated requests (a message fetched twice, a profile polled
+    again) replay their successive responses. Requests are served concurrently, each one
+    after its recorded duration times `latency`.
+
+    Attributes:
+        path (str): The cassette file.
+        latency (float): The factor applied to the recorded durations, 1 to replay the
+            original timing, 0 to answer at once.
+    """
+
+    def __init__(self, path: str, latency: float = 1.0):
+        self.path = path
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.interactions: dict[tuple, deque[Interaction]] = {}
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                interaction: Interaction = json.loads(line)
+                key = (interaction["method"], interaction["uri"], interaction["body"])
+                self.interactions.setdefault(key, deque()).append(interaction)
+
+    def next_interaction(self, method: str, uri: str, body) -> Interaction:
+        """
+        Returns the next recorded interaction of a request.
+
+        Raises:
+            Exception: If the cassette has no unused interaction for the request.
+        """
+        key = request_key(method, uri, body)
+        with self._lock:
+            recorded = self.interactions.get(key)
+            if not recorded:
+                metrics.inc("cassette_misses_total")
+                raise Exception(
+                    f"No recorded response for {method} {key[1]} in {self.path}"
+                )
+            interaction = recorded.popleft()
+        metrics.inc("cassette_interactions_total", mode="replay")
+        return interaction
+
+    def remaining(self) -> int:
+        """
+        Returns the number of recorded interactions not replayed yet.
+        """
+        with self._lock:
+            return sum(len(recorded) for recorded in self.interactions.values())
+
+    @contextmanager
+    def connection(self) -> Iterator[ReplayClient]:
+        """
+        Lends a client answering from the cassette.
+        """
+        yield ReplayClient(self)
+
+    def close(self):
+        pass
@@ -1,8 +1,20 @@
 import datetime
-from sqlite3 import connect
+import email.utils
+import functools
+import re
+from concurrent.futures import ThreadPoolExecutor
+from sqlite3 import Connection, connect
 import json as json
-from typing import Generator, Iterator, TypedDict
+import operator
+import pathlib
+import time
+from collections import deque
+from typing import Generator, Iterable, Iterator, TypedDict
+from googleapiclient.errors import HttpError
+from mail_actions.gmail.mime import extract_attachments, extract_body_text
 from mail_actions.gmail.service import GMailService, Message
+from mail_actions.metrics import metrics
+from mail_actions.tracing import traced
 from progress.bar import Bar
 from progress.counter import Counter
 
@@ -12,6 +24,110 @@ from typing import TypedDict
 from mail_actions.ruleparser import RuleAction
 
 
+# the columns selected by build_sql and read by MessageRow, in order
+MESSAGE_COLUMNS = (
+    "id",
+    "threadId",
+    "historyId",
+    "internalDate",
+    "internalTimestamp",
+    "from",
+    "to",
+    "subject",
+    "labelIds",
+    "payload__body__data",
+    "payload__body__size",
+    "payload__body__attachmentId",
+    "payload__filename",
+    "payload__mimeType",
+    "payload__partId",
+    "payload__parts",
+    "raw",
+    "sizeEstimate",
+    "snippet",
+)
+
+
+class MessageRow(tuple):
+    """
+    Represents a stored message as the row tuple read from SQLite, used as the row factory of
+    get_messages_sql.
+
+    A row costs one tuple, instead of the three nested dicts and two json.loads calls of a
+    Message. The top level Message fields are attributes, and can be read like dict keys
+    (`row["id"]`, `row.get("subject")`); labelIds and payload are decoded on access.
+    to_dict() builds the full Message.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, cursor, row: tuple):
+        return tuple.__new__(cls, row)
+
+    id = property(operator.itemgetter(0))
+    threadId = property(operator.itemgetter(1))
+    historyId = property(operator.itemgetter(2))
+    internalDate = property(operator.itemgetter(3))
+    internalTimestamp = property(operator.itemgetter(4))
+    from_ = property(operator.itemgetter(5))
+    to = property(operator.itemgetter(6))
+    subject = property(operator.itemgetter(7))
+    raw = property(operator.itemgetter(16))
+    sizeEstimate = property(operator.itemgetter(17))
+    snippet = property(operator.itemgetter(18))
+
+    @property
+    def labelIds(self) -> list[str]:
+        return json.loads(self[8])
+
+    @property
+    def payload(self) -> dict:
+        return {
+            "body": {
+                "data": self[9],
+                "size": self[10],
+                "attachmentId": self[11],
+            },
+            "filename": self[12],
+            "mimeType": self[13],
+            "partId": self[14],
+            "parts": json.loads(self[15]),
+        }
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in Message.__annotations__:
+                raise KeyError(key)
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self) -> Message:
+        """
+        Returns the message as the nested Message dict.
+        """
+        return Message(
+            id=self[0],
+            threadId=self[1],
+            historyId=self[2],
+            internalDate=self[3],
+            internalTimestamp=self[4],
+            from_=self[5],
+            to=self[6],
+            subject=self[7],
+            labelIds=self.labelIds,
+            payload=self.payload,
+            raw=self[16],
+            sizeEstimate=self[17],
+            snippet=self[18],
+        )
+
+
 class MailBoxStats(TypedDict):
     """
     Represents the statistics of a mailbox.
@@ -25,26 +141,146 @@ class MailBoxStats(TypedDict):
     totalMessages: int
 
 
+# remote ids missing locally, and local ids missing remotely, see MailBox.sync
+NEW_IDS_SQL = """FROM remote_ids r
+    WHERE NOT EXISTS (SELECT 1 FROM messages m WHERE m.id = r.id)"""
+DELETED_IDS_SQL = """FROM messages m
+    WHERE NOT EXISTS (SELECT 1 FROM remote_ids r WHERE r.id = m.id)"""
+COLD_DELETED_IDS_SQL = """FROM cold.messages c
+    WHERE NOT EXISTS (SELECT 1 FROM remote_ids r WHERE r.id = c.id)"""
+
+# the tables of a message, moved together to the cold database
+COLD_TABLES = ("messages", "headers", "bodies", "attachments")
+# "cold" moves old messages to the cold database, "metadata" drops their payload, headers and
+# body text in place, keeping what rules filter on
+RETENTION_MODES = ("cold", "metadata")
+# seconds between two maintenance runs (retention and incremental vacuum), see MailBox.maintain
+MAINTENANCE_INTERVAL = 24 * 3600
+# messages fetched per backfill() call, older than the sync window
+BACKFILL_BATCH = 1000
+# a windowed sync only deletes the local messages received a day inside the window, Gmail
+# evaluates newer_than: on its own clock and date
+WINDOW_MARGIN = 24 * 3600
+
+
 class MailBox:
     """
     Represents a mailbox.
 
     Attributes:
         gmail_service (GMailService): The Gmail service to use for interacting with the mailbox.
+        db_path (str): Path of the SQLite database file backing the mailbox.
+        scan_limit (int): Maximum number of remote ids scanned per sync, 0 for no limit.
+        fetch_concurrency (int): Number of messages fetched from the API in parallel.
+        cold_db_path (str): Path of the cold database holding the messages moved out by the
+            retention policy, attached to the connection as `cold`. None to keep one database.
+        retention_days (int): Age in days after which maintain() archives messages, None to
+            keep every message hot.
+        retention_mode (str): How old messages are archived, one of RETENTION_MODES.
+        sync_window_days (int): Only sync the messages received in the last days, older ones
+            are fetched by backfill(). None to sync the whole mailbox.
+        backfill_batch (int): Maximum number of messages fetched per backfill() call.
+        read_only (bool): Open the databases read-only, for a run that must not modify them
+            (see runlock.RunLock). init_db() must not be called.
 
-    init_db() must be called before using the mailbox.
+    init_db() must be called before using the mailbox. The database connection is opened on first
+    use and kept open until close() is called.
     """
 
-    def __init__(self, gmailService: GMailService) -> None:
+    def __init__(
+        self,
+        gmailService: GMailService,
+        db_path: str = "store.db",
+        scan_limit: int = 10000,
+        fetch_concurrency: int = 1,
+        cold_db_path: str | None = None,
+        retention_days: int | None = None,
+        retention_mode: str = "cold",
+        sync_window_days: int | None = None,
+        backfill_batch: int = BACKFILL_BATCH,
+        read_only: bool = False,
+    ) -> None:
         self.gmail_service = gmailService
+        self.db_path = db_path
+        self.scan_limit = scan_limit
+        self.fetch_concurrency = fetch_concurrency
+        self.cold_db_path = cold_db_path
+        self.retention_days = retention_days
+        self.retention_mode = retention_mode
+        self.sync_window_days = sync_window_days
+        self.backfill_batch = backfill_batch
+        self.read_only = read_only
+        self._conn: Connection | None = None
+        self._cold_conn: Connection | None = None
         pass
 
+    def connection(self) -> Connection:
+        """
+        Returns the database connection, opening it on first use.
+
+        The connection is reused for the lifetime of the mailbox. Use it as a context manager
+        (`with self.connection() as conn:`) to commit, or roll back on error, at the end of the block.
+        It may be handed over to another thread, but must not be used by two threads at once.
+        """
+        if self._conn is None:
+            self._conn = connect(
+                self.database_uri(self.db_path), check_same_thread=False, uri=True
+            )
+            # backs the REGEXP operator used by the matches and nmatches rule operators
+            self._conn.create_function("REGEXP", 2, regexp, deterministic=True)
+            if self.cold_db_path is not None:
+                self._conn.execute(
+                    "ATTACH DATABASE ? AS cold", (self.database_uri(self.cold_db_path),)
+                )
+        return self._conn
+
+    def database_uri(self, path: str) -> str:
+        """
+        Returns the SQLite URI of a database file, read-only when the mailbox is.
+        """
+        uri = pathlib.Path(path).absolute().as_uri()
+        return f"{uri}?mode=ro" if self.read_only else uri
+
+    def cold_connection(self) -> Connection:
+        """
+        Returns a connection to the cold database alone, opening it on first use.
+
+        Its tables have the names of the hot ones, so a rule query runs on it unchanged.
+        """
+        if self.cold_db_path is None:
+            raise Exception("No cold database configured")
+        if self._cold_conn is None:
+            self._cold_conn = connect(
+                self.database_uri(self.cold_db_path), check_same_thread=False, uri=True
+            )
+            self._cold_conn.create_function("REGEXP", 2, regexp, deterministic=True)
+        return self._cold_conn
+
+    def schemas(self) -> list[str]:
+        """
+        Returns the schemas holding messages: main, and cold when a cold database is configured.
+        """
+        return ["main"] if self.cold_db_path is None else ["main", "cold"]
+
+    def close(self):
+        """
+        Closes the database connections.
+        """
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._cold_conn is not None:
+            self._cold_conn.close()
+            self._cold_conn = None
+
     def init_db(self):
         """
         Initializes the database by creating the necessary tables if they don't exist.
         """
-        with connect("store.db") as conn:
+        with self.connection() as conn:
             cursor = conn.cursor()
+            # only applies to a new database, maintain() converts older ones
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
             cursor.execute(
                 """
                 CREATE TABLE IF NOT EXISTS messages (
@@ -66,10 +302,23 @@ class MailBox:
                     subject TEXT,
                     raw TEXT,
                     sizeEstimate INTEGER,
-                    snippet TEXT
+                    snippet TEXT,
+                    receivedAt INTEGER,
+                    sentAt INTEGER
                 )
                 """
             )
+            self._migrate_date_columns(cursor)
+            cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_messages_receivedAt ON messages (receivedAt)
+                """
+            )
+            cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_messages_sentAt ON messages (sentAt)
+                """
+            )
             cursor.execute(
                 """
                 CREATE TABLE IF NOT EXISTS headers (
@@ -86,58 +335,531 @@ class MailBox:
                 CREATE INDEX IF NOT EXISTS idx_headers_message_id ON headers (message_id)
                 """
             )
+            cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_messages_threadId ON messages (threadId)
+                """
+            )
+            new_threads_table = not cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'threads'"
+            ).fetchone()
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS threads (
+                    id TEXT PRIMARY KEY,
+                    historyId TEXT,
+                    messageCount INTEGER,
+                    lastReceivedAt INTEGER
+                )
+                """
+            )
+            if new_threads_table:
+                # databases created before the threads table existed
+                cursor.execute(
+                    """
+                    INSERT INTO threads (id, historyId, messageCount, lastReceivedAt)
+                    SELECT threadId, MAX(CAST(historyId AS INTEGER)), COUNT(*), MAX(receivedAt)
+                    FROM messages GROUP BY threadId
+                    """
+                )
+            new_bodies_table = not cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bodies'"
+            ).fetchone()
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS bodies (
+                    message_id TEXT PRIMARY KEY,
+                    text TEXT
+                )
+                """
+            )
+            if new_bodies_table:
+                self._backfill_bodies(cursor)
+            new_attachments_table = not cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'attachments'"
+            ).fetchone()
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS attachments (
+                    id INTEGER PRIMARY KEY,
+                    message_id TEXT,
+                    filename TEXT,
+                    mimeType TEXT,
+                    size INTEGER
+                )
+                """
+            )
+            cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_attachments_message_id ON attachments (message_id)
+                """
+            )
+            cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_messages_sizeEstimate ON messages (sizeEstimate)
+                """
+            )
+            # exact sender rules, and their UNION rewrite, see optimizer.Optimizer
+            cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_messages_from ON messages ("from")
+                """
+            )
+            if new_attachments_table:
+                self._backfill_attachments(cursor)
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY,
+                    kind TEXT,
+                    target_id TEXT,
+                    addLabelIds TEXT,
+                    removeLabelIds TEXT,
+                    status TEXT DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at REAL DEFAULT 0,
+                    created_at REAL,
+                    error TEXT
+                )
+                """
+            )
+            cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, next_attempt_at)
+                """
+            )
+            cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_outbox_target_id ON outbox (target_id)
+                """
+            )
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    name TEXT PRIMARY KEY,
+                    value TEXT
+                )
+                """
+            )
+            if self.cold_db_path is not None:
+                self._init_cold_db(cursor)
             conn.commit()
         pass
 
+    def _init_cold_db(self, cursor):
+        """
+        Creates the message tables and their indexes in the cold database, from the definitions
+        of the hot ones.
+        """
+        cursor.execute("PRAGMA cold.auto_vacuum = INCREMENTAL")
+        definitions = cursor.execute(
+            f"""
+            SELECT sql FROM main.sqlite_master
+            WHERE tbl_name IN ({", ".join("?" for _ in COLD_TABLES)}) AND sql IS NOT NULL
+            ORDER BY type DESC
+            """,
+            COLD_TABLES,
+        ).fetchall()
+        for (sql,) in definitions:
+            cursor.execute(
+                re.sub(r"^CREATE (TABLE|INDEX) ", r"CREATE \1 IF NOT EXISTS cold.", sql)
+            )
+
+    def _migrate_date_columns(self, cursor):
+        """
+        Adds the receivedAt and sentAt epoch columns to a database created before they existed
+        and fills them from the stored timestamps and Date headers.
+        """
+        columns = [row[1] for row in cursor.execute("PRAGMA table_info(messages)")]
+        if "receivedAt" in columns and "sentAt" in columns:
+            return
+        for column in ("receivedAt", "sentAt"):
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE messages ADD COLUMN {column} INTEGER")
+        cursor.execute(
+            "UPDATE messages SET receivedAt = CAST(internalTimestamp AS INTEGER) / 1000"
+        )
+        rows = cursor.execute(
+            "SELECT message_id, value FROM headers WHERE name = 'Date'"
+        ).fetchall()
+        cursor.executemany(
+            "UPDATE messages SET sentAt = ? WHERE id = ?",
+            [(parse_date_header(value), message_id) for message_id, value in rows],
+        )
+
+    def _backfill_bodies(self, cursor):
+        """
+        Extracts the body text of messages stored before the bodies table existed.
+        """
+        rows = cursor.execute(
+            "SELECT id, payload__mimeType, payload__body__data, payload__parts FROM messages"
+        ).fetchall()
+        cursor.executemany(
+            "INSERT INTO bodies (message_id, text) VALUES (?, ?)",
+            (
+                (
+                    id,
+                    extract_body_text(
+                        {
+                            "mimeType": mimeType,
+                            "body": {"data": data},
+                            "parts": json.loads(parts) if parts else None,
+                        }
+                    ),
+                )
+                for (id, mimeType, data, parts) in rows
+            ),
+        )
+
+    def _backfill_attachments(self, cursor):
+        """
+        Extracts the attachments of messages stored before the attachments table existed.
+        """
+        rows = cursor.execute(
+            """
+            SELECT id, payload__filename, payload__mimeType, payload__body__size, payload__parts
+            FROM messages
+            """
+        ).fetchall()
+        cursor.executemany(
+            """
+            INSERT INTO attachments (message_id, filename, mimeType, size)
+            VALUES (?, ?, ?, ?)
+            """,
+            (
+                (id, attachment["filename"], attachment["mimeType"], attachment["size"])
+                for (id, filename, mimeType, size, parts) in rows
+                for attachment in extract_attachments(
+                    {
+                        "filename": filename,
+                        "mimeType": mimeType,
+                        "body": {"size": size},
+                        "parts": json.loads(parts) if parts else None,
+                    }
+                )
+            ),
+        )
+
     def get_stats(self) -> MailBoxStats:
         """
         Retrieves the statistics of the mailbox.
 
         Returns:
-            A MailBoxStats object containing the last history ID and the total number of messages.
+            A MailBoxStats object containing the last history ID and the total number of messages,
+            hot and cold.
         """
-        with connect("store.db") as conn:
+        conn = self.connection()
+        with metrics.timer("db_operation_seconds", op="get_stats"), conn:
             cursor = conn.cursor()
             cursor.execute("SELECT MAX(historyId) FROM messages")
             lastHistoryId = cursor.fetchone()[0]
-            cursor.execute("SELECT COUNT(*) FROM messages")
-            totalMessages = cursor.fetchone()[0]
+            totalMessages = 0
+            for schema in self.schemas():
+                cursor.execute(f"SELECT COUNT(*) FROM {schema}.messages")
+                totalMessages += cursor.fetchone()[0]
         return MailBoxStats(lastHistoryId=lastHistoryId, totalMessages=totalMessages)
 
+    def get_state(self, name: str) -> str | None:
+        """
+        Retrieves a sync state value, e.g. the "historyId" the mailbox was last synced to.
+
+        Returns:
+            str | None: The stored value, or None if it was never set.
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT value FROM sync_state WHERE name=?", (name,))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def set_state(self, name: str, value: str):
+        """
+        Stores a sync state value.
+        """
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)",
+                (name, value),
+            )
+
+    def sync_history(self, startHistoryId: str) -> set[str] | None:
+        """
+        Incrementally synchronizes the mailbox with the changes made after startHistoryId.
+        Added messages and messages with label changes are (re)fetched, deleted messages are removed.
+        The new history ID is stored as the "historyId" sync state.
+
+        Args:
+            startHistoryId (str): The history ID the mailbox was last synced to.
+
+        Returns:
+            set[str] | None: The IDs of the added or changed messages, or None if startHistoryId is
+            too old and a full sync is needed.
+        """
+        changed = set()
+        deleted = set()
+        pageToken = None
+        while True:
+            resp = self.gmail_service.get_history(startHistoryId, pageToken=pageToken)
+            if resp is None:
+                return None
+            for record in resp.get("history", []):
+                for key in ("messagesAdded", "labelsAdded", "labelsRemoved"):
+                    for change in record.get(key, []):
+                        changed.add(change["message"]["id"])
+                        deleted.discard(change["message"]["id"])
+                for change in record.get("messagesDeleted", []):
+                    deleted.add(change["message"]["id"])
+                    changed.discard(change["message"]["id"])
+            pageToken = resp.get("nextPageToken", None)
+            if not pageToken:
+                break
+        if len(changed) > 0:
+            changed -= self.refresh_messages(changed)
+        if len(deleted) > 0:
+            self.delete_messages(deleted)
+        self.set_state("historyId", resp["historyId"])
+        self.set_state("lastSyncAt", str(time.time()))
+        return changed
+
+    def refresh_messages(self, ids: set[str]) -> set[str]:
+        """
+        Fetches the latest version of the given messages and replaces the stored copies.
+
+        Args:
+            ids (set[str]): The IDs of the messages to refresh.
+
+        Returns:
+            set[str]: The IDs of messages that no longer exist remotely, they are removed locally.
+        """
+        missing = set()
+        for id in ids:
+            try:
+                msg = self.gmail_service.get_message(id)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                missing.add(id)
+                self.delete_message(id)
+                continue
+            self.delete_message(id)
+            self.save_message(msg)
+        return missing
+
     def sync(self):
         """
         Synchronizes the mailbox by comparing the remote and local message IDs.
         Fetches new messages and deletes messages that are no longer present remotely.
 
+        The remote IDs are streamed into a temporary table page by page and diffed against the
+        messages table with indexed anti-joins, the new and deleted IDs are then streamed in
+        batches, so memory use does not grow with the size of the mailbox. New messages are
+        fetched newest first, in the order Gmail lists them.
+
+        With sync_window_days, only the messages received in the window are listed, and only
+        local messages inside the window are deleted. The older messages are left to backfill(),
+        the first windowed sync stores the receivedAt of the oldest listed message as its cursor.
+        When scan_limit cuts the listing short, only the local messages received after the
+        oldest listed one are deleted, older ones were not listed and may still exist.
+
         This is a not a perfect implementation.
         Ideally, we need a full sync on the first time and then incremental syncs based on historyId.
 
         Returns:
             None
         """
-        remoteIds = self.scan_remote()
-        dbIds = self.scan_db()
-        newMsgs = remoteIds - dbIds
-        deletedMsgs = dbIds - remoteIds
-        if len(newMsgs) > 0:
-            self.fetch_messages(newMsgs)
-        if len(deletedMsgs) > 0:
-            self.delete_messages(deletedMsgs)
+        q = None
+        deleted_sql = DELETED_IDS_SQL
+        if self.sync_window_days is not None:
+            q = f"newer_than:{self.sync_window_days}d"
+            since = int(time.time()) - self.sync_window_days * 24 * 3600 + WINDOW_MARGIN
+            deleted_sql = f"{DELETED_IDS_SQL} AND m.receivedAt >= {since}"
+        with metrics.phase("sync.scan_remote"):
+            (_, complete) = self.scan_remote_to_db(q)
+        conn = self.connection()
+        if self.cold_db_path is not None:
+            with metrics.phase("sync.cold"):
+                # cold messages are older than any window worth syncing
+                self.sync_cold(delete=q is None and complete)
+        with metrics.phase("sync.diff"):
+            (newCount,) = conn.execute(f"SELECT COUNT(*) {NEW_IDS_SQL}").fetchone()
+        if newCount > 0:
+            with metrics.phase("sync.fetch"):
+                self.fetch_messages(
+                    self.iter_ids(
+                        "r.id", NEW_IDS_SQL, op="sync_new_ids", key="r.position"
+                    ),
+                    newCount,
+                )
+        if not complete:
+            # the listed messages are all stored now, the oldest of them bounds the listing
+            metrics.inc("sync_truncated_total")
+            (oldest,) = conn.execute(
+                "SELECT MIN(m.receivedAt) FROM messages m JOIN remote_ids r ON r.id = m.id"
+            ).fetchone()
+            deleted_sql = f"{deleted_sql} AND m.receivedAt >= {int(oldest or 2**62)}"
+        if q is not None and self.get_state("backfillBefore") is None:
+            # the backfill resumes from the stored mail, not the clock, so its requests are the
+            # same when a recorded run is replayed
+            (oldest,) = conn.execute(
+                "SELECT MIN(m.receivedAt) FROM messages m JOIN remote_ids r ON r.id = m.id"
+            ).fetchone()
+            if oldest is not None:
+                self.set_state("backfillBefore", str(oldest))
+        with metrics.phase("sync.diff"):
+            (deletedCount,) = conn.execute(f"SELECT COUNT(*) {deleted_sql}").fetchone()
+        if deletedCount > 0:
+            with metrics.phase("sync.delete"):
+                self.delete_messages(
+                    self.iter_ids("m.id", deleted_sql, op="sync_deleted_ids"),
+                    deletedCount,
+                )
+        conn.execute("DROP TABLE IF EXISTS temp.remote_ids")
+        self.set_state("lastSyncAt", str(time.time()))
         print("Sync Completed")
         pass
 
-    def delete_messages(self, ids: set[str]):
+    def sync_cold(self, delete: bool = True):
+        """
+        Deletes the cold messages no longer present remotely, then leaves the other cold messages
+        out of the remote IDs, so the diff with the hot messages does not fetch them again.
+
+        Args:
+            delete (bool, optional): Delete the cold messages missing from the remote IDs, False
+                when only a window of the mailbox was scanned.
+        """
+        conn = self.connection()
+        (deletedCount,) = conn.execute(
+            f"SELECT COUNT(*) {COLD_DELETED_IDS_SQL}"
+        ).fetchone()
+        if delete and deletedCount > 0:
+            self.delete_messages(
+                self.iter_ids("c.id", COLD_DELETED_IDS_SQL, op="sync_cold_deleted_ids"),
+                deletedCount,
+            )
+        with conn:
+            conn.execute(
+                "DELETE FROM remote_ids WHERE id IN (SELECT id FROM cold.messages)"
+            )
+
+    def backfill_pending(self) -> bool:
+        """
+        Checks if the mailbox syncs a window and the messages older than it are not all fetched.
+        """
+        return (
+            self.sync_window_days is not None
+            and self.get_state("backfillCompleteAt") is None
+        )
+
+    def backfill(self, limit: int | None = None) -> list[str]:
+        """
+        Fetches the missing messages older than the sync window, newest first, a batch at a time.
+
+        The receivedAt of the oldest message listed so far is stored as the "backfillBefore" sync
+        state, the next call resumes with a `before:` search from there. The first windowed
+        sync seeds it, without a cursor (an empty window) the whole mailbox is listed. Once the
+        listing is exhausted the "backfillCompleteAt" state is set and backfill_pending() is
+        False.
+
+        Args:
+            limit (int, optional): Stop listing once this many messages were fetched. Defaults to
+                backfill_batch.
+
+        Returns:
+            list[str]: The IDs of the fetched messages.
+        """
+        if not self.backfill_pending():
+            return []
+        limit = self.backfill_batch if limit is None else limit
+        before = self.get_state("backfillBefore")
+        # before: is exclusive, the messages of the cursor second already stored are skipped
+        q = None if before is None else f"before:{int(before) + 1}"
+        fetched = []
+        pageToken = None
+        while len(fetched) < limit:
+            resp = self.gmail_service.get_message_list(
+                pageToken=pageToken, maxResults=500, q=q
+            )
+            ids = [msg["id"] for msg in resp.get("messages", [])]
+            missing = self.missing_ids(ids)
+            if missing:
+                self.fetch_messages(missing)
+                fetched.extend(missing)
+            oldest = self._oldest_received(ids)
+            if oldest is not None:
+                self.set_state("backfillBefore", str(oldest))
+            pageToken = resp.get("nextPageToken", None)
+            if not pageToken:
+                self.set_state("backfillCompleteAt", str(time.time()))
+                print("Backfill Completed")
+                break
+        metrics.inc("backfill_messages_total", len(fetched))
+        return fetched
+
+    def _oldest_received(self, ids: list[str]) -> int | None:
+        conn = self.connection()
+        oldest = None
+        for schema in self.schemas():
+            (received,) = conn.execute(
+                f"SELECT MIN(receivedAt) FROM {schema}.messages "
+                "WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(ids),),
+            ).fetchone()
+            if received is not None and (oldest is None or received < oldest):
+                oldest = received
+        return oldest
+
+    def iter_ids(
+        self,
+        column: str,
+        from_sql: str,
+        op: str,
+        batch_size: int = 1000,
+        key: str | None = None,
+    ) -> Iterator[str]:
+        """
+        Streams the IDs selected by `SELECT column from_sql` in batches of batch_size, in key
+        order. Batches are read with keyset pagination, so rows can be written between batches.
+
+        Args:
+            column (str): The ID column to select.
+            from_sql (str): The FROM and WHERE clauses of the query.
+            op (str): The operation name used in the metrics.
+            batch_size (int, optional): The number of IDs read per query.
+            key (str, optional): The unique column to order by. Defaults to the ID column.
+
+        Yields:
+            str: The selected IDs.
+        """
+        key = key or column
+        conn = self.connection()
+        last = None
+        while True:
+            keyset = "" if last is None else f" AND {key} > ?"
+            with metrics.timer("db_operation_seconds", op=op):
+                rows = conn.execute(
+                    f"SELECT {column}, {key} {from_sql}{keyset} ORDER BY {key} LIMIT ?",
+                    ([] if last is None else [last]) + [batch_size],
+                ).fetchall()
+            metrics.inc("db_rows_scanned_total", len(rows), op=op)
+            for id, _ in rows:
+                yield id
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][1]
+
+    def delete_messages(self, ids: Iterable[str], total: int | None = None):
         """
         Deletes the specified messages from the mailbox.
 
         Args:
-            ids (set[str]): The set of message IDs to delete.
+            ids (Iterable[str]): The message IDs to delete.
+            total (int, optional): The number of IDs, required when ids has no len().
 
         Returns:
             int: The number of messages deleted.
         """
         deleted = 0
-        progress = Bar("Deleting messages", max=len(ids))
+        progress = Bar("Deleting messages", max=len(ids) if total is None else total)
         for id in ids:
             self.delete_message(id)
             deleted = deleted + 1
@@ -146,32 +868,231 @@ class MailBox:
         return deleted
 
     def delete_message(self, id: str):
-        with connect("store.db") as conn:
+        conn = self.connection()
+        with metrics.timer("db_operation_seconds", op="delete_message"), conn:
             cursor = conn.cursor()
+            row = cursor.execute(
+                "SELECT threadId FROM messages WHERE id=?", (id,)
+            ).fetchone()
             cursor.execute("DELETE FROM messages WHERE id=?", (id,))
+            deleted = cursor.rowcount
             cursor.execute("DELETE FROM headers WHERE message_id=?", (id,))
+            deleted += cursor.rowcount
+            cursor.execute("DELETE FROM bodies WHERE message_id=?", (id,))
+            deleted += cursor.rowcount
+            cursor.execute("DELETE FROM attachments WHERE message_id=?", (id,))
+            deleted += cursor.rowcount
+            if self.cold_db_path is not None:
+                for table in COLD_TABLES:
+                    column = "id" if table == "messages" else "message_id"
+                    cursor.execute(f"DELETE FROM cold.{table} WHERE {column}=?", (id,))
+                    deleted += cursor.rowcount
+            if row is not None:
+                update_thread(cursor, row[0])
             conn.commit()
+        metrics.inc("db_rows_deleted_total", deleted, op="delete_message")
+
+    def archive_messages(self, before: int, mode: str = "cold") -> int:
+        """
+        Takes the messages received before a time out of the working set.
+
+        In "cold" mode the messages, with their headers, body text and attachments, move to the
+        cold database, in one transaction. Rules then only query them with `partition: all`.
+        In "metadata" mode they stay in place without their payload, headers and body text, the
+        columns rules filter on (addresses, subject, dates, size, labels and attachments) are kept.
+
+        The threads table summarizes the hot messages only.
+
+        Args:
+            before (int): Epoch seconds, messages received earlier are archived.
+            mode (str, optional): One of RETENTION_MODES. Defaults to "cold".
+
+        Returns:
+            int: The number of messages archived.
+
+        Raises:
+            Exception: If the mode is invalid, or is "cold" without a cold database.
+        """
+        if mode not in RETENTION_MODES:
+            raise Exception(f"Invalid retention mode: {mode}")
+        if mode == "cold" and self.cold_db_path is None:
+            raise Exception("No cold database configured")
+        conn = self.connection()
+        with metrics.timer("db_operation_seconds", op="archive_messages"), conn:
+            cursor = conn.cursor()
+            cursor.execute("DROP TABLE IF EXISTS temp.archived")
+            cursor.execute(
+                "CREATE TEMP TABLE archived (id TEXT PRIMARY KEY, threadId TEXT)"
+            )
+            if mode == "metadata":
+                # messages reduced by an earlier run have no payload left
+                cursor.execute(
+                    """
+                    INSERT INTO temp.archived SELECT id, threadId FROM main.messages
+                    WHERE receivedAt < ? AND (
+                        payload__parts != 'null' OR payload__body__data IS NOT NULL
+                        OR raw IS NOT NULL
+                        OR EXISTS (SELECT 1 FROM main.headers WHERE message_id = messages.id)
+                    )
+                    """,
+                    (before,),
+                )
+            else:
+                cursor.execute(
+                    """
+                    INSERT INTO temp.archived
+                    SELECT id, threadId FROM main.messages WHERE receivedAt < ?
+                    """,
+                    (before,),
+                )
+            archived = cursor.rowcount
+            if mode == "metadata":
+                cursor.execute(
+                    """
+                    UPDATE main.messages
+                    SET payload__body__data = NULL, payload__parts = 'null', raw = NULL
+                    WHERE id IN (SELECT id FROM temp.archived)
+                    """
+                )
+                for table in ("headers", "bodies"):
+                    cursor.execute(
+                        f"DELETE FROM main.{table} "
+                        "WHERE message_id IN (SELECT id FROM temp.archived)"
+                    )
+            else:
+                for table in COLD_TABLES:
+                    column = "id" if table == "messages" else "message_id"
+                    # integer row IDs are left to the cold table, they are reused in the hot one
+                    columns = ", ".join(
+                        f'"{name}"'
+                        for (_, name, type, _, _, pk) in cursor.execute(
+                            f"PRAGMA main.table_info({table})"
+                        ).fetchall()
+                        if not (pk and type.upper() == "INTEGER")
+                    )
+                    cursor.execute(
+                        f"""
+                        INSERT OR REPLACE INTO cold.{table} ({columns})
+                        SELECT {columns} FROM main.{table}
+                        WHERE {column} IN (SELECT id FROM temp.archived)
+                        """
+                    )
+                    cursor.execute(
+                        f"DELETE FROM main.{table} "
+                        f"WHERE {column} IN (SELECT id FROM temp.archived)"
+                    )
+                threadIds = cursor.execute(
+                    "SELECT DISTINCT threadId FROM temp.archived"
+                ).fetchall()
+                for (threadId,) in threadIds:
+                    update_thread(cursor, threadId)
+            cursor.execute("DROP TABLE temp.archived")
+        metrics.inc("messages_archived_total", archived, mode=mode)
+        return archived
+
+    def vacuum(self, pages: int | None = None):
+        """
+        Returns free pages of the hot and cold databases to the file system.
+
+        Databases are created with incremental auto vacuum, which frees pages without rewriting
+        the file. A database created before that is converted with one full VACUUM.
+
+        Args:
+            pages (int, optional): The maximum number of pages freed per database, all if None.
+        """
+        conn = self.connection()
+        conn.commit()
+        with metrics.timer("db_operation_seconds", op="vacuum"):
+            for schema in self.schemas():
+                (mode,) = conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()
+                if mode != 2:
+                    conn.execute(f"PRAGMA {schema}.auto_vacuum = INCREMENTAL")
+                    conn.execute(f"VACUUM {schema}")
+                    continue
+                # the pragma frees one page per step, fetchall runs it to completion
+                conn.execute(
+                    f"PRAGMA {schema}.incremental_vacuum({pages or 0})"
+                ).fetchall()
+
+    def analyze(self):
+        """
+        Refreshes the index statistics (sqlite_stat1) used by the SQLite query planner and the
+        rule optimizer. The sample per index is bounded, so it stays fast on large mailboxes.
+        """
+        conn = self.connection()
+        with metrics.timer("db_operation_seconds", op="analyze"), conn:
+            conn.execute("PRAGMA analysis_limit = 1000")
+            conn.execute("ANALYZE main")
+
+    def maintain(self, now: float | None = None, force: bool = False) -> bool:
+        """
+        Applies the retention policy, vacuums the databases and refreshes the index statistics,
+        at most once per
+        MAINTENANCE_INTERVAL. Called after every run, and every poll in watch mode.
+
+        Args:
+            now (float, optional): The current epoch time, for tests.
+            force (bool, optional): Run even if the last run is recent.
+
+        Returns:
+            bool: Whether maintenance ran.
+        """
+        now = time.time() if now is None else now
+        last = self.get_state("lastMaintenanceAt")
+        if not force and last is not None and now - float(last) < MAINTENANCE_INTERVAL:
+            return False
+        if self.retention_days is not None:
+            self.archive_messages(
+                int(now) - self.retention_days * 24 * 3600, self.retention_mode
+            )
+        self.vacuum()
+        self.analyze()
+        self.set_state("lastMaintenanceAt", str(now))
+        return True
 
-    def fetch_messages(self, ids: set[str]):
+    def fetch_messages(self, ids: Iterable[str], total: int | None = None):
         """
         Fetches messages from the mailbox using the provided message IDs.
 
+        With fetch_concurrency > 1 the API calls run in a thread pool, while the messages are
+        saved from the calling thread, the database connection is not shared between threads.
+
         Args:
-            ids (set[str]): A set of message IDs to fetch.
+            ids (Iterable[str]): The message IDs to fetch.
+            total (int, optional): The number of IDs, required when ids has no len().
 
         Returns:
             int: The number of messages successfully fetched and saved.
         """
         saved = 0
-        bar = Bar("Fetching messages", max=len(ids))
-        for id in ids:
-            msg = self.gmail_service.get_message(id)
+        bar = Bar("Fetching messages", max=len(ids) if total is None else total)
+        if self.fetch_concurrency > 1:
+            messages = self._fetch_concurrently(ids)
+        else:
+            messages = (self.gmail_service.get_message(id) for id in ids)
+        for msg in messages:
             self.save_message(msg)
             bar.next()
             saved = saved + 1
         bar.finish()
         return saved
 
+    def _fetch_concurrently(self, ids: Iterable[str]) -> Iterator[Message]:
+        """
+        Fetches the messages with fetch_concurrency threads, yielding them as they complete.
+        At most 2 * fetch_concurrency requests are queued, so memory doesn't grow with len(ids).
+        """
+        window = self.fetch_concurrency * 2
+        with ThreadPoolExecutor(max_workers=self.fetch_concurrency) as pool:
+            pending = deque()
+            for id in ids:
+                pending.append(pool.submit(self.gmail_service.get_message, id))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    @traced("mailbox.save_message")
     def save_message(self, msg: Message):
         """
         Saves the provided message to the database.
@@ -182,9 +1103,41 @@ class MailBox:
         Returns:
             None
         """
+        conn = self.connection()
+        with metrics.timer("db_operation_seconds", op="save_message"), conn:
+            rows = self._insert_message(conn.cursor(), msg)
+        metrics.inc("db_rows_written_total", rows, op="save_message")
+        return
+
+    def save_messages(self, msgs: Iterable[Message]) -> int:
+        """
+        Saves the provided messages to the database in one transaction, for bulk loads.
+
+        Args:
+            msgs (Iterable[Message]): The messages to be saved, none of them stored yet.
+
+        Returns:
+            int: The number of messages saved.
+        """
+        saved = 0
+        rows = 0
+        conn = self.connection()
+        with metrics.timer("db_operation_seconds", op="save_messages"), conn:
+            cursor = conn.cursor()
+            for msg in msgs:
+                rows += self._insert_message(cursor, msg)
+                saved += 1
+        metrics.inc("db_rows_written_total", rows, op="save_messages")
+        return saved
+
+    def _insert_message(self, cursor, msg: Message) -> int:
+        """
+        Inserts a message with its headers, body text and attachments, returns the rows written.
+        """
         fromVal = None
         toVal = None
         subjectVal = None
+        sentAt = None
         for header in msg["payload"]["headers"]:
             if header["name"] == "From":
                 # email address is in the format "Name <email>"
@@ -193,105 +1146,183 @@ class MailBox:
                 toVal = parse_email_address(header["value"])
             elif header["name"] == "Subject":
                 subjectVal = header["value"]
+            elif header["name"] == "Date":
+                sentAt = parse_date_header(header["value"])
+        # the MIME tree is walked and decoded once here, rules then query the text directly
+        bodyText = extract_body_text(msg["payload"])
+        attachments = extract_attachments(msg["payload"])
         timestamp = int(msg["internalDate"]) / 1000
         # Date string of format "YYYY-MM-DD hh:mm:ss"
         internalDate = datetime.datetime.fromtimestamp(
             timestamp, datetime.UTC
         ).strftime("%Y-%m-%d %H:%M:%S")
 
-        with connect("store.db") as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                INSERT INTO messages (
-                    id,
-                    threadId,
-                    historyId,
-                    internalDate,
-                    internalTimestamp,
-                    labelIds,
-                    payload__body__data,
-                    payload__body__size,
-                    payload__body__attachmentId,
-                    payload__filename,
-                    payload__mimeType,
-                    payload__partId,
-                    payload__parts,
-                    "from",
-                    "to",
-                    subject,
-                    raw,
-                    sizeEstimate,
-                    snippet
-                )
-                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-                """,
-                (
-                    msg["id"],
-                    msg["threadId"],
-                    msg["historyId"],
-                    internalDate,
-                    msg["internalDate"],
-                    json.dumps(msg["labelIds"]),
-                    msg["payload"]["body"].get("data", None),
-                    msg["payload"]["body"].get("size", None),
-                    msg["payload"]["body"].get("attachmentId", None),
-                    msg["payload"]["filename"],
-                    msg["payload"]["mimeType"],
-                    msg["payload"]["partId"],
-                    json.dumps(msg["payload"].get("parts", None)),
-                    fromVal,
-                    toVal,
-                    subjectVal,
-                    msg.get("raw", None),
-                    msg["sizeEstimate"],
-                    msg["snippet"],
-                ),
+        cursor.execute(
+            """
+            INSERT INTO messages (
+                id,
+                threadId,
+                historyId,
+                internalDate,
+                internalTimestamp,
+                labelIds,
+                payload__body__data,
+                payload__body__size,
+                payload__body__attachmentId,
+                payload__filename,
+                payload__mimeType,
+                payload__partId,
+                payload__parts,
+                "from",
+                "to",
+                subject,
+                raw,
+                sizeEstimate,
+                snippet,
+                receivedAt,
+                sentAt
             )
-            cursor.executemany(
-                """
-                INSERT INTO headers (
-                    message_id,
-                    name,
-                    value
-                )
-                VALUES (?,?,?)
-                """,
-                [
-                    (msg["id"], header["name"], header["value"])
-                    for header in msg["payload"]["headers"]
-                ],
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+            """,
+            (
+                msg["id"],
+                msg["threadId"],
+                msg["historyId"],
+                internalDate,
+                msg["internalDate"],
+                json.dumps(msg["labelIds"]),
+                msg["payload"]["body"].get("data", None),
+                msg["payload"]["body"].get("size", None),
+                msg["payload"]["body"].get("attachmentId", None),
+                msg["payload"]["filename"],
+                msg["payload"]["mimeType"],
+                msg["payload"]["partId"],
+                json.dumps(msg["payload"].get("parts", None)),
+                fromVal,
+                toVal,
+                subjectVal,
+                msg.get("raw", None),
+                msg["sizeEstimate"],
+                msg["snippet"],
+                int(msg["internalDate"]) // 1000,
+                sentAt,
+            ),
+        )
+        cursor.executemany(
+            """
+            INSERT INTO headers (
+                message_id,
+                name,
+                value
             )
-        return
+            VALUES (?,?,?)
+            """,
+            [
+                (msg["id"], header["name"], header["value"])
+                for header in msg["payload"]["headers"]
+            ],
+        )
+        cursor.execute(
+            "INSERT OR REPLACE INTO bodies (message_id, text) VALUES (?, ?)",
+            (msg["id"], bodyText),
+        )
+        cursor.executemany(
+            """
+            INSERT INTO attachments (
+                message_id,
+                filename,
+                mimeType,
+                size
+            )
+            VALUES (?,?,?,?)
+            """,
+            [(msg["id"], a["filename"], a["mimeType"], a["size"]) for a in attachments],
+        )
+        update_thread(cursor, msg["threadId"])
+        return 2 + len(msg["payload"]["headers"]) + len(attachments)
 
-    def scan_remote(self) -> set[str]:
+    def scan_remote_to_db(self, q: str | None = None) -> tuple[int, bool]:
         """
-        Scans the remote mailbox and retrieves a set of message IDs.
+        Scans the remote mailbox into the temporary remote_ids table, one page at a time.
+
+        The position column keeps the listing order, newest first.
+
+        Args:
+            q (str, optional): Only scan the messages matching this Gmail search query.
 
         Returns:
-            A set of message IDs (strings) representing the messages in the remote mailbox.
+            tuple[int, bool]: The number of remote message IDs scanned, and False if scan_limit
+                stopped the scan before the end of the listing.
         """
-        limit = 10000
-        allIds = set()
+        limit = self.scan_limit
+        conn = self.connection()
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS temp.remote_ids")
+            conn.execute(
+                "CREATE TEMP TABLE remote_ids (id TEXT PRIMARY KEY, position INTEGER UNIQUE)"
+            )
+        scanned = 0
         pageToken = None
         counter = Counter("Scanning Gmail Messages: ")
         while True:
             resp = self.gmail_service.get_message_list(
-                pageToken=pageToken, maxResults=500
+                pageToken=pageToken, maxResults=500, q=q
             )
-            msgs = resp["messages"]
-            for msg in msgs:
-                allIds.add(msg["id"])
+            msgs = resp.get("messages", [])
+            with metrics.timer("db_operation_seconds", op="scan_remote_to_db"), conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO remote_ids (id, position) VALUES (?, ?)",
+                    [(msg["id"], scanned + i) for (i, msg) in enumerate(msgs)],
+                )
+            scanned += len(msgs)
             counter.next(len(msgs))
-            if not resp.get("nextPageToken", None) or (
-                limit != 0 and len(allIds) >= limit
-            ):
+            if not resp.get("nextPageToken", None) or (limit != 0 and scanned >= limit):
                 break
             else:
                 pageToken = resp.get("nextPageToken", None)
         counter.writeln("Scanning Complete")
         counter.finish()
-        return allIds
+        return scanned, not resp.get("nextPageToken", None)
+
+    def scan_query(self, q: str) -> list[str]:
+        """
+        Lists the IDs of the remote messages matching a Gmail search query.
+
+        Args:
+            q (str): The Gmail search query, see planner.build_query.
+
+        Returns:
+            list[str]: The IDs of the matching messages, newest first.
+        """
+        ids = []
+        pageToken = None
+        while True:
+            resp = self.gmail_service.get_message_list(
+                pageToken=pageToken, maxResults=500, q=q
+            )
+            ids.extend(msg["id"] for msg in resp.get("messages", []))
+            pageToken = resp.get("nextPageToken", None)
+            if not pageToken:
+                return ids
+
+    def missing_ids(self, ids: Iterable[str]) -> list[str]:
+        """
+        Returns the IDs, of the given ones, of messages not stored in the hot or cold database.
+        """
+        ids = list(ids)
+        conn = self.connection()
+        stored = set()
+        with metrics.timer("db_operation_seconds", op="missing_ids"):
+            for schema in self.schemas():
+                stored.update(
+                    row[0]
+                    for row in conn.execute(
+                        f"SELECT id FROM {schema}.messages "
+                        "WHERE id IN (SELECT value FROM json_each(?))",
+                        (json.dumps(ids),),
+                    )
+                )
+        return [id for id in ids if id not in stored]
 
     def scan_db(self) -> set[str]:
         """
@@ -301,92 +1332,279 @@ class MailBox:
             set[str]: A set of all message IDs in the database.
         """
         allIds = set()
-        with connect("store.db") as conn:
+        conn = self.connection()
+        with metrics.timer("db_operation_seconds", op="scan_db"), conn:
             cursor = conn.cursor()
             cursor.execute("SELECT id FROM messages")
             rows = cursor.fetchall()
             for row in rows:
                 allIds.add(row[0])
+        metrics.inc("db_rows_scanned_total", len(allIds), op="scan_db")
         return allIds
 
-    def get_messages_sql(self, sql: str, args: dict) -> Iterator[Message]:
+    @traced("mailbox.get_messages_sql")
+    def get_messages_sql(
+        self, sql: str, args: dict, partition: str = "hot"
+    ) -> Iterator["MessageRow"]:
         """
-        Executes the given SQL query with the provided arguments and returns an iterator of Message objects.
+        Executes the given SQL query with the provided arguments and returns an iterator of messages.
+
+        The query must select the columns of MESSAGE_COLUMNS, in order, as build_sql does.
 
         Args:
             sql (str): The SQL query to execute.
             opts (dict): The options to be used in the SQL query.
+            partition (str, optional): "hot" to query the working set only, "all" to run the
+                query on the cold database as well. Defaults to "hot".
 
         Yields:
-            Message: A Message object representing a retrieved message.
+            MessageRow: A retrieved message, MessageRow.to_dict() returns it as a Message.
 
         Returns:
-            Iterator[Message]: An iterator of Message objects.
+            Iterator[MessageRow]: An iterator of messages.
 
         """
         # print("Executing SQL: ", sql, opts)
-        with connect("store.db") as conn:
+        with self.connection() as conn:
             cursor = conn.cursor()
-            cursor.execute(sql, args)
-            for row in cursor.fetchall():
-                message = Message(
-                    id=row[0],
-                    threadId=row[1],
-                    historyId=row[2],
-                    internalDate=row[3],
-                    internalTimestamp=row[4],
-                    from_=row[5],
-                    to=row[6],
-                    subject=row[7],
-                    labelIds=json.loads(row[8]),
-                    payload={
-                        "body": {
-                            "data": row[9],
-                            "size": row[10],
-                            "attachmentId": row[11],
-                        },
-                        "filename": row[12],
-                        "mimeType": row[13],
-                        "partId": row[14],
-                        "parts": json.loads(row[15]),
-                    },
-                    raw=row[16],
-                    sizeEstimate=row[17],
-                    snippet=row[18],
-                )
-                yield message
+            # rows stay compact tuples, nested dicts are only built by MessageRow.to_dict()
+            cursor.row_factory = MessageRow
+            with metrics.timer("db_operation_seconds", op="get_messages_sql"):
+                cursor.execute(sql, args)
+                rows = cursor.fetchall()
+            metrics.inc("db_rows_scanned_total", len(rows), op="get_messages_sql")
+            yield from rows
+        if partition == "all" and self.cold_db_path is not None:
+            cursor = self.cold_connection().cursor()
+            cursor.row_factory = MessageRow
+            with metrics.timer("db_operation_seconds", op="get_messages_sql_cold"):
+                cursor.execute(sql, args)
+                rows = cursor.fetchall()
+            metrics.inc("db_rows_scanned_total", len(rows), op="get_messages_sql_cold")
+            yield from rows
+        elif partition not in ("hot", "all"):
+            raise Exception(f"Invalid partition: {partition}")
         pass
 
-    def apply_action(self, actions: list[RuleAction], message: Message):
-
-        for action in actions:
-            if action["type"] == "move":
-                labelId = self.gmail_service.get_labels_by_name(action["value"])
-                if labelId:
-                    if labelId != "INBOX":
-                        self.gmail_service.update_labels(
-                            message.get("id"), [labelId], ["INBOX"]
-                        )
-                    else:
-                        self.gmail_service.update_labels(
-                            message.get("id"), [labelId], []
-                        )
-                else:
-                    raise Exception("Invalid label name")
-
-            elif action["type"] == "unread":
-
-                self.gmail_service.update_labels(message.get("id"), ["UNREAD"], [])
-
-            elif action["type"] == "read":
-                self.gmail_service.update_labels(message.get("id"), [], ["UNREAD"])
-            else:
-                raise Exception("Invalid action type")
-            msg = self.gmail_service.get_message(message.get("id"))
-            self.delete_message(message.get("id"))
-            self.save_message(msg)
+    @traced("mailbox.enqueue_label_changes")
+    def enqueue_label_changes(
+        self, kind: str, ids: Iterable[str], changes: list[tuple[list[str], list[str]]]
+    ) -> int:
+        """
+        Records label changes in the outbox, to be sent to Gmail by a Dispatcher.
 
-        pass
+        Args:
+            kind (str): "message" or "thread", the kind of the IDs.
+            ids (Iterable[str]): The message or thread IDs.
+            changes (list[tuple[list[str], list[str]]]): The (added, removed) label IDs, applied
+                in order to every ID.
+
+        Returns:
+            int: The number of outbox entries written.
+        """
+        now = time.time()
+        rows = [
+            (kind, id, json.dumps(add), json.dumps(remove), now)
+            for id in ids
+            for (add, remove) in changes
+        ]
+        conn = self.connection()
+        with metrics.timer("db_operation_seconds", op="enqueue_label_changes"), conn:
+            conn.executemany(
+                """
+                INSERT INTO outbox (kind, target_id, addLabelIds, removeLabelIds, created_at)
+                VALUES (?,?,?,?,?)
+                """,
+                rows,
+            )
+        metrics.inc("outbox_enqueued_total", len(rows), kind=kind)
+        return len(rows)
+
+    def pending_outbox(self, now: float, limit: int) -> list[tuple]:
+        """
+        Returns up to limit pending outbox entries due at `now`, oldest first, as
+        (id, kind, target_id, addLabelIds, removeLabelIds, attempts) tuples.
+        """
+        conn = self.connection()
+        rows = conn.execute(
+            """
+            SELECT id, kind, target_id, addLabelIds, removeLabelIds, attempts FROM outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            -- changes wait for older changes of the same target that are backing off
+            AND NOT EXISTS (
+                SELECT 1 FROM outbox older
+                WHERE older.target_id = outbox.target_id AND older.status = 'pending'
+                AND older.id < outbox.id AND older.next_attempt_at > ?
+            )
+            ORDER BY id LIMIT ?
+            """,
+            (now, now, limit),
+        ).fetchall()
+        return [
+            (id, kind, target, json.loads(add), json.loads(remove), attempts)
+            for (id, kind, target, add, remove, attempts) in rows
+        ]
+
+    def outbox_counts(self) -> dict[str, int]:
+        """
+        Returns the number of outbox entries per status, and the due time of the next retry.
+        """
+        conn = self.connection()
+        counts = dict(
+            conn.execute(
+                "SELECT status, COUNT(*) FROM outbox GROUP BY status"
+            ).fetchall()
+        )
+        (next_attempt_at,) = conn.execute(
+            "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'"
+        ).fetchone()
+        counts["next_attempt_at"] = next_attempt_at
+        return counts
+
+    def complete_outbox(
+        self,
+        entryIds: list[int],
+        kind: str,
+        ids: list[str],
+        addLabelIds: list[str],
+        removeLabelIds: list[str],
+    ):
+        """
+        Marks outbox entries as done and applies their label changes to the stored messages, so
+        they need not be fetched again.
+        """
+        column = "threadId" if kind == "thread" else "id"
+        conn = self.connection()
+        with metrics.timer("db_operation_seconds", op="complete_outbox"), conn:
+            for schema in self.schemas():
+                rows = conn.execute(
+                    f"""
+                    SELECT id, labelIds FROM {schema}.messages
+                    WHERE {column} IN (SELECT value FROM json_each(?))
+                    """,
+                    (json.dumps(ids),),
+                ).fetchall()
+                updates = []
+                for id, labelIds in rows:
+                    labels = [
+                        l for l in json.loads(labelIds) if l not in removeLabelIds
+                    ]
+                    labels.extend(l for l in addLabelIds if l not in labels)
+                    updates.append((json.dumps(labels), id))
+                conn.executemany(
+                    f"UPDATE {schema}.messages SET labelIds = ? WHERE id = ?", updates
+                )
+            conn.execute(
+                """
+                UPDATE outbox SET status = 'done', error = NULL
+                WHERE id IN (SELECT value FROM json_each(?))
+                """,
+                (json.dumps(entryIds),),
+            )
+
+    def retry_outbox(
+        self, entryIds: list[int], error: str, next_attempt_at: float, failed: bool
+    ):
+        """
+        Records a failed attempt of outbox entries, scheduling the next one at next_attempt_at
+        or marking them failed when out of attempts.
+        """
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                """
+                UPDATE outbox SET attempts = attempts + 1, error = ?, next_attempt_at = ?,
+                    status = ?
+                WHERE id IN (SELECT value FROM json_each(?))
+                """,
+                (
+                    error,
+                    next_attempt_at,
+                    "failed" if failed else "pending",
+                    json.dumps(entryIds),
+                ),
+            )
+
+    def get_threads_sql(self, sql: str, args: list) -> list[str]:
+        """
+        Executes a thread query built by build_sql and returns the matching thread IDs.
+
+        Args:
+            sql (str): The SQL query to execute, selecting from the threads table.
+            args (list): The parameters of the query.
+
+        Returns:
+            list[str]: The IDs of the matching threads.
+        """
+        conn = self.connection()
+        with metrics.timer("db_operation_seconds", op="get_threads_sql"):
+            rows = conn.execute(sql, args).fetchall()
+        metrics.inc("db_rows_scanned_total", len(rows), op="get_threads_sql")
+        return [row[0] for row in rows]
+
+    def action_labels(self, action: RuleAction) -> tuple[list[str], list[str]]:
+        """
+        Returns the label IDs to add and to remove for an action.
+
+        Raises:
+            Exception: If the action type or label name is invalid.
+        """
+        if action["type"] == "move":
+            labelId = self.gmail_service.get_labels_by_name(action["value"])
+            if not labelId:
+                raise Exception("Invalid label name")
+            if labelId != "INBOX":
+                return [labelId], ["INBOX"]
+            return [labelId], []
+        elif action["type"] == "unread":
+            return ["UNREAD"], []
+        elif action["type"] == "read":
+            return [], ["UNREAD"]
+        raise Exception("Invalid action type")
+
+
+@functools.lru_cache(maxsize=256)
+def compile_pattern(pattern: str) -> re.Pattern:
+    """
+    Compiles a regular expression, once per pattern: REGEXP is called for every row.
+    """
+    return re.compile(pattern)
+
+
+def regexp(pattern: str, value: str | None) -> bool | None:
+    """
+    Implements `value REGEXP pattern` for SQLite: whether the pattern matches anywhere in the
+    value. A NULL value gives NULL, so neither matches nor nmatches selects it.
+    """
+    if value is None:
+        return None
+    return compile_pattern(pattern).search(value) is not None
+
+
+def update_thread(cursor, threadId: str):
+    """
+    Recomputes the threads row of a thread from its stored messages, dropping it once the
+    thread has no messages left.
+    """
+    cursor.execute(
+        """
+        INSERT INTO threads (id, historyId, messageCount, lastReceivedAt)
+        SELECT threadId, MAX(CAST(historyId AS INTEGER)), COUNT(*), MAX(receivedAt)
+        FROM messages WHERE threadId = ? GROUP BY threadId
+        ON CONFLICT (id) DO UPDATE SET
+            historyId = excluded.historyId,
+            messageCount = excluded.messageCount,
+            lastReceivedAt = excluded.lastReceivedAt
+        """,
+        (threadId,),
+    )
+    cursor.execute(
+        """
+        DELETE FROM threads WHERE id = ?
+        AND NOT EXISTS (SELECT 1 FROM messages WHERE threadId = ?)
+        """,
+        (threadId, threadId),
+    )
 
 
 def parse_email_address(email: str) -> str:
@@ -402,3 +1620,22 @@ def parse_email_address(email: str) -> str:
     if "<" not in email:
         return email
     return email.split("<")[1].split(">")[0]
+
+
+def parse_date_header(value: str) -> int | None:
+    """
+    Parses an RFC 2822 Date header to epoch seconds. A date without a timezone is taken as UTC.
+
+    Args:
+        value (str): The Date header value.
+
+    Returns:
+        int | None: The epoch seconds, None if the header is not a valid date.
+    """
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.UTC)
+    return int(date.timestamp())
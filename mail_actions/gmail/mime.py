@@ -0,0 +1,148 @@
+import base64
+import codecs
+from email.message import Message
+from html.parser import HTMLParser
+from typing import Iterator, TypedDict
+
+from mail_actions.gmail.service import MessagePayload
+
+# characters of body text kept per message, enough for rules to match on
+MAX_BODY_CHARS = 64 * 1024
+# base64url characters decoded per part (768 KB of content), enough to fill MAX_BODY_CHARS
+# even from markup heavy HTML without decoding huge parts in full
+MAX_PART_DATA = 1024 * 1024
+
+
+class Attachment(TypedDict):
+    """
+    Represents the metadata of an attachment of a message.
+
+    Attributes:
+        filename (str): The file name of the attachment.
+        mimeType (str): The MIME type of the attachment.
+        size (int): The size of the attachment in bytes.
+    """
+
+    filename: str
+    mimeType: str
+    size: int
+
+
+def walk_parts(payload: MessagePayload) -> Iterator[dict]:
+    """
+    Yields the payload and all its nested parts, depth first in document order.
+    """
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        yield part
+        stack.extend(reversed(part.get("parts") or []))
+
+
+def part_charset(part: dict) -> str:
+    """
+    Returns the charset declared by the Content-Type header of a part, UTF-8 when it declares
+    none or one Python does not know.
+    """
+    headers = Message()
+    for header in part.get("headers") or []:
+        if header.get("name", "").lower() == "content-type":
+            headers["Content-Type"] = header.get("value", "")
+            break
+    charset = headers.get_content_charset()
+    if charset:
+        try:
+            return codecs.lookup(charset).name
+        except LookupError:
+            pass
+    return "utf-8"
+
+
+def decode_part(part: dict, limit: int = MAX_PART_DATA) -> str:
+    """
+    Decodes the base64url body data of a part in its declared charset, reading at most `limit`
+    characters of data. Invalid bytes are replaced rather than raised.
+    """
+    data = (part.get("body") or {}).get("data")
+    if not data:
+        return ""
+    data = data[: limit - limit % 4]
+    data += "=" * (-len(data) % 4)
+    return base64.urlsafe_b64decode(data).decode(part_charset(part), errors="replace")
+
+
+def extract_body_text(payload: MessagePayload, limit: int = MAX_BODY_CHARS) -> str:
+    """
+    Walks the MIME tree once and returns the text of the message, capped at `limit` characters.
+
+    text/plain parts are preferred, the text of text/html parts is used when a message has no
+    plain text. Attachments are skipped.
+
+    Args:
+        payload (MessagePayload): The payload of a message fetched with format=full.
+        limit (int, optional): The maximum number of characters returned.
+
+    Returns:
+        str: The body text, empty when the message has no text part.
+    """
+    plain = []
+    html = []
+    for part in walk_parts(payload):
+        if part.get("filename"):
+            continue
+        mimeType = part.get("mimeType", "")
+        if mimeType == "text/plain":
+            plain.append(decode_part(part))
+        elif mimeType == "text/html" and not plain:
+            html.append(decode_part(part))
+    if plain:
+        text = "\n".join(plain)
+    else:
+        text = "\n".join(strip_html(content) for content in html)
+    return text[:limit]
+
+
+def extract_attachments(payload: MessagePayload) -> list[Attachment]:
+    """
+    Returns the metadata of the attachments of a message, the parts with a file name.
+    """
+    return [
+        Attachment(
+            filename=part["filename"],
+            mimeType=part.get("mimeType", ""),
+            size=(part.get("body") or {}).get("size", 0),
+        )
+        for part in walk_parts(payload)
+        if part.get("filename")
+    ]
+
+
+class _TextExtractor(HTMLParser):
+    SKIP = {"script", "style", "head"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks: list[str] = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.chunks.append(data)
+
+
+def strip_html(content: str) -> str:
+    """
+    Returns the text of an HTML document, without tags, scripts and styles, whitespace collapsed.
+    """
+    parser = _TextExtractor()
+    parser.feed(content)
+    parser.close()
+    return " ".join("".join(parser.chunks).split())
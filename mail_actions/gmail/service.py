@@ -1,7 +1,33 @@
-from typing import TypedDict
+import json as json
+import threading
+import time
+from typing import TYPE_CHECKING, TypedDict
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from requests import HTTPError
+from mail_actions.metrics import metrics
+from mail_actions.tracing import traced
+
+if TYPE_CHECKING:
+    from mail_actions.gmail.transport import Transport
+
+# Gmail API quota units per method, see https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "getProfile": 1,
+    "labels.list": 1,
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+    "history.list": 2,
+    "threads.get": 10,
+    "threads.modify": 10,
+}
+
+# status codes worth retrying, rate limits and transient backend errors
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# retries of a request, the backoff waits 1, 2, 4, 8 and 16 seconds
+MAX_RETRIES = 5
 
 
 class MessagePayloadHeader(TypedDict):
@@ -84,6 +110,23 @@ class Message(TypedDict):
     threadId: str
 
 
+class Thread(TypedDict):
+    """
+    Represents a Gmail thread, a conversation of messages.
+
+    Attributes:
+        id (str): The ID of the thread.
+        historyId (str): The history ID of the last change to the thread.
+        messages (list[Message]): The messages of the thread, oldest first.
+        snippet (str): The snippet of the thread.
+    """
+
+    id: str
+    historyId: str
+    messages: list[Message]
+    snippet: str
+
+
 class MessageListItem(TypedDict):
     """
     Represents a Gmail message list item.
@@ -97,6 +140,22 @@ class MessageListItem(TypedDict):
     threadId: str
 
 
+class HistoryList(TypedDict):
+    """
+    Represents a page of mailbox changes retrieved from Gmail.
+
+    Attributes:
+        history (list[dict]): The change records, each with messagesAdded, messagesDeleted,
+            labelsAdded and labelsRemoved entries.
+        nextPageToken (str): The token for the next page of history.
+        historyId (str): The current history ID of the mailbox.
+    """
+
+    history: list[dict]
+    nextPageToken: str
+    historyId: str
+
+
 class Profile(TypedDict):
     """
     Represents the profile of a Gmail user.
@@ -129,10 +188,136 @@ class MessageList(TypedDict):
     resultSizeEstimate: int
 
 
+_discovery_document: dict | None = None
+
+
+def discovery_document() -> dict:
+    """
+    Returns the Gmail v1 discovery document bundled with googleapiclient.
+
+    The document is read and parsed once per process, every GMailService built afterwards
+    (daemon reconnects, multiple accounts) reuses it.
+    """
+    global _discovery_document
+    if _discovery_document is None:
+        from googleapiclient.discovery_cache import get_static_doc
+
+        _discovery_document = json.loads(get_static_doc("gmail", "v1"))
+    return _discovery_document
+
+
 class GMailService:
-    def __init__(self, credentials: Credentials):
+    """
+    Wraps the Gmail API. Every call is recorded in the run metrics.
+
+    The discovery client is built on first use, so creating a GMailService is free and runs
+    that never call the API never import or build it.
+
+    Requests are executed on the transport, by default a transport.HttpPool of keep-alive
+    connections shared by the fetch threads and the dispatcher.
+
+    Attributes:
+        credentials (Credentials): The credentials used to authorize the requests.
+        max_retries (int): Number of retries for rate limited or failed (5xx) requests.
+        backoff (float): Seconds waited before the first retry, doubled on every retry.
+        transport (Transport): Executes the requests, an HttpPool when None is passed.
+    """
+
+    def __init__(
+        self,
+        credentials: Credentials,
+        max_retries: int = MAX_RETRIES,
+        transport: "Transport | None" = None,
+    ):
         self.credentials = credentials
-        self.service = build("gmail", "v1", credentials=self.credentials)
+        self.max_retries = max_retries
+        self.backoff = 1.0
+        self._service = None
+        self._transport = transport
+        self._lock = threading.Lock()
+
+    @property
+    def service(self):
+        """
+        The googleapiclient discovery client, built on first use.
+        """
+        if self._service is None:
+            # deferred, importing googleapiclient.discovery dominates startup time
+            from googleapiclient.discovery import build_from_document
+
+            self._service = build_from_document(
+                discovery_document(), credentials=self.credentials
+            )
+        return self._service
+
+    @service.setter
+    def service(self, service):
+        self._service = service
+
+    @property
+    def transport(self):
+        """
+        The transport executing the requests, a default HttpPool is built on first use.
+        """
+        with self._lock:
+            if self._transport is None:
+                from mail_actions.gmail.transport import HttpPool
+
+                self._transport = HttpPool(self.credentials)
+        return self._transport
+
+    def connection(self):
+        """
+        Lends an HTTP client of the transport for one request, as a context manager.
+        """
+        return self.transport.connection()
+
+    def _execute(self, method: str, request):
+        """
+        Executes an API request, recording call count, latency, response bytes and quota usage.
+        Requests failing with a retryable status are retried with exponential backoff.
+
+        Args:
+            method (str): The API method name, e.g. "messages.get".
+            request: The request to execute.
+
+        Returns:
+            The decoded response.
+        """
+        size = 0
+        postproc = request.postproc
+
+        def measure(resp, content):
+            nonlocal size
+            size = len(content) if content else 0
+            return postproc(resp, content)
+
+        request.postproc = measure
+        attempt = 0
+        while True:
+            metrics.inc("gmail_api_calls_total", method=method)
+            metrics.inc(
+                "gmail_api_quota_units_total", QUOTA_UNITS.get(method, 0), method=method
+            )
+            start = time.perf_counter()
+            try:
+                with self.connection() as http:
+                    response = request.execute(http=http)
+            except Exception as e:
+                elapsed = time.perf_counter() - start
+                metrics.observe("gmail_api_seconds", elapsed, method=method)
+                metrics.inc("gmail_api_errors_total", method=method)
+                status = e.resp.status if isinstance(e, HttpError) else None
+                if attempt < self.max_retries and status in RETRY_STATUS:
+                    attempt += 1
+                    metrics.inc("gmail_api_retries_total", method=method)
+                    time.sleep(min(self.backoff * 2 ** (attempt - 1), 32))
+                    continue
+                raise
+            elapsed = time.perf_counter() - start
+            metrics.observe("gmail_api_seconds", elapsed, method=method)
+            metrics.inc("gmail_api_response_bytes_total", size, method=method)
+            return response
 
     def get_profile(self) -> Profile:
         """
@@ -146,7 +331,7 @@ class GMailService:
         """
         profile = self.service.users().getProfile(userId="me")
         try:
-            response = profile.execute()
+            response = self._execute("getProfile", profile)
             return response
         except HTTPError as e:
             raise Exception(
@@ -173,7 +358,7 @@ class GMailService:
         """
         labels = self.service.users().labels().list(userId="me")
         try:
-            response = labels.execute()
+            response = self._execute("labels.list", labels)
             return response
         except HTTPError as e:
             raise Exception(
@@ -190,13 +375,14 @@ class GMailService:
                 return label.get("id")
         return None
 
-    def get_message_list(self, maxResults=None, pageToken=None) -> MessageList:
+    def get_message_list(self, maxResults=None, pageToken=None, q=None) -> MessageList:
         """
         Fetches the messages for the user.
 
         Args:
             maxResults (int, optional): The maximum number of messages to retrieve. API Defaults to 100, max allowed is 500.
             pageToken (str, optional): The page token for pagination. Defaults to None(First Page).
+            q (str, optional): Only list messages matching this Gmail search query. Defaults to None (all messages).
 
         Returns:
             MessageList: A MessageList object containing the list of messages.
@@ -207,16 +393,17 @@ class GMailService:
         messages = (
             self.service.users()
             .messages()
-            .list(userId="me", maxResults=maxResults, pageToken=pageToken)
+            .list(userId="me", maxResults=maxResults, pageToken=pageToken, q=q)
         )
         try:
-            response = messages.execute()
+            response = self._execute("messages.list", messages)
             return response
         except HTTPError as e:
             raise Exception(
                 f"Http error with status code {e.response.status_code} occurred while fetching messages, {e.response.content}"
             )
 
+    @traced("gmail.get_message")
     def get_message(self, messageId: str) -> Message:
         """
         Fetches a message by ID.
@@ -232,7 +419,7 @@ class GMailService:
         """
         message = self.service.users().messages().get(userId="me", id=messageId)
         try:
-            response = message.execute()
+            response = self._execute("messages.get", message)
             return response
         except HTTPError as e:
             raise Exception(
@@ -261,15 +448,133 @@ class GMailService:
             self.service.users().messages().modify(userId="me", id=messageId, body=body)
         )
         try:
-            response = message.execute()
+            response = self._execute("messages.modify", message)
             return response
         except HTTPError as e:
             raise Exception(
                 f"Http error with status code {e.response.status_code} occurred while updating labels, {e.response.content}"
             )
 
+    def batch_update_labels(
+        self, messageIds: list[str], addLabelIds: list[str], removeLabelIds: list[str]
+    ):
+        """
+        Updates the labels of up to 1000 messages in one call.
+
+        Args:
+            messageIds (list[str]): The IDs of the messages to update, at most 1000.
+            addLabelIds (list[str]): The list of label IDs to add to the messages.
+            removeLabelIds (list[str]): The list of label IDs to remove from the messages.
+
+        Raises:
+            Exception: If an HTTP error occurs while updating the labels.
+        """
+        body = {
+            "ids": messageIds,
+            "addLabelIds": addLabelIds,
+            "removeLabelIds": removeLabelIds,
+        }
+        request = self.service.users().messages().batchModify(userId="me", body=body)
+        try:
+            self._execute("messages.batchModify", request)
+        except HttpError as e:
+            raise Exception(
+                f"Http error with status code {e.resp.status} occurred while updating labels, {e.content}"
+            )
+
+    def get_thread(self, threadId: str) -> Thread:
+        """
+        Fetches a thread with all its messages in one call.
+
+        Args:
+            threadId (str): The ID of the thread to retrieve.
+
+        Returns:
+            Thread: A Thread object containing the messages of the thread.
+
+        Raises:
+            Exception: If an HTTP error occurs while fetching the thread.
+        """
+        thread = self.service.users().threads().get(userId="me", id=threadId)
+        try:
+            response = self._execute("threads.get", thread)
+            return response
+        except HttpError as e:
+            raise Exception(
+                f"Http error with status code {e.resp.status} occurred while fetching thread, {e.content}"
+            )
+
+    def update_thread_labels(
+        self, threadId: str, addLabelIds: list[str], removeLabelIds: list[str]
+    ) -> Thread:
+        """
+        Updates the labels of every message of a thread in one call.
+
+        Args:
+            threadId (str): The ID of the thread to update.
+            addLabelIds (list[str]): The list of label IDs to add to the messages.
+            removeLabelIds (list[str]): The list of label IDs to remove from the messages.
+
+        Returns:
+            Thread: The updated thread, its messages only carry IDs and labels.
+
+        Raises:
+            Exception: If an HTTP error occurs while updating the labels.
+        """
+        body = {"addLabelIds": addLabelIds, "removeLabelIds": removeLabelIds}
+        thread = (
+            self.service.users().threads().modify(userId="me", id=threadId, body=body)
+        )
+        try:
+            response = self._execute("threads.modify", thread)
+            return response
+        except HttpError as e:
+            raise Exception(
+                f"Http error with status code {e.resp.status} occurred while updating thread labels, {e.content}"
+            )
+
+    def get_history(
+        self, startHistoryId: str, pageToken=None, maxResults=500
+    ) -> HistoryList | None:
+        """
+        Fetches the changes made to the mailbox after the given history ID.
+
+        Args:
+            startHistoryId (str): The history ID to list changes from.
+            pageToken (str, optional): The page token for pagination. Defaults to None(First Page).
+            maxResults (int, optional): The maximum number of history records to retrieve, max 500.
+
+        Returns:
+            HistoryList | None: The changes, or None if startHistoryId is too old and a full sync is needed.
+
+        Raises:
+            Exception: If an HTTP error occurs while fetching the history.
+        """
+        history = (
+            self.service.users()
+            .history()
+            .list(
+                userId="me",
+                startHistoryId=startHistoryId,
+                pageToken=pageToken,
+                maxResults=maxResults,
+            )
+        )
+        try:
+            response = self._execute("history.list", history)
+            return response
+        except HttpError as e:
+            if e.resp.status == 404:
+                return None
+            raise Exception(
+                f"Http error with status code {e.resp.status} occurred while fetching history, {e.content}"
+            )
+
     def close(self):
         """
         Closes the service connection.
         """
-        self.service.close()
+        if self._service is not None:
+            self._service.close()
+        if self._transport is not None:
+            self._transport.close()
@@ -0,0 +1,159 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Protocol
+
+import httplib2
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+
+from mail_actions.metrics import metrics
+
+# connections kept open to the API, at least the fetch concurrency of the mailbox
+DEFAULT_POOL_SIZE = 8
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 60.0
+
+
+class Transport(Protocol):
+    """
+    Executes the HTTP requests of a GMailService.
+
+    Any object with these methods can be passed as the transport of a GMailService, e.g. to
+    record or stub the API calls.
+    """
+
+    def connection(self):
+        """
+        Lends an httplib2 compatible client for one request, as a context manager.
+        """
+
+    def close(self):
+        """
+        Closes the open connections.
+        """
+
+
+class TimeoutHttp(httplib2.Http):
+    """
+    An httplib2 client with separate connect and read timeouts, asking for gzip responses.
+
+    httplib2 applies one socket timeout to connecting and reading, new connections are opened
+    with the connect timeout and then switched to the read timeout. Connections are kept alive
+    between requests (httplib2 keeps one per host).
+
+    Google APIs only compress responses for clients whose User-Agent contains "gzip", the
+    responses are decompressed by httplib2.
+
+    Attributes:
+        connect_timeout (float): Seconds to wait for a connection.
+        read_timeout (float): Seconds to wait for response data.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout: float = DEFAULT_READ_TIMEOUT,
+    ):
+        super().__init__(timeout=connect_timeout)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        headers = dict(headers or {})
+        agent = headers.get("user-agent", "mail-actions")
+        if "gzip" not in agent:
+            headers["user-agent"] = f"{agent} (gzip)"
+        headers.setdefault("accept-encoding", "gzip")
+        reused = any(conn.sock is not None for conn in self.connections.values())
+        start = time.perf_counter()
+        try:
+            return super().request(uri, method, body, headers, *args, **kwargs)
+        finally:
+            metrics.observe(
+                "http_request_seconds",
+                time.perf_counter() - start,
+                connection="reused" if reused else "new",
+            )
+
+    def _conn_request(self, conn, request_uri, method, body, headers):
+        if conn.sock is None:
+            conn.timeout = self.connect_timeout
+            try:
+                conn.connect()
+            except OSError:
+                conn.close()
+                raise
+            metrics.inc("http_connections_opened_total")
+        conn.sock.settimeout(self.read_timeout)
+        # httplib2 reconnects a connection the server closed, with the read timeout
+        conn.timeout = self.read_timeout
+        return super()._conn_request(conn, request_uri, method, body, headers)
+
+
+class HttpPool:
+    """
+    A pool of authorized keep-alive HTTP clients, shared by every thread of a GMailService.
+
+    httplib2 clients are not thread safe, a client is lent to one request at a time. Requests
+    wait for a free client once `size` are in use, which bounds the open connections. Idle
+    clients are reused most recent first, their connection is the most likely to be alive.
+
+    Attributes:
+        credentials (Credentials): The credentials authorizing the requests.
+        size (int): The maximum number of clients, and connections.
+        connect_timeout (float): Seconds to wait for a connection.
+        read_timeout (float): Seconds to wait for response data.
+    """
+
+    def __init__(
+        self,
+        credentials: Credentials,
+        size: int = DEFAULT_POOL_SIZE,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout: float = DEFAULT_READ_TIMEOUT,
+    ):
+        self.credentials = credentials
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._clients: list[AuthorizedHttp] = []
+
+    def _client(self) -> AuthorizedHttp:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        http = TimeoutHttp(self.connect_timeout, self.read_timeout)
+        client = AuthorizedHttp(self.credentials, http=http)
+        with self._lock:
+            self._clients.append(client)
+        return client
+
+    @contextmanager
+    def connection(self) -> Iterator[AuthorizedHttp]:
+        """
+        Lends a client for one request, waiting for one to be free if the pool is exhausted.
+        """
+        with metrics.timer("http_pool_wait_seconds"):
+            self._slots.acquire()
+        try:
+            client = self._client()
+            try:
+                yield client
+            finally:
+                self._idle.put(client)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """
+        Closes the connections of every client.
+        """
+        with self._lock:
+            for client in self._clients:
+                client.http.close()
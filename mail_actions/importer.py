@@ -0,0 +1,264 @@
+import base64
+import csv
+import datetime
+import email.policy
+import email.utils
+from email.message import Message as EmailMessage
+from email.parser import BytesParser
+from typing import Iterator, TypedDict
+
+from progress.counter import Counter
+
+from mail_actions.gmail.mailbox import MailBox
+from mail_actions.gmail.mime import extract_body_text
+from mail_actions.gmail.service import GMailService, Message, MessagePayload
+from mail_actions.metrics import metrics
+
+# messages parsed and saved per transaction
+IMPORT_BATCH_SIZE = 500
+# characters of body text in the snippet, like the snippets of the Gmail API
+SNIPPET_CHARS = 200
+
+# X-Gmail-Labels names of the Gmail system labels, user labels are looked up by name
+SYSTEM_LABELS = {
+    "Inbox": "INBOX",
+    "Unread": "UNREAD",
+    "Starred": "STARRED",
+    "Important": "IMPORTANT",
+    "Sent": "SENT",
+    "Draft": "DRAFT",
+    "Drafts": "DRAFT",
+    "Category Personal": "CATEGORY_PERSONAL",
+    "Category Social": "CATEGORY_SOCIAL",
+    "Category Promotions": "CATEGORY_PROMOTIONS",
+    "Category Updates": "CATEGORY_UPDATES",
+    "Category Forums": "CATEGORY_FORUMS",
+}
+# messages.list leaves out spam, trash and chats, a sync would delete them again
+SKIPPED_LABELS = {"Spam", "Trash", "Chat"}
+
+
+class ImportSummary(TypedDict):
+    """
+    Represents the outcome of an mbox import.
+
+    Attributes:
+        read (int): The number of messages read from the mbox file.
+        imported (int): The number of messages saved to the database.
+        existing (int): The number of messages already stored, left unchanged.
+        skipped (int): The number of messages without a Gmail message ID, or in spam, trash
+            or chats.
+    """
+
+    read: int
+    imported: int
+    existing: int
+    skipped: int
+
+
+def iter_mbox(path: str) -> Iterator[tuple[bytes, bytes]]:
+    """
+    Streams the messages of an mbox file, one message in memory at a time.
+
+    Every line starting with `From ` starts a message, `>From ` lines in the body are unquoted
+    (mboxrd, as written by Google Takeout).
+
+    Yields:
+        tuple[bytes, bytes]: The `From ` separator line and the message.
+    """
+    separator = None
+    lines = []
+    with open(path, "rb") as stream:
+        for line in stream:
+            if line.startswith(b"From "):
+                if separator is not None:
+                    yield separator, b"".join(lines)
+                separator = line.rstrip(b"\r\n")
+                lines = []
+            elif separator is not None:
+                if line.startswith(b">") and line.lstrip(b">").startswith(b"From "):
+                    line = line[1:]
+                lines.append(line)
+    if separator is not None:
+        yield separator, b"".join(lines)
+
+
+def parse_separator(separator: bytes) -> tuple[str | None, int | None]:
+    """
+    Parses a Takeout `From <X-GM-MSGID>@xxx <date>` separator line.
+
+    Returns:
+        tuple[str | None, int | None]: The Gmail API message ID (the hex X-GM-MSGID) and the
+            internal date in milliseconds, None when the line does not carry them.
+    """
+    fields = separator.decode("ascii", errors="replace").split(None, 2)
+    sender = fields[1] if len(fields) > 1 else ""
+    msgid = sender.split("@")[0]
+    id = format(int(msgid), "x") if msgid.isdigit() else None
+    try:
+        date = datetime.datetime.strptime(fields[2].strip(), "%a %b %d %H:%M:%S %z %Y")
+        internalDate = int(date.timestamp() * 1000)
+    except (IndexError, ValueError):
+        internalDate = None
+    return id, internalDate
+
+
+def parse_labels(value: str, labels: dict[str, str]) -> tuple[list[str], bool]:
+    """
+    Maps an X-Gmail-Labels header to label IDs.
+
+    Args:
+        value (str): The comma separated label names, names with a comma are quoted.
+        labels (dict[str, str]): The IDs of the user labels by name.
+
+    Returns:
+        tuple[list[str], bool]: The label IDs, and whether the message is in spam, trash or
+            chats. Names of labels deleted since the export are dropped.
+    """
+    ids = []
+    skipped = False
+    for name in next(csv.reader([value], skipinitialspace=True), []):
+        name = name.strip()
+        if name in SKIPPED_LABELS:
+            skipped = True
+        elif name in SYSTEM_LABELS:
+            ids.append(SYSTEM_LABELS[name])
+        elif name in labels:
+            ids.append(labels[name])
+    return list(dict.fromkeys(ids)), skipped
+
+
+def build_payload(part: EmailMessage, partId: str = "") -> MessagePayload:
+    """
+    Converts a parsed MIME part to a payload shaped like messages.get(format=full).
+
+    Like the API, bodies are the transfer-decoded bytes in the charset their Content-Type
+    declares, and attachment data is left out, only its size is kept.
+    """
+    payload = MessagePayload(
+        partId=partId,
+        mimeType=part.get_content_type(),
+        filename=part.get_filename() or "",
+        headers=[{"name": name, "value": str(value)} for (name, value) in part.items()],
+        body={"size": 0},
+    )
+    if part.is_multipart():
+        payload["parts"] = [
+            build_payload(sub, f"{partId}.{i}" if partId else str(i))
+            for (i, sub) in enumerate(part.get_payload())
+        ]
+        return payload
+    data = part.get_payload(decode=True) or b""
+    payload["body"]["size"] = len(data)
+    if not payload["filename"]:
+        payload["body"]["data"] = base64.urlsafe_b64encode(data).decode("ascii")
+    return payload
+
+
+def parse_mbox_message(
+    separator: bytes, raw: bytes, labels: dict[str, str]
+) -> Message | None:
+    """
+    Converts a Takeout mbox message to a Message, None if it cannot be matched to a Gmail
+    message (no X-GM-MSGID) or is left out of the Gmail listing (spam, trash and chats).
+
+    The IDs are the hex forms of the X-GM-MSGID and X-GM-THRID of the export, which are the
+    message and thread IDs of the Gmail API.
+    """
+    (id, internalDate) = parse_separator(separator)
+    if id is None:
+        return None
+    parsed = BytesParser(policy=email.policy.default).parsebytes(raw)
+    (labelIds, skipped) = parse_labels(str(parsed.get("X-Gmail-Labels", "")), labels)
+    if skipped:
+        return None
+    thrid = str(parsed.get("X-GM-THRID", "")).strip()
+    if internalDate is None:
+        try:
+            internalDate = int(
+                email.utils.parsedate_to_datetime(str(parsed["Date"])).timestamp()
+                * 1000
+            )
+        except (TypeError, ValueError):
+            internalDate = 0
+    payload = build_payload(parsed)
+    return Message(
+        id=id,
+        threadId=format(int(thrid), "x") if thrid.isdigit() else id,
+        # the export carries no history ID, the next sync_history starts after the sync
+        historyId="0",
+        internalDate=str(internalDate),
+        labelIds=labelIds,
+        snippet=" ".join(extract_body_text(payload, SNIPPET_CHARS * 4).split())[
+            :SNIPPET_CHARS
+        ],
+        sizeEstimate=len(raw),
+        payload=payload,
+    )
+
+
+def user_labels(service: GMailService) -> dict[str, str]:
+    """
+    Returns the IDs of the user labels of the account by name.
+    """
+    return {
+        label["name"]: label["id"]
+        for label in service.get_labels().get("labels", [])
+        if label.get("type") == "user"
+    }
+
+
+def import_mbox(
+    mailbox: MailBox,
+    path: str,
+    labels: dict[str, str],
+    batch_size: int = IMPORT_BATCH_SIZE,
+) -> ImportSummary:
+    """
+    Bulk loads a Google Takeout mbox export into the mailbox.
+
+    The file is streamed and saved in batches, messages already stored are left unchanged.
+    The IDs match the Gmail API, so the next MailBox.sync() only fetches the messages received
+    since the export and deletes the ones deleted since. Label changes made after the export
+    are not picked up by the sync.
+
+    Args:
+        mailbox (MailBox): The mailbox to load, init_db() must have been called.
+        path (str): The mbox file.
+        labels (dict[str, str]): The IDs of the user labels by name, see user_labels().
+        batch_size (int, optional): Messages saved per transaction.
+
+    Returns:
+        ImportSummary: The number of messages read, imported, already stored and skipped.
+    """
+    summary = ImportSummary(read=0, imported=0, existing=0, skipped=0)
+    counter = Counter("Importing messages: ")
+    batch: dict[str, Message] = {}
+
+    def flush():
+        missing = set(mailbox.missing_ids(list(batch)))
+        saved = mailbox.save_messages(batch[id] for id in batch if id in missing)
+        summary["imported"] += saved
+        summary["existing"] += len(batch) - saved
+        metrics.inc("mbox_messages_imported_total", saved)
+        batch.clear()
+
+    with metrics.phase("import_mbox"):
+        for separator, raw in iter_mbox(path):
+            summary["read"] += 1
+            counter.next()
+            msg = parse_mbox_message(separator, raw, labels)
+            if msg is None:
+                summary["skipped"] += 1
+                continue
+            # exports can repeat a message, keep the first copy
+            if msg["id"] in batch:
+                summary["existing"] += 1
+                continue
+            batch[msg["id"]] = msg
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+    counter.finish()
+    return summary
@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import json as json
+from collections import deque
+from typing import TYPE_CHECKING
+
+from mail_actions.gmail.mailbox import MailBox
+from mail_actions.metrics import metrics
+
+if TYPE_CHECKING:
+    from mail_actions.ruleengine import CompiledRule
+
+# the messages columns the index matches, one pass reads them for every candidate message
+INDEXED_FIELDS = ("from", "to", "subject")
+INDEXED_OPERATORS = ("eq", "ne", "contains", "ncontains")
+# LIKE folds the case of ASCII letters only
+ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+# distinct values whose matches are remembered per field, senders repeat a lot
+VALUE_CACHE_SIZE = 100_000
+
+
+class AhoCorasick:
+    """
+    Finds which of a set of patterns occur in a text in one pass over the text, however many
+    patterns there are.
+
+    Attributes:
+        patterns (list[str]): The patterns, identified by their position.
+    """
+
+    def __init__(self, patterns: list[str]):
+        self.patterns = patterns
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail = [0]
+        output: list[set[int]] = [set()]
+        for i, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                next = self.goto[state].get(char)
+                if next is None:
+                    next = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    output.append(set())
+                    self.goto[state][char] = next
+                state = next
+            output[state].add(i)
+        # breadth first, the fail link of a state points to a shallower one
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next in self.goto[state].items():
+                queue.append(next)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next] = self.goto[fail].get(char, 0)
+                output[next] |= output[self.fail[next]]
+        self.output = [frozenset(patterns) for patterns in output]
+
+    def search(self, text: str) -> set[int]:
+        """
+        Returns the positions of the patterns occurring in the text.
+        """
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found |= output[state]
+        return found
+
+
+def is_indexable(compiled: CompiledRule) -> bool:
+    """
+    Checks if a rule can be matched by the RuleIndex: a message rule on the hot partition whose
+    filters are all eq, ne, contains or ncontains on from, to or subject.
+
+    Contains values with LIKE wildcards (% and _) are left to SQLite.
+    """
+    rule = compiled["rule"]
+    filters = rule.get("filters") or []
+    if (
+        rule.get("scope", "message") != "message"
+        or rule.get("partition", "hot") != "hot"
+        or rule.get("match") not in ("all", "any")
+        or not filters
+    ):
+        return False
+    for filter in filters:
+        if (
+            filter.get("field") not in INDEXED_FIELDS
+            or filter.get("operator") not in INDEXED_OPERATORS
+            or not isinstance(filter.get("value"), str)
+        ):
+            return False
+        if filter["operator"] in ("contains", "ncontains") and (
+            not filter["value"] or "%" in filter["value"] or "_" in filter["value"]
+        ):
+            return False
+    return True
+
+
+class RuleIndex:
+    """
+    Matches many rules in one pass over the messages, instead of one query per rule.
+
+    The eq and ne filters of every rule are grouped into a hash table per field, the contains
+    and ncontains values into one Aho-Corasick automaton per field, so a message is matched
+    against all the rules with a lookup and a scan of each field. Only the rules a message hits
+    (and the rules with a negated filter, which match on a miss) are then checked.
+
+    Matches are the ones of the rule queries: eq compares exactly, contains ignores the case
+    of ASCII letters like LIKE, and a NULL field matches no filter.
+
+    Attributes:
+        rules (list[CompiledRule]): The rules, matched by position.
+        indexed (list[int]): The positions of the rules matched by the index, see is_indexable.
+    """
+
+    def __init__(self, rules: list[CompiledRule]):
+        self.rules = rules
+        self.indexed = [i for (i, rule) in enumerate(rules) if is_indexable(rule)]
+        # (field, kind, value) -> term, a filter value shared by rules is looked up once
+        terms: dict[tuple[str, str, str], int] = {}
+        self.conditions: dict[int, list[tuple[int, bool, int]]] = {}
+        self.rules_by_term: dict[int, list[int]] = {}
+        self.always: list[int] = []
+        for i in self.indexed:
+            rule = rules[i]["rule"]
+            conditions = []
+            for filter in rule["filters"]:
+                operator = filter["operator"]
+                kind = "eq" if operator in ("eq", "ne") else "contains"
+                value = filter["value"]
+                if kind == "contains":
+                    value = value.translate(ASCII_LOWER)
+                term = terms.setdefault((filter["field"], kind, value), len(terms))
+                negated = operator in ("ne", "ncontains")
+                column = INDEXED_FIELDS.index(filter["field"])
+                conditions.append((term, negated, column))
+                self.rules_by_term.setdefault(term, []).append(i)
+            self.conditions[i] = conditions
+            if any(negated for (_, negated, _) in conditions):
+                self.always.append(i)
+        self.equal: dict[str, dict[str, list[int]]] = {f: {} for f in INDEXED_FIELDS}
+        contains: dict[str, list[tuple[str, int]]] = {f: [] for f in INDEXED_FIELDS}
+        for (field, kind, value), term in terms.items():
+            if kind == "eq":
+                self.equal[field].setdefault(value, []).append(term)
+            else:
+                contains[field].append((value, term))
+        self.automata = {
+            field: (
+                AhoCorasick([value for (value, _) in patterns]),
+                [term for (_, term) in patterns],
+            )
+            for (field, patterns) in contains.items()
+            if patterns
+        }
+
+    def field_terms(self, field: str, value: str) -> frozenset[int]:
+        """
+        Returns the terms (eq and contains filter values) a field value hits.
+        """
+        terms = set(self.equal[field].get(value, ()))
+        if field in self.automata:
+            automaton, patternTerms = self.automata[field]
+            for pattern in automaton.search(value.translate(ASCII_LOWER)):
+                terms.add(patternTerms[pattern])
+        return frozenset(terms)
+
+    def match(
+        self, mailbox: MailBox, ids: set[str] | None = None
+    ) -> dict[int, list[str]]:
+        """
+        Matches the indexed rules against the hot messages in one pass.
+
+        Args:
+            mailbox (MailBox): The mailbox to match.
+            ids (set[str], optional): Only consider these message IDs. Defaults to None (all
+                messages).
+
+        Returns:
+            dict[int, list[str]]: The IDs of the matching messages by rule position, for every
+                indexed rule.
+        """
+        matches: dict[int, list[str]] = {i: [] for i in self.indexed}
+        if not self.indexed:
+            return matches
+        columns = ", ".join(f'"{field}"' for field in INDEXED_FIELDS)
+        sql = f"SELECT id, {columns} FROM messages"
+        params = []
+        if ids is not None:
+            sql += " WHERE id IN (SELECT value FROM json_each(?))"
+            params.append(json.dumps(sorted(ids)))
+        cache: dict[str, dict[str, frozenset[int]]] = {f: {} for f in INDEXED_FIELDS}
+        scanned = 0
+        with metrics.timer("rule_index_seconds"):
+            for row in mailbox.connection().execute(sql, params):
+                scanned += 1
+                values = row[1:]
+                hits = set()
+                for field, value in zip(INDEXED_FIELDS, values):
+                    if value is None:
+                        continue
+                    terms = cache[field].get(value)
+                    if terms is None:
+                        if len(cache[field]) >= VALUE_CACHE_SIZE:
+                            cache[field].clear()
+                        terms = cache[field][value] = self.field_terms(field, value)
+                    hits |= terms
+                candidates = set(self.always)
+                for term in hits:
+                    candidates.update(self.rules_by_term[term])
+                for i in candidates:
+                    if self.matches(i, hits, values):
+                        matches[i].append(row[0])
+        metrics.inc("db_rows_scanned_total", scanned, op="rule_index")
+        return matches
+
+    def matches(self, i: int, hits: set[int], values: tuple) -> bool:
+        """
+        Checks if the rule at position i matches a message, given the terms it hits.
+        """
+        results = (
+            values[column] is not None and (term in hits) != negated
+            for (term, negated, column) in self.conditions[i]
+        )
+        if self.rules[i]["rule"]["match"] == "all":
+            return all(results)
+        return any(results)
@@ -0,0 +1,281 @@
+import json as json
+import os as os
+import threading
+import time
+from contextlib import contextmanager
+from mail_actions.tracing import tracer
+
+PREFIX = "mail_actions_"
+
+# latency buckets in seconds, tuned for Gmail API calls and SQLite statements
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram:
+    """
+    Represents a cumulative histogram of observed values.
+
+    Attributes:
+        buckets (tuple[float]): The upper bounds of the buckets, +Inf is implicit.
+        counts (list[int]): The number of observations per bucket (not cumulative).
+        sum (float): The sum of all observed values.
+        count (int): The number of observations.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """
+        Returns the cumulative bucket counts as (le, count) pairs, including +Inf.
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append(("+Inf" if bound == float("inf") else repr(bound), total))
+        return result
+
+
+class Metrics:
+    """
+    Collects the run metrics: counters, latency histograms and per-phase wall time.
+
+    Metrics are identified by a name and a set of labels, e.g.
+    `metrics.inc("gmail_api_calls_total", method="messages.get")`.
+    All methods are thread safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.help: dict[str, str] = {}
+        self.reset()
+
+    def reset(self):
+        """
+        Drops every recorded value.
+        """
+        with self._lock:
+            self.counters: dict[str, dict[tuple, float]] = {}
+            self.histograms: dict[str, dict[tuple, Histogram]] = {}
+            self.phases: dict[str, float] = {}
+            self.started = time.time()
+
+    def describe(self, name: str, text: str):
+        """
+        Sets the help text of a metric used in the Prometheus output.
+        """
+        self.help[name] = text
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """
+        Increments the counter `name` with the given labels by value.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Records value in the histogram `name` with the given labels.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Context manager observing the wall time of the block, in seconds, into histogram `name`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Context manager adding the wall time of the block to phase `name`.
+        A phase entered multiple times accumulates its time. Phases also show up as trace spans.
+        """
+        start = time.perf_counter()
+        try:
+            with tracer.span(name, cat="phase"):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def to_dict(self) -> dict:
+        """
+        Returns all metrics as a JSON serializable dict.
+        """
+        with self._lock:
+            return {
+                "started": self.started,
+                "finished": time.time(),
+                "phases": dict(self.phases),
+                "counters": {
+                    name: [
+                        {"labels": dict(key), "value": value}
+                        for key, value in series.items()
+                    ]
+                    for name, series in self.counters.items()
+                },
+                "histograms": {
+                    name: [
+                        {
+                            "labels": dict(key),
+                            "count": hist.count,
+                            "sum": hist.sum,
+                            "buckets": dict(hist.cumulative()),
+                        }
+                        for key, hist in series.items()
+                    ]
+                    for name, series in self.histograms.items()
+                },
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                metric = PREFIX + name
+                if name in self.help:
+                    lines.append(f"# HELP {metric} {self.help[name]}")
+                lines.append(f"# TYPE {metric} counter")
+                for key, value in series.items():
+                    lines.append(f"{metric}{format_labels(key)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                metric = PREFIX + name
+                if name in self.help:
+                    lines.append(f"# HELP {metric} {self.help[name]}")
+                lines.append(f"# TYPE {metric} histogram")
+                for key, hist in series.items():
+                    for le, count in hist.cumulative():
+                        labels = format_labels(key + (("le", le),))
+                        lines.append(f"{metric}_bucket{labels} {count}")
+                    lines.append(f"{metric}_sum{format_labels(key)} {hist.sum}")
+                    lines.append(f"{metric}_count{format_labels(key)} {hist.count}")
+            metric = PREFIX + "phase_seconds"
+            lines.append(f"# HELP {metric} Wall time spent per run phase")
+            lines.append(f"# TYPE {metric} gauge")
+            for phase, seconds in self.phases.items():
+                lines.append(f"{metric}{format_labels((('phase', phase),))} {seconds}")
+            metric = PREFIX + "last_run_timestamp_seconds"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {self.started}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path: str):
+        write_atomic(path, self.to_json())
+
+    def write_prometheus(self, path: str):
+        """
+        Writes the Prometheus textfile. The file is replaced atomically so the node exporter
+        textfile collector never reads a partial file.
+        """
+        write_atomic(path, self.to_prometheus())
+
+
+def format_labels(key: tuple) -> str:
+    if not key:
+        return ""
+    pairs = []
+    for name, value in key:
+        value = (
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def write_atomic(path: str, content: str):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+# process wide registry used by the service, mailbox and rule engine
+metrics = Metrics()
+metrics.describe("gmail_api_calls_total", "Gmail API calls per method")
+metrics.describe("gmail_api_errors_total", "Failed Gmail API calls per method")
+metrics.describe("gmail_api_retries_total", "Retried Gmail API calls per method")
+metrics.describe("gmail_api_response_bytes_total", "Gmail API response body bytes")
+metrics.describe("gmail_api_quota_units_total", "Gmail API quota units consumed")
+metrics.describe("gmail_api_seconds", "Gmail API call latency")
+metrics.describe("http_request_seconds", "HTTP request latency per connection reuse")
+metrics.describe(
+    "http_connections_opened_total", "HTTP connections opened to the Gmail API"
+)
+metrics.describe(
+    "http_pool_wait_seconds", "Time spent waiting for a pooled HTTP client"
+)
+metrics.describe("db_operation_seconds", "MailBox database operation latency")
+metrics.describe("db_rows_scanned_total", "Rows read from the database")
+metrics.describe("db_rows_written_total", "Rows written to the database")
+metrics.describe("db_rows_deleted_total", "Rows deleted from the database")
+metrics.describe("rule_messages_matched_total", "Messages matched per rule")
+metrics.describe("rule_threads_matched_total", "Threads matched per thread scoped rule")
+metrics.describe("outbox_enqueued_total", "Label changes written to the outbox")
+metrics.describe("outbox_sent_total", "Outbox label changes accepted by Gmail")
+metrics.describe(
+    "outbox_coalesced_total", "Outbox label changes cancelled by later ones"
+)
+metrics.describe("outbox_retries_total", "Failed outbox sends scheduled for a retry")
+metrics.describe("outbox_failed_total", "Outbox sends that ran out of attempts")
+metrics.describe("messages_archived_total", "Messages taken out of the working set")
+metrics.describe("mbox_messages_imported_total", "Messages loaded from an mbox export")
+metrics.describe("optimizer_rewrites_total", "Rule queries rewritten by the optimizer")
+metrics.describe("auth_refreshes_total", "Access token refreshes per source")
+metrics.describe(
+    "auth_refresh_errors_total", "Failed background access token refreshes"
+)
+metrics.describe("auth_refresh_seconds", "Access token refresh latency")
+metrics.describe("run_lease_takeovers_total", "Stale run leases taken over")
+metrics.describe("run_lease_lost_total", "Run leases lost to another run")
+metrics.describe("run_lease_wait_seconds", "Time spent waiting for the run lease")
+metrics.describe("rules_indexed_total", "Rules matched together by the rule index")
+metrics.describe("rule_index_seconds", "Time spent matching the indexed rules")
+metrics.describe("rule_seconds", "Time spent applying a rule")
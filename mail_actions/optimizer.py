@@ -0,0 +1,293 @@
+from typing import TypedDict
+
+from mail_actions.gmail.mailbox import MailBox
+from mail_actions.metrics import metrics
+
+# the messages columns of the indexed rule fields, see MailBox.init_db
+INDEXED_COLUMNS = {
+    "date_received": "receivedAt",
+    "date_sent": "sentAt",
+    "size": "sizeEstimate",
+    "from": "from",
+}
+INDEXES = {
+    "idx_messages_receivedAt": "receivedAt",
+    "idx_messages_sentAt": "sentAt",
+    "idx_messages_sizeEstimate": "sizeEstimate",
+    "idx_messages_from": "from",
+}
+MESSAGE_LOOKUP = "SELECT id FROM messages WHERE"
+# relative cost of evaluating a predicate on one row, a column comparison costs 1
+FIELD_COSTS = {
+    "body": 20,
+    "has_attachment": 4,
+    "attachment_name": 5,
+    "attachment_type": 5,
+}
+REGEX_COST = 30
+# selectivity guesses when the statistics have nothing better
+DEFAULT_SELECTIVITY = {
+    "eq": 0.05,
+    "ne": 0.95,
+    "contains": 0.1,
+    "ncontains": 0.9,
+    "matches": 0.1,
+    "nmatches": 0.9,
+    "range": 0.3,
+}
+
+
+class Predicate(TypedDict):
+    """
+    Represents the where clause of one rule filter.
+
+    Attributes:
+        field (str): The filter field.
+        operator (str): The filter operator.
+        sql (str): The clause, on the messages table.
+        params (list): The clause parameters, relative dates are bound before optimizing.
+    """
+
+    field: str
+    operator: str
+    sql: str
+    params: list
+
+
+class Stats(TypedDict):
+    """
+    Represents the statistics the optimizer estimates selectivity from.
+
+    Attributes:
+        rows (int): The number of messages.
+        rows_per_value (dict[str, float]): Average rows per distinct value of the indexed
+            columns, from sqlite_stat1 (written by ANALYZE, see MailBox.maintain).
+        ranges (dict[str, tuple]): Minimum and maximum of the indexed numeric columns.
+        with_attachments (int): The number of messages with an attachment.
+    """
+
+    rows: int
+    rows_per_value: dict[str, float]
+    ranges: dict[str, tuple]
+    with_attachments: int
+
+
+class Optimizer:
+    """
+    Rewrites the where clause of a rule for the current data.
+
+    - Date bounds on the same column are constant folded into one range, a rule whose ranges
+      cannot overlap matches nothing without a query.
+    - `match: all` predicates are ordered by rank, cost / (1 - selectivity), so the cheap and
+      selective ones reject a row before the expensive ones run. `match: any` predicates by
+      cost / selectivity, the cheap and likely ones accept a row first.
+    - `match: any` over indexable predicates only (date, size, from eq and has_attachment) is
+      rewritten to a UNION of index lookups when it has an attachment predicate, with which
+      SQLite would scan the table.
+
+    Selectivity is estimated from sqlite_stat1 and the bounds of the indexed columns.
+
+    Attributes:
+        mailbox (MailBox): The mailbox whose statistics are used.
+    """
+
+    def __init__(self, mailbox: MailBox):
+        self.mailbox = mailbox
+
+    def load_stats(self) -> Stats:
+        """
+        Reads the statistics of the messages table, a few index lookups.
+        """
+        conn = self.mailbox.connection()
+        stats = Stats(rows=0, rows_per_value={}, ranges={}, with_attachments=0)
+        has_stat1 = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+        ).fetchone()
+        analyzed = {}
+        if has_stat1:
+            for idx, stat in conn.execute(
+                "SELECT idx, stat FROM sqlite_stat1 WHERE tbl IN ('messages', 'attachments')"
+            ):
+                analyzed[idx] = [
+                    int(value) for value in stat.split()[:2] if value.isdigit()
+                ]
+        for idx, column in INDEXES.items():
+            if len(analyzed.get(idx, [])) == 2:
+                stats["rows"] = analyzed[idx][0]
+                stats["rows_per_value"][column] = analyzed[idx][1]
+        if not stats["rows"]:
+            (stats["rows"],) = conn.execute("SELECT COUNT(*) FROM messages").fetchone()
+        attachments = analyzed.get("idx_attachments_message_id", [])
+        if len(attachments) == 2 and attachments[1]:
+            stats["with_attachments"] = attachments[0] // attachments[1]
+        else:
+            stats["with_attachments"] = stats["rows"] // 10
+        for column in ("receivedAt", "sentAt", "sizeEstimate"):
+            stats["ranges"][column] = conn.execute(
+                f'SELECT MIN("{column}"), MAX("{column}") FROM messages'
+            ).fetchone()
+        return stats
+
+    def optimize(
+        self, predicates: list[Predicate], match: str, stats: Stats | None = None
+    ) -> tuple[str, list]:
+        """
+        Builds the optimized where clause of a rule.
+
+        Args:
+            predicates (list[Predicate]): The predicates of the rule, parameters bound.
+            match (str): The match criteria of the rule, "all" or "any".
+            stats (Stats, optional): The statistics to use, loaded when None.
+
+        Returns:
+            tuple[str, list]: The where clause and its parameters.
+
+        Raises:
+            Exception: If the match criteria is invalid.
+        """
+        if match not in ("all", "any"):
+            raise Exception(f"Invalid filter match: {match}")
+        if match == "all":
+            predicates = fold_ranges(predicates)
+            if predicates is None:
+                metrics.inc("optimizer_rewrites_total", kind="empty_range")
+                return "0", []
+        stats = self.load_stats() if stats is None else stats
+        if match == "any" and len(predicates) > 1:
+            lookups = [index_lookup(predicate) for predicate in predicates]
+            # SQLite serves an OR of indexed messages columns itself (MULTI-INDEX OR), the
+            # rewrite is for the attachment subqueries, which it evaluates on every row
+            native = [
+                lookup
+                for lookup in lookups
+                if (lookup or "").startswith(MESSAGE_LOOKUP)
+            ]
+            if all(lookups) and len(native) < len(lookups):
+                metrics.inc("optimizer_rewrites_total", kind="union")
+                union = " UNION ".join(lookups)
+                params = [
+                    param for predicate in predicates for param in predicate["params"]
+                ]
+                return f"id IN ({union})", params
+
+        def rank(predicate: Predicate) -> float:
+            selectivity = estimate_selectivity(predicate, stats)
+            cost = estimate_cost(predicate)
+            if match == "all":
+                return cost / max(1 - selectivity, 1e-6)
+            return cost / max(selectivity, 1e-6)
+
+        # sorted is stable, predicates of equal rank keep the order of the rules file
+        ordered = sorted(predicates, key=rank)
+        where = (" AND " if match == "all" else " OR ").join(
+            f"({predicate['sql']})" for predicate in ordered
+        )
+        return where, [param for predicate in ordered for param in predicate["params"]]
+
+
+def fold_ranges(predicates: list[Predicate]) -> list[Predicate] | None:
+    """
+    Merges the single bound date predicates (gt, gte, lt, lte) of an `all` rule on the same
+    column into one range. Epoch seconds are integers, so `> t` is `>= t + 1`.
+
+    Returns:
+        list[Predicate] | None: The predicates with one range per date column, None when a
+            range is empty.
+    """
+    bounds: dict[str, list] = {}
+    folded = []
+    for predicate in predicates:
+        column = INDEXED_COLUMNS.get(predicate["field"])
+        operator = predicate["operator"]
+        if (
+            predicate["field"] not in ("date_received", "date_sent")
+            or operator not in ("gt", "gte", "lt", "lte")
+            or len(predicate["params"]) != 1
+        ):
+            folded.append(predicate)
+            continue
+        value = predicate["params"][0]
+        (low, high) = bounds.setdefault(column, [None, None])
+        if operator in ("gt", "gte"):
+            value += 1 if operator == "gt" else 0
+            bounds[column][0] = value if low is None else max(low, value)
+        else:
+            value -= 1 if operator == "lt" else 0
+            bounds[column][1] = value if high is None else min(high, value)
+    for column, (low, high) in bounds.items():
+        field = next(f for (f, c) in INDEXED_COLUMNS.items() if c == column)
+        if low is not None and high is not None and low > high:
+            return None
+        if low is not None:
+            folded.append(
+                Predicate(
+                    field=field, operator="gte", sql=f'"{column}" >= ?', params=[low]
+                )
+            )
+        if high is not None:
+            folded.append(
+                Predicate(
+                    field=field, operator="lte", sql=f'"{column}" <= ?', params=[high]
+                )
+            )
+    return folded
+
+
+def index_lookup(predicate: Predicate) -> str | None:
+    """
+    Returns a query selecting the IDs of the messages matching an indexable predicate with an
+    index lookup, None if the predicate needs a scan.
+    """
+    field = predicate["field"]
+    operator = predicate["operator"]
+    if (field in ("date_received", "date_sent", "size") and operator != "ne") or (
+        field == "from" and operator == "eq"
+    ):
+        return f"{MESSAGE_LOOKUP} {predicate['sql']}"
+    if field == "has_attachment" and predicate["sql"].startswith("EXISTS"):
+        return "SELECT message_id FROM attachments"
+    return None
+
+
+def estimate_selectivity(predicate: Predicate, stats: Stats) -> float:
+    """
+    Estimates the fraction of messages matching a predicate.
+    """
+    field = predicate["field"]
+    operator = predicate["operator"]
+    rows = max(stats["rows"], 1)
+    column = INDEXED_COLUMNS.get(field)
+    if field == "has_attachment":
+        fraction = min(stats["with_attachments"] / rows, 1)
+        return fraction if predicate["sql"].startswith("EXISTS") else 1 - fraction
+    if column in stats["ranges"] and operator in ("gt", "gte", "lt", "lte"):
+        (low, high) = stats["ranges"][column]
+        value = predicate["params"][0] if predicate["params"] else None
+        if low is None or high is None or not isinstance(value, (int, float)):
+            return DEFAULT_SELECTIVITY["range"]
+        below = min(max((value - low) / max(high - low, 1), 0), 1)
+        return max(1 - below if operator in ("gt", "gte") else below, 0.001)
+    if column in stats["ranges"] and operator == "eq" and len(predicate["params"]) == 2:
+        # a date without a time matches the whole day
+        (low, high) = stats["ranges"][column]
+        if low is not None and high is not None:
+            (start, end) = predicate["params"]
+            return min(max((end - start) / max(high - low, 1), 0.001), 1)
+    if column in stats["rows_per_value"] and operator in ("eq", "ne"):
+        equal = min(stats["rows_per_value"][column] / rows, 1)
+        return equal if operator == "eq" else 1 - equal
+    if field in ("date_received", "date_sent"):
+        return DEFAULT_SELECTIVITY["range"]
+    return DEFAULT_SELECTIVITY.get(operator, DEFAULT_SELECTIVITY["range"])
+
+
+def estimate_cost(predicate: Predicate) -> float:
+    """
+    Estimates the relative cost of evaluating a predicate on one row.
+    """
+    cost = FIELD_COSTS.get(predicate["field"], 1)
+    if predicate["operator"] in ("contains", "ncontains"):
+        cost *= 2
+    if predicate["operator"] in ("matches", "nmatches"):
+        cost *= REGEX_COST
+    return cost
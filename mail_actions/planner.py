@@ -0,0 +1,249 @@
+import datetime
+import math
+import time
+from typing import TypedDict
+
+from mail_actions.gmail.mailbox import MailBox
+from mail_actions.gmail.service import QUOTA_UNITS, GMailService, Profile
+from mail_actions.ruleengine import (
+    CompiledRule,
+    is_relative_date,
+    parse_date,
+    parse_size,
+)
+from mail_actions.ruleparser import Rule, RuleFilter
+
+# a mailbox synced within this many seconds is fresh enough to run rules locally
+DEFAULT_MAX_STALENESS = 15 * 60
+
+SEARCH_OPERATORS = {"from": "from", "to": "to", "subject": "subject"}
+SEARCH_UNITS = {"day": "d", "month": "m", "year": "y"}
+
+
+class Plan(TypedDict):
+    """
+    Represents how a rule is executed.
+
+    Attributes:
+        mode (str): "local" to run the rule on the synced database, "remote" to list the
+            candidate messages with a Gmail search and fetch only those.
+        query (str): The Gmail search query of the rule, None if it cannot be expressed.
+        reason (str): Why the mode was chosen.
+        remote_cost (int): The estimated quota units of a remote run.
+        sync_cost (int): The estimated quota units of the full sync a local run needs.
+    """
+
+    mode: str
+    query: str | None
+    reason: str
+    remote_cost: int
+    sync_cost: int
+
+
+def build_query(rule: Rule) -> str | None:
+    """
+    Translates a rule to a Gmail search query.
+
+    The query selects a superset of the messages matched by the rule, which then runs on them
+    locally: date bounds are widened by a day, since Gmail compares dates in the account's time
+    zone. Text values match whole words in Gmail, so a `contains` value that is only part of a
+    word (`hub` in `github.com`) would not be found, contains filters have no equivalent. Their
+    negations are kept, a message excluded by the search contains the value as a word. `ne`
+    has none either, the search would also exclude the messages merely containing the value.
+
+    Args:
+        rule (Rule): The rule to translate.
+
+    Returns:
+        str | None: The query, None if a filter, the thread match or the match criteria has no
+            Gmail search equivalent (e.g. date_sent, body or gt on a text field).
+
+    Example:
+        rule = {
+            "match": "all",
+            "filters": [
+                {"field": "from", "operator": "eq", "value": "notifications@github.com"},
+                {"field": "date_received", "operator": "gt", "value": "2 days"},
+            ],
+        }
+        build_query(rule)
+        # Output: 'from:"notifications@github.com" newer_than:3d'
+    """
+    if rule.get("scope", "message") == "thread" and rule.get("thread_match") == "all":
+        return None
+    terms = []
+    for filter in rule.get("filters", []):
+        term = build_query_term(filter)
+        if term is None:
+            return None
+        terms.append(term)
+    if not terms:
+        return None
+    if rule.get("match") == "all":
+        return " ".join(terms)
+    elif rule.get("match") == "any":
+        return "{" + " ".join(terms) + "}"
+    return None
+
+
+def build_query_term(filter: RuleFilter) -> str | None:
+    """
+    Translates a filter to a Gmail search term, None if it has no equivalent.
+    """
+    field = filter.get("field", "")
+    operator = filter.get("operator", "")
+    value = str(filter.get("value", "")).strip()
+    if not value or any(c in value for c in '"{}()'):
+        return None
+
+    if field in SEARCH_OPERATORS:
+        term = f'{SEARCH_OPERATORS[field]}:"{value}"'
+        if operator == "eq":
+            return term
+        if operator == "ncontains":
+            return f"-{term}"
+        return None
+
+    if field == "date_received":
+        if is_relative_date(value):
+            (amount, unit) = value.split(" ")
+            unit = SEARCH_UNITS.get(unit.rstrip("s"))
+            if unit is None:
+                return None
+            if operator in ("gt", "gte"):
+                return f"newer_than:{int(amount) + 1}{unit}"
+            if operator in ("lt", "lte"):
+                return f"older_than:{max(int(amount) - 1, 0)}{unit}"
+            return None
+        try:
+            (timestamp, _) = parse_date(value)
+        except Exception:
+            return None
+        day = datetime.datetime.fromtimestamp(timestamp, datetime.UTC).date()
+        after = (day - datetime.timedelta(days=1)).strftime("%Y/%m/%d")
+        before = (day + datetime.timedelta(days=2)).strftime("%Y/%m/%d")
+        if operator in ("gt", "gte"):
+            return f"after:{after}"
+        if operator in ("lt", "lte"):
+            return f"before:{before}"
+        if operator == "eq":
+            return f"after:{after} before:{before}"
+        return None
+
+    if field == "size":
+        try:
+            size = parse_size(value)
+        except Exception:
+            return None
+        if operator in ("gt", "gte"):
+            return f"larger:{max(size - 1, 0)}"
+        if operator in ("lt", "lte"):
+            return f"smaller:{size + 1}"
+        return None
+
+    if field == "has_attachment" and operator in ("eq", "ne"):
+        has = (value.lower() == "true") == (operator == "eq")
+        return "has:attachment" if has else "-has:attachment"
+
+    if field == "attachment_name" and operator == "eq":
+        return f'filename:"{value}"'
+
+    return None
+
+
+class Planner:
+    """
+    Chooses, per rule, between running it on the local database and a remote Gmail search.
+
+    A local run needs an up to date mirror: when the mailbox was synced recently (or the stored
+    history ID is current) every rule runs locally. Otherwise a rule with a Gmail search
+    equivalent runs remotely when listing and fetching its candidates is estimated to cost
+    fewer quota units than the full sync.
+
+    Attributes:
+        mailbox (MailBox): The local mailbox.
+        service (GMailService): The Gmail service.
+        max_staleness (float): Seconds after a sync during which the mailbox counts as fresh.
+    """
+
+    def __init__(
+        self,
+        mailbox: MailBox,
+        service: GMailService,
+        max_staleness: float = DEFAULT_MAX_STALENESS,
+    ):
+        self.mailbox = mailbox
+        self.service = service
+        self.max_staleness = max_staleness
+
+    def is_fresh(self, profile: Profile) -> bool:
+        """
+        Returns whether the local mailbox is recent enough to run rules on.
+        """
+        lastSyncAt = self.mailbox.get_state("lastSyncAt")
+        if (
+            lastSyncAt is not None
+            and time.time() - float(lastSyncAt) < self.max_staleness
+        ):
+            return True
+        stats = self.mailbox.get_stats()
+        return stats.get("lastHistoryId") == profile.get("historyId")
+
+    def plan(self, compiled: CompiledRule, profile: Profile) -> Plan:
+        """
+        Plans the execution of a compiled rule.
+
+        The remote estimate lists one page of the search (5 quota units), its result size
+        estimate then prices the listing and the fetch of the messages not stored yet.
+
+        Args:
+            compiled (CompiledRule): The rule to plan.
+            profile (Profile): The profile of the account, for the mailbox size and history ID.
+
+        Returns:
+            Plan: The chosen mode with its estimated costs.
+        """
+        query = build_query(compiled["rule"])
+        total = int(profile.get("messagesTotal", 0))
+        local = self.mailbox.get_stats()["totalMessages"]
+        sync_cost = QUOTA_UNITS["messages.list"] * math.ceil(total / 500) + QUOTA_UNITS[
+            "messages.get"
+        ] * max(total - local, 0)
+        if self.is_fresh(profile):
+            return Plan(
+                mode="local",
+                query=query,
+                reason="mailbox is in sync",
+                remote_cost=0,
+                sync_cost=0,
+            )
+        if query is None:
+            return Plan(
+                mode="local",
+                query=None,
+                reason="rule has no Gmail search equivalent",
+                remote_cost=0,
+                sync_cost=sync_cost,
+            )
+        estimate = self.service.get_message_list(maxResults=1, q=query).get(
+            "resultSizeEstimate", 0
+        )
+        unstored = estimate * (1 - min(local / total, 1)) if total else estimate
+        remote_cost = QUOTA_UNITS["messages.list"] * (
+            1 + math.ceil(estimate / 500)
+        ) + QUOTA_UNITS["messages.get"] * math.ceil(unstored)
+        if remote_cost < sync_cost:
+            return Plan(
+                mode="remote",
+                query=query,
+                reason="searching is cheaper than a full sync",
+                remote_cost=remote_cost,
+                sync_cost=sync_cost,
+            )
+        return Plan(
+            mode="local",
+            query=query,
+            reason="a full sync is cheaper than searching",
+            remote_cost=remote_cost,
+            sync_cost=sync_cost,
+        )
@@ -0,0 +1,111 @@
+import hashlib
+import json as json
+import os as os
+import mail_actions.ruleparser as ruleparser
+from mail_actions.metrics import metrics
+from mail_actions.ruleengine import CompiledRule, compile_rule
+
+# bump when build_sql output or the cache layout changes, so stale caches are rebuilt
+CACHE_VERSION = 3
+
+# rules file path -> (cache key, compiled rules), reused for the lifetime of the process
+_memory: dict[str, tuple[str, list[CompiledRule]]] = {}
+
+
+def cache_key(rules_file: str, schema_file: str) -> str:
+    """
+    Returns a key identifying the content of the rules and schema files.
+
+    Args:
+        rules_file (str): Path of the rules file.
+        schema_file (str): Path of the schema file.
+
+    Returns:
+        str: The sha256 hex digest of the cache version and both files.
+    """
+    digest = hashlib.sha256(f"v{CACHE_VERSION}".encode())
+    for path in (rules_file, schema_file):
+        with open(path, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def default_cache_file(rules_file: str) -> str:
+    """
+    Returns the cache file path for a rules file, e.g. `.rules.yaml.cache.json` next to `rules.yaml`.
+    """
+    directory, name = os.path.split(rules_file)
+    return os.path.join(directory, f".{name}.cache.json")
+
+
+def read_cache(cache_file: str, key: str) -> list[CompiledRule] | None:
+    """
+    Reads the compiled rules from the cache file.
+
+    Returns:
+        list[CompiledRule] | None: The compiled rules, or None if the file is missing, unreadable
+        or was written for another key.
+    """
+    try:
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or cache.get("key") != key:
+        return None
+    return cache.get("rules")
+
+
+def write_cache(cache_file: str, key: str, compiled: list[CompiledRule]):
+    """
+    Writes the compiled rules to the cache file. The file is replaced atomically, and a cache
+    that can't be written is skipped, it only costs the validation on the next run.
+    """
+    tmp = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump({"key": key, "rules": compiled}, f)
+        os.replace(tmp, cache_file)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load_compiled_rules(
+    rules_file: str, cache_file: str | None = None
+) -> list[CompiledRule]:
+    """
+    Loads the rules compiled to their queries, validating and compiling them only when the
+    rules or schema file changed.
+
+    The compiled rules are cached in memory and in `cache_file`, keyed by the hashes of both
+    files. While neither changes, loading skips the YAML parsing, the jsonschema validation
+    and build_sql.
+
+    Args:
+        rules_file (str): Path of the rules file.
+        cache_file (str, optional): Path of the cache file. Defaults to default_cache_file(rules_file).
+
+    Returns:
+        list[CompiledRule]: The compiled rules, in file order.
+
+    Raises:
+        Exception: If the rules file is invalid.
+    """
+    key = cache_key(rules_file, ruleparser.SCHEMA_FILE)
+    path = os.path.abspath(rules_file)
+    cached = _memory.get(path)
+    if cached is not None and cached[0] == key:
+        metrics.inc("rule_cache_hits_total", layer="memory")
+        return cached[1]
+
+    cache_file = cache_file or default_cache_file(rules_file)
+    compiled = read_cache(cache_file, key)
+    if compiled is not None:
+        metrics.inc("rule_cache_hits_total", layer="file")
+    else:
+        metrics.inc("rule_cache_misses_total")
+        compiled = [compile_rule(rule) for rule in ruleparser.load_rules(rules_file)]
+        write_cache(cache_file, key, compiled)
+    _memory[path] = (key, compiled)
+    return compiled
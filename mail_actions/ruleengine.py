@@ -1,17 +1,164 @@
-from mail_actions.gmail.mailbox import MailBox
+import calendar
+import datetime
+import json as json
+from typing import TypedDict
+from mail_actions.dispatcher import Dispatcher
+from mail_actions.gmail.mailbox import MESSAGE_COLUMNS, MailBox
 from mail_actions.gmail.service import GMailService
+from mail_actions.metrics import metrics
+from mail_actions.matcher import RuleIndex
+from mail_actions.optimizer import Optimizer, Predicate, Stats
 from mail_actions.ruleparser import Rule, RuleFilter
 from progress.counter import Counter
 
 
+class CompiledRule(TypedDict):
+    """
+    Represents a rule compiled to a query on the messages table.
+
+    Attributes:
+        rule (Rule): The validated rule.
+        sql (str): The query selecting the messages matching the rule.
+        params (list): The query parameters, relative dates are resolved by bind_params.
+        predicates (list[Predicate]): The clauses of the filters, reordered or rewritten by the
+            optimizer when the rule runs.
+    """
+
+    rule: Rule
+    sql: str
+    params: list
+    predicates: list[Predicate]
+
+
+def compile_rule(rule: Rule) -> CompiledRule:
+    """
+    Compiles a rule to its query with build_sql.
+
+    Raises:
+        Exception: If the rule has an invalid field, operator or match criteria.
+    """
+    (sql, params) = build_sql(rule)
+    return CompiledRule(
+        rule=rule, sql=sql, params=params, predicates=build_predicates(rule)
+    )
+
+
 class RuleEngine:
+    """
+    Applies rules to the mailbox.
+
+    Matching messages are not modified inline: their label changes are written to the outbox
+    and sent by the dispatcher once the rule has been evaluated, in batches. A read-only engine
+    only counts the matches, e.g. while another run holds the database (see runlock.RunLock).
+    """
 
-    def __init__(self, mailbox: MailBox, mailService: GMailService):
+    def __init__(
+        self, mailbox: MailBox, mailService: GMailService, read_only: bool = False
+    ):
         self.mailbox = mailbox
         self.mailService = mailService
+        self.read_only = read_only
+        self.dispatcher = Dispatcher(mailbox, mailService)
+        self.optimizer = Optimizer(mailbox)
+
+    def apply_rule(self, rule: Rule, ids: set[str] | None = None):
+        """
+        Applies the rule's actions to every matching message.
+
+        Args:
+            rule (Rule): The rule to apply.
+            ids (set[str], optional): Only consider these message IDs. Defaults to None (all messages).
+        """
+        self.apply_compiled_rule(compile_rule(rule), ids)
+
+    def apply_compiled_rule(
+        self,
+        compiled: CompiledRule,
+        ids: set[str] | None = None,
+        stats: Stats | None = None,
+    ):
+        """
+        Applies the actions of a compiled rule to every matching message.
+
+        Args:
+            compiled (CompiledRule): The rule and its query, see compile_rule and rulecache.
+            ids (set[str], optional): Only consider these message IDs. Defaults to None (all messages).
+            stats (Stats, optional): The statistics the query is optimized for, loaded when None.
+        """
+        rule = compiled["rule"]
+        scope = rule.get("scope", "message")
+        (sql, opts) = self.rule_sql(compiled, stats=stats)
+        if ids is not None:
+            (sql, opts) = restrict_to_ids(sql, opts, ids, scope)
+        changes = self.rule_changes(rule)
+        if scope == "thread":
+            self.apply_thread_rule(rule, sql, opts, changes)
+            return
+        counter = Counter("Processed messages : ")
+        with metrics.timer("rule_seconds", rule=rule["name"]):
+            matched = []
+            for message in self.mailbox.get_messages_sql(
+                sql, opts, rule.get("partition", "hot")
+            ):
+                matched.append(message["id"])
+                counter.next()
+            if not self.read_only:
+                self.mailbox.enqueue_label_changes("message", matched, changes)
+                self.dispatch()
+        counter.finish()
+        metrics.inc("rule_messages_matched_total", counter.index, rule=rule["name"])
+        if counter.index == 0:
+            print("No messages to process")
+        elif self.read_only:
+            print(f"Read-only: {counter.index} messages match, not modified")
+        pass
+
+    def apply_rules(self, rules: list[CompiledRule], ids: set[str] | None = None):
+        """
+        Applies compiled rules in order.
+
+        The rules the matcher.RuleIndex supports (eq and contains filters on from, to and
+        subject) are matched together in one pass over the messages, the others run their own
+        query. Their label changes are queued in the order of the rules either way.
+
+        Args:
+            rules (list[CompiledRule]): The rules, see rulecache.load_compiled_rules.
+            ids (set[str], optional): Only consider these message IDs. Defaults to None (all messages).
+        """
+        index = RuleIndex(rules)
+        # a single rule is served as well by its own query, which can use the from index
+        matches = index.match(self.mailbox, ids) if len(index.indexed) > 1 else {}
+        metrics.inc("rules_indexed_total", len(matches))
+        # loaded once for all the rule queries, a few scans without sqlite_stat1
+        stats = self.optimizer.load_stats() if len(matches) < len(rules) else None
+        for position, compiled in enumerate(rules):
+            if position in matches:
+                self.apply_matches(compiled["rule"], matches[position])
+            else:
+                self.apply_compiled_rule(compiled, ids, stats)
+
+    def apply_matches(self, rule: Rule, ids: list[str]):
+        """
+        Applies the actions of a message rule to the messages it matched, see apply_rules.
+        """
+        changes = self.rule_changes(rule)
+        with metrics.timer("rule_seconds", rule=rule["name"]):
+            if not self.read_only:
+                self.mailbox.enqueue_label_changes("message", ids, changes)
+                self.dispatch()
+        metrics.inc("rule_messages_matched_total", len(ids), rule=rule["name"])
+        print(f"Processed messages : {len(ids)}")
+        if not ids:
+            print("No messages to process")
+        elif self.read_only:
+            print(f"Read-only: {len(ids)} messages match, not modified")
+
+    def rule_changes(self, rule: Rule) -> list[tuple[list, list]]:
+        """
+        Prints the actions of a rule and returns its label changes, none for a read-only engine.
 
-    def apply_rule(self, rule: Rule):
-        (sql, opts) = build_sql(rule)
+        Label names are resolved once per rule, invalid actions fail before any change.
+        """
         print("Applying Rule : ", rule["name"])
         print(
             "Actions: ",
@@ -25,74 +172,237 @@ class RuleEngine:
                 print(f"\tMark as unread")
             else:
                 print(f"Unknown action type: {action.get('type')}")
-        counter = Counter("Processed messages : ")
-        for message in self.mailbox.get_messages_sql(sql, opts):
-            self.mailbox.apply_action(rule["actions"], message)
-            counter.next()
+        if self.read_only:
+            return []
+        return [self.mailbox.action_labels(action) for action in rule["actions"]]
+
+    def rule_sql(
+        self,
+        compiled: CompiledRule,
+        now: datetime.datetime | None = None,
+        stats: Stats | None = None,
+    ) -> tuple[str, list]:
+        """
+        Returns the query of a compiled rule with its parameters bound, optimized for the
+        current statistics of the mailbox (see optimizer.Optimizer).
+
+        Args:
+            compiled (CompiledRule): The rule and its query.
+            now (datetime, optional): The reference time of relative dates.
+            stats (Stats, optional): The statistics of the mailbox, loaded when None.
+
+        Returns:
+            tuple[str, list]: The query and its parameters.
+        """
+        if not compiled.get("predicates"):
+            # compiled before predicates were cached
+            return compiled["sql"], bind_params(compiled["params"], now)
+        bound = [
+            Predicate(
+                field=predicate["field"],
+                operator=predicate["operator"],
+                sql=predicate["sql"],
+                params=bind_params(predicate["params"], now),
+            )
+            for predicate in compiled["predicates"]
+        ]
+        with metrics.timer("optimizer_seconds"):
+            (where, params) = self.optimizer.optimize(
+                bound, compiled["rule"].get("match"), stats
+            )
+        return build_select(compiled["rule"], where), params
+
+    def dispatch(self):
+        """
+        Sends the queued label changes, reporting the ones left for a retry.
+        """
+        with metrics.phase("dispatch"):
+            summary = self.dispatcher.drain()
+        if summary["pending"] or summary["failed"]:
+            print(
+                f"Outbox: {summary['pending']} changes pending retry, {summary['failed']} failed"
+            )
+
+    def apply_remote_rule(self, compiled: CompiledRule, query: str):
+        """
+        Applies a rule without a full sync: the candidates are listed with a Gmail search,
+        only the ones not stored yet are fetched, and the rule's query then runs on them.
+
+        Args:
+            compiled (CompiledRule): The rule and its query.
+            query (str): The Gmail search query of the rule, see planner.build_query.
+        """
+        with metrics.phase("rules.remote_search"):
+            ids = self.mailbox.scan_query(query)
+            missing = self.mailbox.missing_ids(ids)
+        print(f"Search {query!r} found {len(ids)} messages, {len(missing)} not stored")
+        if missing:
+            with metrics.phase("rules.remote_fetch"):
+                self.mailbox.fetch_messages(missing)
+        self.apply_compiled_rule(compiled, set(ids))
+
+    def apply_thread_rule(
+        self, rule: Rule, sql: str, opts: list, changes: list[tuple[list, list]]
+    ):
+        """
+        Applies the actions of a thread scoped rule, each matching thread is modified with a
+        single threads.modify call regardless of its length.
+        """
+        counter = Counter("Processed threads : ")
+        with metrics.timer("rule_seconds", rule=rule["name"]):
+            threadIds = self.mailbox.get_threads_sql(sql, opts)
+            counter.next(len(threadIds))
+            if not self.read_only:
+                self.mailbox.enqueue_label_changes("thread", threadIds, changes)
+                self.dispatch()
         counter.finish()
+        metrics.inc("rule_threads_matched_total", counter.index, rule=rule["name"])
         if counter.index == 0:
-            print("No messages to process")
-        pass
+            print("No threads to process")
+        elif self.read_only:
+            print(f"Read-only: {counter.index} threads match, not modified")
 
 
 def build_sql(rule: Rule) -> tuple[str, dict]:
     """
     Builds an SQL query on messages table of mailbox and options based on the given rule.
 
+    Rules with `scope: thread` query the threads table instead, selecting the threads with any
+    (or, with `thread_match: all`, every) message matching the filters.
+
     Args:
         rule (Rule): The rule object containing the filters and match criteria.
 
     Returns:
         tuple[str, dict]: A tuple containing the SQL query and options.
 
+    Raises:
+        Exception: If the filter match criteria, scope, thread match or partition is invalid.
+    """
+    (where, options) = build_where(rule)
+    return build_select(rule, where), options
+
+
+def build_select(rule: Rule, where: str) -> str:
+    """
+    Builds the query of a rule around a where clause on the messages table, see build_sql.
+
+    Raises:
+        Exception: If the scope, thread match or partition is invalid.
+    """
+    scope = rule.get("scope", "message")
+    partition = rule.get("partition", "hot")
+    if partition not in ("hot", "all"):
+        raise Exception(f"Invalid partition: {partition}")
+    if scope == "thread":
+        if partition != "hot":
+            raise Exception("Thread rules only match the hot partition")
+        columns = '"id", "historyId", "messageCount", "lastReceivedAt"'
+        thread_match = rule.get("thread_match", "any")
+        if thread_match == "any":
+            threads = f"SELECT threadId FROM messages WHERE {where}"
+        elif thread_match == "all":
+            threads = (
+                "SELECT threadId FROM messages GROUP BY threadId "
+                f"HAVING MIN(CASE WHEN ({where}) THEN 1 ELSE 0 END) = 1"
+            )
+        else:
+            raise Exception(f"Invalid thread match: {thread_match}")
+        return f"SELECT {columns} FROM threads WHERE id IN ({threads})"
+    elif scope != "message":
+        raise Exception(f"Invalid rule scope: {scope}")
+
+    columns = [f'"{column}"' for column in MESSAGE_COLUMNS]
+    return "SELECT " + ", ".join(columns) + " FROM messages WHERE " + where
+
+
+def build_where(rule: Rule) -> tuple[str, list]:
+    """
+    Builds the where clause on the messages table matching the filters of the rule.
+
+    Returns:
+        tuple[str, list]: A tuple containing the where clause and its parameters.
+
     Raises:
         Exception: If the filter match criteria is invalid.
     """
-    options = []
-    clauses = []
-    columns = [
-        "id",
-        "threadId",
-        "historyId",
-        "internalDate",
-        "internalTimestamp",
-        "from",
-        "to",
-        "subject",
-        "labelIds",
-        "payload__body__data",
-        "payload__body__size",
-        "payload__body__attachmentId",
-        "payload__filename",
-        "payload__mimeType",
-        "payload__partId",
-        "payload__parts",
-        "raw",
-        "sizeEstimate",
-        "snippet",
-    ]
-    columns = [f'"{column}"' for column in columns]
-    sql = "SELECT " + ", ".join(columns) + " FROM messages WHERE "
-    for filter in rule.get("filters", []):
+    predicates = build_predicates(rule)
+    clauses = [predicate["sql"] for predicate in predicates]
+    options = [param for predicate in predicates for param in predicate["params"]]
+
+    if rule.get("match") == "all":
+        where = " AND ".join(clauses)
+    elif rule.get("match") == "any":
+        where = " OR ".join(clauses)
+    else:
+        raise Exception(f"Invalid filter match: {rule.get('match')}")
+
+    return where, options
+
+
+def build_predicates(rule: Rule) -> list[Predicate]:
+    """
+    Builds the clause of every filter of the rule.
+
+    Raises:
+        Exception: If a filter has an invalid field, operator or value.
+    """
+    predicates = []
+    # regular expressions run in Python for every row they see, the indexed and LIKE
+    # predicates go first so SQLite short circuits before reaching them
+    filters = sorted(rule.get("filters", []), key=is_regex_filter)
+    for filter in filters:
         if (filter.get("field") == "date_received") or (
             filter.get("field") == "date_sent"
         ):
             (clause, opt) = build_date_filter_clause(filter)
-            clauses.append(clause)
-            options.extend(opt)
+        elif filter.get("field") in ATTACHMENT_FIELDS:
+            (clause, opt) = build_attachment_filter_clause(filter)
         else:
             (clause, opt) = build_string_filter_clause(filter)
-            clauses.append(clause)
-            options.extend(opt)
+        predicates.append(
+            Predicate(
+                field=filter.get("field"),
+                operator=filter.get("operator"),
+                sql=clause,
+                params=opt,
+            )
+        )
+    return predicates
 
-    if rule.get("match") == "all":
-        sql += " AND ".join(clauses)
-    elif rule.get("match") == "any":
-        sql += " OR ".join(clauses)
-    else:
-        raise Exception(f"Invalid filter match: {rule.get('match')}")
 
-    return sql, options
+def is_regex_filter(filter: RuleFilter) -> bool:
+    return filter.get("operator") in REGEX_OPERATORS
+
+
+REGEX_OPERATORS = ("matches", "nmatches")
+
+
+def restrict_to_ids(
+    sql: str, options: list, ids: set[str], scope: str = "message"
+) -> tuple[str, list]:
+    """
+    Restricts a rule query built by build_sql to the given message IDs.
+
+    The IDs are bound as a single JSON array parameter, so any number of IDs can be passed.
+    Thread queries are restricted to the threads containing one of the messages.
+
+    Args:
+        sql (str): The rule query.
+        options (list): The query parameters.
+        ids (set[str]): The message IDs to keep.
+        scope (str, optional): The scope of the rule, "message" or "thread".
+
+    Returns:
+        tuple[str, list]: A tuple containing the restricted SQL query and options.
+    """
+    ids_param = "SELECT value FROM json_each(?)"
+    if scope == "thread":
+        ids_param = f"SELECT threadId FROM messages WHERE id IN ({ids_param})"
+    return (
+        f"SELECT * FROM ({sql}) WHERE id IN ({ids_param})",
+        options + [json.dumps(sorted(ids))],
+    )
 
 
 def build_string_filter_clause(filter: RuleFilter) -> tuple[str, list]:
@@ -115,6 +425,7 @@ def build_string_filter_clause(filter: RuleFilter) -> tuple[str, list]:
         "from": "from",
         "to": "to",
         "subject": "subject",
+        "body": "body",
     }
     operatorMap = {
         "contains": "LIKE",
@@ -125,6 +436,8 @@ def build_string_filter_clause(filter: RuleFilter) -> tuple[str, list]:
         "lt": "<",
         "gte": ">=",
         "lte": "<=",
+        "matches": "REGEXP",
+        "nmatches": "NOT REGEXP",
     }
     field = filter.get("field", "")
     column = columnMap.get(field, None)
@@ -139,13 +452,124 @@ def build_string_filter_clause(filter: RuleFilter) -> tuple[str, list]:
     if operator in ["LIKE", "NOT LIKE"]:
         value = f"%{value}%"
 
+    if column == "body":
+        # decoded at ingest into the bodies table, one primary key lookup per message
+        return f"{BODY_TEXT} {operator} ?", [value]
     return f'"{column}" {operator} ?', [value]
 
 
+BODY_TEXT = "(SELECT text FROM bodies WHERE message_id = messages.id)"
+
+
+ATTACHMENT_FIELDS = ["size", "has_attachment", "attachment_name", "attachment_type"]
+
+SIZE_UNITS = {"": 1, "b": 1, "kb": 1024, "mb": 1024**2, "gb": 1024**3}
+
+
+def build_attachment_filter_clause(filter: RuleFilter) -> tuple[str, list]:
+    """
+    Builds a sql where clause for the size and attachment fields.
+
+    `size` compares the size estimate of the message to a size like `500KB` or `10 MB`.
+    `has_attachment` takes `true` or `false` with eq or ne. `attachment_name` and
+    `attachment_type` match when any attachment's file name or MIME type matches, their
+    negated operators (ncontains, ne) when no attachment matches. All of them use the indexes
+    on messages.sizeEstimate and attachments.message_id.
+
+    Args:
+        filter (RuleFilter): The filter object containing the field, operator, and value.
+
+    Returns:
+        tuple[str, list]: A tuple containing the SQL clause and a list of parameter values.
+
+    Raises:
+        Exception: If an invalid field, operator or value is provided in the filter.
+
+    Example:
+        filter = {
+            "field": "attachment_type",
+            "operator": "eq",
+            "value": "application/pdf"
+        }
+        build_attachment_filter_clause(filter)
+        # Output: ('EXISTS (SELECT 1 FROM attachments WHERE message_id = messages.id AND "mimeType" = ?)', ["application/pdf"])
+    """
+    field = filter.get("field", "")
+    operator = filter.get("operator", "")
+    value = str(filter.get("value", "")).strip()
+    comparisons = {
+        "eq": "=",
+        "ne": "!=",
+        "gt": ">",
+        "lt": "<",
+        "gte": ">=",
+        "lte": "<=",
+    }
+
+    if field == "size":
+        if operator not in comparisons:
+            raise Exception(f"Invalid operator for size: {operator}")
+        return f'"sizeEstimate" {comparisons[operator]} ?', [parse_size(value)]
+
+    if field == "has_attachment":
+        if operator not in ("eq", "ne") or value.lower() not in ("true", "false"):
+            raise Exception(
+                "Invalid has_attachment filter, use eq or ne with true or false"
+            )
+        exists = (value.lower() == "true") == (operator == "eq")
+        negation = "" if exists else "NOT "
+        return (
+            f"{negation}EXISTS (SELECT 1 FROM attachments WHERE message_id = messages.id)",
+            [],
+        )
+
+    columnMap = {"attachment_name": "filename", "attachment_type": "mimeType"}
+    column = columnMap.get(field, None)
+    if column is None:
+        raise Exception(f"Invalid field: {field}")
+    negation = ""
+    if operator == "contains":
+        (sqlOperator, value) = ("LIKE", f"%{value}%")
+    elif operator == "ncontains":
+        (negation, sqlOperator, value) = ("NOT ", "LIKE", f"%{value}%")
+    elif operator == "ne":
+        (negation, sqlOperator) = ("NOT ", "=")
+    elif operator in comparisons:
+        sqlOperator = comparisons[operator]
+    else:
+        raise Exception(f"Invalid operator: {operator}")
+    return (
+        f"{negation}EXISTS (SELECT 1 FROM attachments WHERE message_id = messages.id "
+        f'AND "{column}" {sqlOperator} ?)',
+        [value],
+    )
+
+
+def parse_size(value: str) -> int:
+    """
+    Parses a size like `2048`, `500KB` or `10 MB` to bytes.
+
+    Raises:
+        Exception: If the value is not a valid size.
+    """
+    number = value.rstrip("bBkKmMgG ").strip()
+    unit = value[len(number) :].strip().lower()
+    try:
+        return int(float(number) * SIZE_UNITS[unit])
+    except (KeyError, ValueError):
+        raise Exception(f"Invalid size: {value}")
+
+
 def build_date_filter_clause(filter: RuleFilter) -> tuple[str, list]:
     """
     Builds a sql where clause based on the provided filter. This works for date comaprisions with relative dates.
 
+    Dates are compared as integer epoch seconds on the indexed receivedAt (date_received) and
+    sentAt (date_sent, the Date header) columns, so date filters are index range scans.
+    Absolute dates are converted when the rule is compiled. Relative dates are returned as a
+    {"relative": value} parameter, resolved to now - value by bind_params each time the rule runs.
+    An absolute date without a time matches the whole day (UTC) for eq and ne.
+
     Args:
         filter (RuleFilter): The filter object containing the field, operator, and value.
 
@@ -153,7 +577,7 @@ def build_date_filter_clause(filter: RuleFilter) -> tuple[str, list]:
         tuple[str, list]: A tuple containing the filter clause and a list of values to be used in the query.
 
     Raises:
-        Exception: If an invalid field or operator is provided in the filter.
+        Exception: If an invalid field, operator or value is provided in the filter.
 
     Example:
         filter = {
@@ -162,15 +586,15 @@ def build_date_filter_clause(filter: RuleFilter) -> tuple[str, list]:
             "value": "2 days"
         }
         build_date_filter_clause(filter)
-        # Output: ("internalDate > datetime('now',?)", ["-2 days"])
+        # Output: ('"receivedAt" > ?', [{"relative": "2 days"}])
     """
 
     if not filter.get("value"):
         raise Exception("Invalid value for date filter")
 
     columnMap = {
-        "date_received": "internalDate",
-        "date_sent": "internalDate",
+        "date_received": "receivedAt",
+        "date_sent": "sentAt",
     }
     operatorMap = {
         "eq": "=",
@@ -191,15 +615,79 @@ def build_date_filter_clause(filter: RuleFilter) -> tuple[str, list]:
 
     value = filter["value"].strip()
 
-    rhs = "?"
     if is_relative_date(value):
-        rhs = f"datetime('now', ?)"
-        value = f"-{value}"
+        return f'"{column}" {operator} ?', [{"relative": value}]
+
+    (timestamp, whole_day) = parse_date(value)
+    if whole_day and operator == "=":
+        return f'"{column}" >= ? AND "{column}" < ?', [timestamp, timestamp + DAY]
+    if whole_day and operator == "!=":
+        return f'("{column}" < ? OR "{column}" >= ?)', [timestamp, timestamp + DAY]
+    return f'"{column}" {operator} ?', [timestamp]
+
+
+DAY = 24 * 60 * 60
+
+
+def parse_date(value: str) -> tuple[int, bool]:
+    """
+    Parses an absolute date of the format `YYYY-MM-DD` or `YYYY-MM-DD HH:MM:SS` (UTC).
 
-    if field == "date_sent":
-        # same column name for both date_received and date_sent, but the labelIds should include SENT for date_sent
-        return f'( "{column}" {operator} {rhs} AND labelIds LIKE %"SENT"% )', [value]
-    return f'"{column}" {operator} {rhs}', [value]
+    Returns:
+        tuple[int, bool]: The epoch seconds and whether the value was a date without a time.
+
+    Raises:
+        Exception: If the value is not a valid date.
+    """
+    for format, whole_day in (("%Y-%m-%d", True), ("%Y-%m-%d %H:%M:%S", False)):
+        try:
+            date = datetime.datetime.strptime(value, format)
+        except ValueError:
+            continue
+        return int(date.replace(tzinfo=datetime.UTC).timestamp()), whole_day
+    raise Exception(f"Invalid date: {value}")
+
+
+def relative_date_to_timestamp(value: str, now: datetime.datetime) -> int:
+    """
+    Returns the epoch seconds of now minus a relative date like `2 days` or `1 month`.
+    Months and years are calendar months and years, the day is clamped to the month's length.
+    """
+    (amount, unit) = value.strip().split(" ")
+    amount = int(amount)
+    unit = unit.rstrip("s")
+    if unit in ("month", "year"):
+        months = now.year * 12 + now.month - 1 - amount * (12 if unit == "year" else 1)
+        year, month = divmod(months, 12)
+        day = min(now.day, calendar.monthrange(year, month + 1)[1])
+        return int(now.replace(year=year, month=month + 1, day=day).timestamp())
+    seconds = {"day": DAY, "hour": 3600, "minute": 60, "second": 1}[unit]
+    return int(now.timestamp()) - amount * seconds
+
+
+def bind_params(params: list, now: datetime.datetime | None = None) -> list:
+    """
+    Resolves the relative date parameters of a compiled query to epoch seconds.
+
+    Relative dates are evaluated once per call, in Python, so the query compares an indexed
+    integer column to a constant.
+
+    Args:
+        params (list): The parameters built by build_sql.
+        now (datetime, optional): The reference time. Defaults to the current time (UTC).
+
+    Returns:
+        list: The parameters ready to be bound to the query.
+    """
+    now = now or datetime.datetime.now(datetime.UTC)
+    return [
+        (
+            relative_date_to_timestamp(param["relative"], now)
+            if isinstance(param, dict) and "relative" in param
+            else param
+        )
+        for param in params
+    ]
 
 
 def is_relative_date(value: str) -> bool:
@@ -1,6 +1,6 @@
+import re
 from typing import TypedDict
 import yaml as yaml
-from jsonschema import validate
 
 
 class RuleFilter(TypedDict):
@@ -17,6 +17,12 @@ class RuleAction(TypedDict):
 class Rule(TypedDict):
     name: str
     match: str
+    # optional, "message" (default) or "thread" to apply the actions to whole conversations
+    scope: str
+    # optional for thread rules, "any" (default) or "all" messages of the thread must match
+    thread_match: str
+    # optional, "hot" (default) to match the working set, "all" to include archived messages
+    partition: str
     filters: list[RuleFilter]
     actions: list[RuleAction]
 
@@ -34,6 +40,9 @@ def load_rules(rules_file) -> list[Rule]:
     Raises:
         Exception: If the rules file is invalid.
     """
+    # deferred, jsonschema is slow to import and only needed here
+    from jsonschema import validate
+
     schema = None
     with open(SCHEMA_FILE, "r") as stream:
         schema = yaml.safe_load(stream)
@@ -44,4 +53,24 @@ def load_rules(rules_file) -> list[Rule]:
             validate(rules, schema)
         except Exception as e:
             raise Exception(f"Invalid rules file")
+    for rule in rules["rules"]:
+        validate_patterns(rule)
     return rules["rules"]
+
+
+def validate_patterns(rule: Rule):
+    """
+    Checks that the values of the matches and nmatches filters are valid regular expressions,
+    so a bad pattern fails when the rules are loaded instead of in the middle of a query.
+
+    Raises:
+        Exception: If a pattern does not compile.
+    """
+    for filter in rule.get("filters", []):
+        if filter.get("operator") in ("matches", "nmatches"):
+            try:
+                re.compile(filter.get("value", ""))
+            except re.error as e:
+                raise Exception(
+                    f"Invalid regular expression {filter.get('value')!r} in rule {rule.get('name')}: {e}"
+                )
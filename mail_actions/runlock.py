@@ -0,0 +1,251 @@
+import os as os
+import socket
+import threading
+import time
+import uuid
+from sqlite3 import connect
+from typing import TypedDict
+
+from mail_actions.metrics import metrics
+
+# seconds a lease is valid without a renewal, the holder renews it every third of that
+LEASE_TTL = 120.0
+# seconds between attempts to take a lease held by another run
+LEASE_POLL = 2.0
+# what a run does when another run holds the lease of its database
+ON_LOCKED = ("wait", "exit", "read-only")
+
+
+class Lease(TypedDict):
+    """
+    Represents the holder of a run lease.
+
+    Attributes:
+        owner (str): The unique ID of the holder, `host:pid:random`.
+        host (str): The host name of the holder.
+        pid (int): The process ID of the holder.
+        acquired_at (float): When the lease was taken, epoch seconds.
+        expires_at (float): When the lease expires unless renewed, epoch seconds.
+    """
+
+    owner: str
+    host: str
+    pid: int
+    acquired_at: float
+    expires_at: float
+
+
+def pid_alive(pid: int) -> bool:
+    """
+    Checks if a process of this host is running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running, as another user
+        return True
+    return True
+
+
+class RunLock:
+    """
+    A lease on a mailbox database, so overlapping runs (a sync outlasting the cron interval, a
+    daemon and a one-off run) don't sync and apply rules to the same database at once.
+
+    The lease is a row of the `run_leases` table of the database, taken in an immediate
+    transaction. The holder renews it from a background thread every ttl / 3 seconds, a lease
+    left by a crashed run is taken over once it expired, or right away when its process is
+    gone (same host only, pids of other hosts can't be checked).
+
+    Attributes:
+        db_path (str): The database the lease protects, and is stored in.
+        name (str): The lease name, one lease per name and database.
+        ttl (float): Seconds the lease is valid without a renewal.
+        owner (str): The unique ID of this holder.
+    """
+
+    def __init__(self, db_path: str, name: str = "run", ttl: float = LEASE_TTL):
+        self.db_path = db_path
+        self.name = name
+        self.ttl = ttl
+        self.host = socket.gethostname()
+        self.owner = f"{self.host}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.held = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self) -> "RunLock":
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def _connect(self):
+        # a connection per call, the heartbeat runs beside the mailbox connection. The
+        # timeout covers write transactions of the run holding the database
+        conn = connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS run_leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                host TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                acquired_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            """
+        )
+        return conn
+
+    def holder(self) -> Lease | None:
+        """
+        Returns the current holder of the lease, None if it is free.
+        """
+        conn = self._connect()
+        try:
+            return self._holder(conn)
+        finally:
+            conn.close()
+
+    def _holder(self, conn) -> Lease | None:
+        row = conn.execute(
+            "SELECT owner, host, pid, acquired_at, expires_at FROM run_leases WHERE name = ?",
+            (self.name,),
+        ).fetchone()
+        if row is None:
+            return None
+        return Lease(
+            owner=row[0], host=row[1], pid=row[2], acquired_at=row[3], expires_at=row[4]
+        )
+
+    def is_stale(self, lease: Lease, now: float) -> bool:
+        """
+        Checks if a lease was abandoned: expired, or held by a process of this host that is gone.
+        """
+        if lease["expires_at"] <= now:
+            return True
+        return lease["host"] == self.host and not pid_alive(lease["pid"])
+
+    def try_acquire(self, now: float | None = None) -> bool:
+        """
+        Takes the lease if it is free, stale or already held by this lock.
+
+        Returns:
+            bool: True if the lease is held by this lock.
+        """
+        now = time.time() if now is None else now
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE takes the write lock, two runs can't both see a free lease
+            conn.execute("BEGIN IMMEDIATE")
+            lease = self._holder(conn)
+            if lease is not None and lease["owner"] != self.owner:
+                if not self.is_stale(lease, now):
+                    conn.execute("ROLLBACK")
+                    return False
+                metrics.inc("run_lease_takeovers_total")
+                print(f"Taking over the stale run lease of {lease['owner']}")
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO run_leases
+                    (name, owner, host, pid, acquired_at, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (self.name, self.owner, self.host, os.getpid(), now, now + self.ttl),
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        self.held = True
+        self._start_heartbeat()
+        return True
+
+    def acquire(self, timeout: float | None = None) -> bool:
+        """
+        Takes the lease, waiting for the current holder to release it.
+
+        Args:
+            timeout (float, optional): Seconds to wait, None to wait until the lease is free,
+                0 to try once.
+
+        Returns:
+            bool: True if the lease was taken, False if it was still held after the timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with metrics.timer("run_lease_wait_seconds"):
+            while not self.try_acquire():
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                delay = LEASE_POLL
+                if deadline is not None:
+                    delay = min(delay, max(deadline - time.time(), 0))
+                time.sleep(delay)
+        return True
+
+    def renew(self) -> bool:
+        """
+        Extends the lease by ttl seconds.
+
+        Returns:
+            bool: False if the lease was lost, taken over by another run after it expired.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE run_leases SET expires_at = ? WHERE name = ? AND owner = ?",
+                (now + self.ttl, self.name, self.owner),
+            )
+            renewed = cursor.rowcount == 1
+        finally:
+            conn.close()
+        if not renewed:
+            self.held = False
+            metrics.inc("run_lease_lost_total")
+            print("Run lease lost, another run took it over")
+        return renewed
+
+    def release(self):
+        """
+        Gives up the lease, if held.
+        """
+        self._stop_heartbeat()
+        if not self.held:
+            return
+        conn = self._connect()
+        try:
+            conn.execute(
+                "DELETE FROM run_leases WHERE name = ? AND owner = ?",
+                (self.name, self.owner),
+            )
+        finally:
+            conn.close()
+        self.held = False
+
+    def _start_heartbeat(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._heartbeat, name="run-lease", daemon=True
+        )
+        self._thread.start()
+
+    def _stop_heartbeat(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                if not self.renew():
+                    return
+            except Exception as e:
+                # a busy database, the next renewal is still ahead of the expiry
+                print(f"Run lease renewal failed: {e}")
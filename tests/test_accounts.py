@@ -0,0 +1,161 @@
+import pytest
+from benchmarks.fake_service import FakeGMailService
+from mail_actions.accounts import (
+    MAX_CONCURRENCY_PER_ACCOUNT,
+    load_accounts,
+    print_summary,
+    run_account,
+    run_accounts,
+)
+from mail_actions.gmail.mailbox import BACKFILL_BATCH, MailBox
+from mail_actions.gmail.service import MAX_RETRIES
+
+RULES = """
+rules:
+  - name: "Read GitHub"
+    match: "all"
+    filters:
+      - field: "from"
+        operator: "contains"
+        value: "github.com"
+    actions:
+      - type: "read"
+"""
+
+
+def write_accounts(tmp_path, body):
+    path = tmp_path / "accounts.yaml"
+    path.write_text(body)
+    return str(path)
+
+
+def test_load_accounts(tmp_path):
+    path = write_accounts(
+        tmp_path,
+        """
+max_workers: 3
+rules: shared.yaml
+accounts:
+  - name: personal
+  - name: work
+    token: tokens/work.json
+    db: work.db
+    rules: work.yaml
+    concurrency: 100
+    cold_db: work.cold.db
+    retention_days: 365
+    sync_window: 30
+    max_retries: 2
+""",
+    )
+    accounts, workers = load_accounts(path)
+    assert workers == 3
+    assert accounts[0] == {
+        "name": "personal",
+        "token": "personal.token.json",
+        "db": "personal.db",
+        "rules": "shared.yaml",
+        "concurrency": 1,
+        "storage": {
+            "cold_db_path": None,
+            "retention_days": None,
+            "retention_mode": "cold",
+            "sync_window_days": None,
+            "backfill_batch": BACKFILL_BATCH,
+        },
+        "max_retries": MAX_RETRIES,
+    }
+    assert accounts[1]["rules"] == "work.yaml"
+    assert accounts[1]["concurrency"] == MAX_CONCURRENCY_PER_ACCOUNT
+    assert accounts[1]["storage"]["cold_db_path"] == "work.cold.db"
+    assert accounts[1]["storage"]["retention_days"] == 365
+    assert accounts[1]["storage"]["sync_window_days"] == 30
+    assert accounts[1]["max_retries"] == 2
+
+
+def test_load_accounts_rejects_retention_without_cold_db(tmp_path):
+    path = write_accounts(
+        tmp_path,
+        """
+accounts:
+  - name: a
+    retention_days: 365
+""",
+    )
+    with pytest.raises(Exception, match="cold_db"):
+        load_accounts(path)
+
+
+def test_load_accounts_rejects_shared_database(tmp_path):
+    path = write_accounts(
+        tmp_path,
+        """
+accounts:
+  - name: a
+    db: store.db
+  - name: b
+    db: store.db
+""",
+    )
+    with pytest.raises(Exception):
+        load_accounts(path)
+
+
+def test_load_accounts_without_accounts(tmp_path):
+    with pytest.raises(Exception):
+        load_accounts(write_accounts(tmp_path, "max_workers: 2\n"))
+
+
+def test_run_account(tmp_path, mocker):
+    rules = tmp_path / "rules.yaml"
+    rules.write_text(RULES)
+    creds = mocker.Mock(valid=True, expiry=None)
+    mocker.patch("mail_actions.auth.get_saved_credentials", return_value=creds)
+    service = FakeGMailService(30)
+    mocker.patch("mail_actions.gmail.service.GMailService", return_value=service)
+
+    summary = run_account(
+        {
+            "name": "personal",
+            "token": str(tmp_path / "token.json"),
+            "db": str(tmp_path / "personal.db"),
+            "rules": str(rules),
+            "concurrency": 2,
+        }
+    )
+
+    assert summary["ok"], summary["error"]
+    assert summary["messages"] == 30
+    assert summary["new_messages"] == 30
+    assert summary["api_calls"] == sum(service.calls.values())
+    assert summary["quota_units"] > 0
+    # the daily maintenance ran, with ANALYZE for the optimizer
+    mailbox = MailBox(service, db_path=str(tmp_path / "personal.db"))
+    assert mailbox.get_state("lastMaintenanceAt") is not None
+    assert (
+        mailbox.connection().execute("SELECT COUNT(*) FROM sqlite_stat1").fetchone()[0]
+    )
+    mailbox.close()
+
+
+def test_run_accounts_reports_failures(tmp_path, capsys):
+    rules = tmp_path / "rules.yaml"
+    rules.write_text(RULES)
+    accounts = [
+        {
+            "name": name,
+            "token": str(tmp_path / f"{name}.json"),
+            "db": str(tmp_path / f"{name}.db"),
+            "rules": str(rules),
+            "concurrency": 1,
+        }
+        for name in ("a", "b", "c")
+    ]
+    summaries = run_accounts(accounts, max_workers=2)
+
+    assert [summary["name"] for summary in summaries] == ["a", "b", "c"]
+    assert not any(summary["ok"] for summary in summaries)
+    assert "not found" in summaries[0]["error"]
+
+    print_summary(summaries)
+    assert "3 failed" in capsys.readouterr().out
@@ -1,7 +1,16 @@
+import datetime
 import pytest
+import threading
+import time
 import unittest.mock as mocker
 import json
-from mail_actions.auth import get_credentials, save_credentials, get_saved_credentials
+from google.oauth2.credentials import Credentials
+from mail_actions.auth import (
+    CredentialManager,
+    get_credentials,
+    save_credentials,
+    get_saved_credentials,
+)
 
 
 def test_save_credentials(tmp_path):
@@ -43,3 +52,87 @@ def test_get_saved_credentials(tmp_path):
     assert creds.refresh_token == "mock_token"
     assert creds.client_id == "mock_id"
     assert creds.client_secret == "secret"
+
+
+def test_save_credentials_replaces_the_file_atomically(tmp_path):
+    token_file = tmp_path / "token.json"
+    token_file.write_text('{"access_token": "old"}')
+    broken = mocker.Mock()
+    broken.to_json.return_value = "not json"
+
+    with pytest.raises(ValueError):
+        save_credentials(broken, str(token_file))
+
+    assert json.loads(token_file.read_text()) == {"access_token": "old"}
+    assert [path.name for path in tmp_path.iterdir()] == ["token.json"]
+
+
+def expiring_credentials(token_file, minutes: int) -> Credentials:
+    creds = Credentials(
+        token="old",
+        refresh_token="refresh",
+        client_id="id",
+        client_secret="secret",
+        token_uri="https://oauth2.googleapis.com/token",
+        expiry=datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        + datetime.timedelta(minutes=minutes),
+    )
+    save_credentials(creds, str(token_file))
+    return creds
+
+
+def fake_refresh(creds, request):
+    time.sleep(0.05)
+    creds.token = "new"
+    creds.expiry = datetime.datetime.now(datetime.timezone.utc).replace(
+        tzinfo=None
+    ) + datetime.timedelta(hours=1)
+
+
+def test_credential_manager_shares_one_refresh(tmp_path):
+    token_file = tmp_path / "token.json"
+    manager = CredentialManager(str(token_file), expiring_credentials(token_file, 2))
+    assert manager.expiring()
+    with mocker.patch.object(
+        Credentials, "refresh", autospec=True, side_effect=fake_refresh
+    ) as refresh:
+        threads = [threading.Thread(target=manager.ensure_fresh) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert refresh.call_count == 1
+    assert not manager.expiring()
+    assert json.loads(token_file.read_text())["token"] == "new"
+
+
+def test_credential_manager_reuses_a_token_refreshed_by_another_process(tmp_path):
+    token_file = tmp_path / "token.json"
+    manager = CredentialManager(str(token_file), expiring_credentials(token_file, -1))
+    other = get_saved_credentials(str(token_file))
+    fake_refresh(other, None)
+    save_credentials(other, str(token_file))
+
+    with mocker.patch.object(Credentials, "refresh", autospec=True) as refresh:
+        manager.ensure_fresh()
+
+    refresh.assert_not_called()
+    assert manager.credentials.token == "new"
+
+
+def test_credential_manager_refreshes_ahead_of_expiry(tmp_path):
+    token_file = tmp_path / "token.json"
+    creds = expiring_credentials(token_file, 10)
+    manager = CredentialManager(str(token_file), creds, margin=10 * 60 - 0.2)
+    assert not manager.expiring()
+    with mocker.patch.object(
+        Credentials, "refresh", autospec=True, side_effect=fake_refresh
+    ) as refresh:
+        with manager:
+            deadline = time.time() + 5
+            while creds.token != "new" and time.time() < deadline:
+                time.sleep(0.05)
+
+    assert refresh.call_count == 1
+    assert creds.token == "new"
@@ -0,0 +1,86 @@
+import pytest
+from benchmarks.fake_service import FakeGMailService, index_of, message_id
+from benchmarks.bench_matcher import run as run_matcher
+from benchmarks.bench_rows import run
+from benchmarks.bench_sync import run_size
+from mail_actions.gmail.mailbox import MailBox
+
+
+def test_fake_service_listing():
+    service = FakeGMailService(1200)
+
+    first = service.get_message_list(maxResults=500)
+    assert len(first["messages"]) == 500
+    assert first["nextPageToken"] == "500"
+    # newest message is listed first
+    assert first["messages"][0]["id"] == message_id(1199)
+
+    last = service.get_message_list(maxResults=500, pageToken="1000")
+    assert len(last["messages"]) == 200
+    assert "nextPageToken" not in last
+    assert service.calls["messages.list"] == 2
+
+
+def test_fake_service_messages_are_deterministic():
+    service = FakeGMailService(10)
+    msg = service.get_message(message_id(3))
+    assert index_of(msg["id"]) == 3
+    assert msg == FakeGMailService(10).get_message(message_id(3))
+
+    service.update_labels(msg["id"], ["Label_1"], ["INBOX"])
+    labels = service.get_message(msg["id"])["labelIds"]
+    assert "Label_1" in labels
+    assert "INBOX" not in labels
+
+
+def test_fake_service_error_injection():
+    service = FakeGMailService(10, error_rate=1.0, max_retries=2)
+    with pytest.raises(Exception):
+        service.get_profile()
+    assert service.errors["getProfile"] == 3
+
+
+def test_mailbox_sync_with_fake_service(tmp_path):
+    service = FakeGMailService(50)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"), scan_limit=0)
+    mailbox.init_db()
+    mailbox.sync()
+    assert mailbox.get_stats()["totalMessages"] == 50
+
+    service.add_messages(5)
+    service.remove_messages(3)
+    mailbox.sync()
+    assert mailbox.get_stats()["totalMessages"] == 52
+
+
+def test_run_size(tmp_path):
+    results = run_size(40, 0.0, 0.0, str(tmp_path))
+    assert [r["scenario"] for r in results] == [
+        "full_sync",
+        "incremental_sync",
+        "apply_rules",
+        "bulk_delete",
+    ]
+    assert results[0]["items"] == 40
+    assert all(r["api_retries"] == {} for r in results)
+
+
+def test_run_size_retries_injected_errors(tmp_path):
+    results = run_size(200, 0.0, 0.05, str(tmp_path))
+    (full_sync, *_) = results
+    assert full_sync["items"] == 200
+    assert sum(full_sync["api_errors"].values()) > 0
+    assert full_sync["api_retries"] == full_sync["api_errors"]
+    assert all(r["api_failures"] == {} for r in results)
+
+
+def test_bench_rows(tmp_path):
+    results = run(30, str(tmp_path), memory=False)
+    assert [r["representation"] for r in results] == ["row", "dict"]
+    assert all(r["rows"] == 30 for r in results)
+
+
+def test_bench_matcher(tmp_path):
+    (result,) = run_matcher(60, [20], str(tmp_path))
+    assert result["rules"] == 20
+    assert result["matches"] == result["index_matches"] > 0
@@ -0,0 +1,224 @@
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+import pytest
+from benchmarks.fake_service import (
+    FAKE_START_MS,
+    INTERVAL_MS,
+    FakeGMailService,
+    message_id,
+)
+from google.oauth2.credentials import Credentials
+from mail_actions.gmail.cassette import (
+    RecordingTransport,
+    ReplayTransport,
+    copy_database,
+    sanitize_text,
+    snapshot_path,
+)
+from mail_actions.gmail.mailbox import MailBox
+from mail_actions.gmail.service import GMailService
+from mail_actions.runlock import RunLock
+
+MESSAGE = {
+    "id": "18f0000000000001",
+    "threadId": "18f0000000000001",
+    "snippet": "Your code is 123456",
+    "payload": {
+        "headers": [
+            {"name": "Delivered-To", "value": "bob@example.org"},
+            {"name": "Received", "value": "from mx.example.com by mail.example.org"},
+            {"name": "From", "value": '"Alice Liddell" <alice@example.com>'},
+            {"name": "Cc", "value": "Carol <carol@example.com>, dave@example.com"},
+            {"name": "Subject", "value": "Sign in"},
+        ],
+        "body": {"size": 12, "data": "WW91ciBjb2RlIGlzIDEyMzQ1Ng=="},
+    },
+}
+
+
+class StubTransport:
+    """
+    Answers every request with a message, recording the requests it got.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.closed = False
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        self.requests.append((method, uri, headers))
+        resp = httplib2.Response({"status": "200", "content-type": "application/json"})
+        return (resp, json.dumps(MESSAGE).encode())
+
+    def close(self):
+        self.closed = True
+
+
+def test_record_sanitizes_and_replays_offline(tmp_path):
+    cassette = str(tmp_path / "session.jsonl")
+    stub = StubTransport()
+    recording = RecordingTransport(stub, cassette)
+    service = GMailService(Credentials(token="secret-token"), transport=recording)
+    recorded = service.get_message("18f0000000000001")
+    service.close()
+    assert stub.closed
+    assert (
+        recorded["payload"]["headers"][2]["value"]
+        == '"Alice Liddell" <alice@example.com>'
+    )
+
+    text = open(cassette).read()
+    assert "secret-token" not in text
+    assert "alice@example.com" not in text
+    assert "WW91ciBjb2RlIGlzIDEyMzQ1Ng==" not in text
+    assert "123456" not in text
+    assert "Alice" not in text and "Carol" not in text
+    assert "Received" not in text and "mx.example.com" not in text
+    assert "Delivered-To" not in text and "bob" not in text
+    assert sanitize_text("alice@example.com") in text
+
+    replay = ReplayTransport(cassette, latency=0)
+    service = GMailService(Credentials(token="replay"), transport=replay)
+    replayed = service.get_message("18f0000000000001")
+    alice = sanitize_text("alice@example.com")
+    carol = sanitize_text("carol@example.com")
+    headers = {
+        header["name"]: header["value"] for header in replayed["payload"]["headers"]
+    }
+    assert headers == {
+        "From": f"{alice.split('@')[0]} <{alice}>",
+        "Cc": f"{carol.split('@')[0]} <{carol}>, {sanitize_text('dave@example.com')}",
+        "Subject": "Sign in",
+    }
+    assert replayed["payload"]["body"]["size"] == 12
+    assert replay.remaining() == 0
+    # each interaction is replayed once
+    with pytest.raises(Exception, match="No recorded response"):
+        service.get_message("18f0000000000001")
+
+
+def test_replay_scales_recorded_latency(tmp_path):
+    cassette = tmp_path / "session.jsonl"
+    interaction = {
+        "method": "GET",
+        "uri": "https://gmail.googleapis.com/gmail/v1/users/me/profile?alt=json",
+        "body": None,
+        "status": 200,
+        "headers": {"content-type": "application/json"},
+        "content": '{"emailAddress": "user@example.com", "historyId": "1000"}',
+        "seconds": 0.5,
+    }
+    cassette.write_text(json.dumps(interaction) + "\n")
+    service = GMailService(
+        Credentials(token="replay"),
+        transport=ReplayTransport(str(cassette), latency=0.1),
+    )
+    start = time.perf_counter()
+    profile = service.get_profile()
+    elapsed = time.perf_counter() - start
+    assert profile["historyId"] == "1000"
+    assert 0.05 <= elapsed < 0.5
+
+
+def test_sanitize_text_is_stable():
+    once = sanitize_text("from:alice@example.com to:bob@mail.example.org")
+    assert "alice" not in once and "bob" not in once
+    assert once.endswith("@mail.example.org")
+    assert sanitize_text(once) == once
+    assert sanitize_text("from:alice@example.com") == once.split(" ")[0]
+
+
+def test_sanitize_text_is_linear():
+    body = "eHh4" * 250_000
+    start = time.perf_counter()
+    assert sanitize_text(body + " alice@example.com") != body + " alice@example.com"
+    assert time.perf_counter() - start < 1
+
+
+def test_snapshot_restores_database_without_leases(tmp_path):
+    store = str(tmp_path / "store.db")
+    replay_db = str(tmp_path / "replay.db")
+    snapshot = snapshot_path(str(tmp_path / "session.jsonl"))
+    with sqlite3.connect(store) as conn:
+        conn.execute("CREATE TABLE messages (id TEXT)")
+        conn.execute("INSERT INTO messages VALUES ('18f0000000000001')")
+    with RunLock(store):
+        copy_database(store, snapshot)
+    copy_database(snapshot, replay_db)
+    with sqlite3.connect(replay_db) as conn:
+        assert conn.execute("SELECT id FROM messages").fetchall() == [
+            ("18f0000000000001",)
+        ]
+        tables = conn.execute("SELECT name FROM sqlite_master").fetchall()
+        assert ("run_leases",) not in tables
+
+    # a cassette recorded before the first run replays against an empty database
+    copy_database(str(tmp_path / "missing.db"), replay_db)
+    with sqlite3.connect(replay_db) as conn:
+        assert conn.execute("SELECT name FROM sqlite_master").fetchall() == []
+
+
+class FakeApiTransport(StubTransport):
+    """
+    Answers the messages.list and messages.get requests from a FakeGMailService.
+    """
+
+    def __init__(self, fake: FakeGMailService):
+        super().__init__()
+        self.fake = fake
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        url = urlparse(uri)
+        params = {key: values[0] for (key, values) in parse_qs(url.query).items()}
+        path = url.path.split("/users/me/")[1]
+        if path == "messages":
+            response = self.fake.get_message_list(
+                maxResults=int(params.get("maxResults", 100)),
+                pageToken=params.get("pageToken"),
+                q=params.get("q"),
+            )
+        else:
+            response = self.fake.get_message(path.split("/")[1])
+        resp = httplib2.Response({"status": "200", "content-type": "application/json"})
+        return (resp, json.dumps(response).encode())
+
+
+def windowed_run(transport, db_path: str) -> MailBox:
+    mailbox = MailBox(
+        GMailService(Credentials(token="token"), transport=transport),
+        db_path=db_path,
+        scan_limit=0,
+        sync_window_days=1,
+        backfill_batch=100,
+    )
+    mailbox.init_db()
+    mailbox.sync()
+    mailbox.backfill()
+    mailbox.close()
+    return mailbox
+
+
+def test_windowed_sync_and_backfill_replay(tmp_path, monkeypatch):
+    # a clock a minute after the newest of 400 messages, a day holds 288 messages
+    now = (FAKE_START_MS + 399 * INTERVAL_MS) / 1000 + 60
+    monkeypatch.setattr(time, "time", lambda: now)
+    cassette = str(tmp_path / "session.jsonl")
+    recording = RecordingTransport(FakeApiTransport(FakeGMailService(400)), cassette)
+    windowed_run(recording, str(tmp_path / "store.db"))
+    recording.close()
+
+    # replayed an hour later, the requests of the backfill do not depend on the clock
+    monkeypatch.setattr(time, "time", lambda: now + 3600)
+    replay = ReplayTransport(cassette, latency=0)
+    mailbox = windowed_run(replay, str(tmp_path / "replay.db"))
+    assert replay.remaining() == 0
+    assert mailbox.scan_db() == {message_id(i) for i in range(400)}
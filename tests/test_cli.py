@@ -0,0 +1,81 @@
+import json
+import sqlite3
+
+import pytest
+from mail_actions.cli import (
+    build_service,
+    http_options,
+    open_transport,
+    parse_args,
+    restore_snapshot,
+)
+from mail_actions.gmail.cassette import snapshot_path
+from mail_actions.gmail.service import MAX_RETRIES
+from mail_actions.metrics import metrics
+from mail_actions.runlock import RunLock
+
+PROFILE_URI = "https://gmail.googleapis.com/gmail/v1/users/me/profile?alt=json"
+
+
+def interaction(status: int, content: str) -> str:
+    return json.dumps(
+        {
+            "method": "GET",
+            "uri": PROFILE_URI,
+            "body": None,
+            "status": status,
+            "headers": {"content-type": "application/json"},
+            "content": content,
+            "seconds": 0.0,
+        }
+    )
+
+
+def test_failed_requests_are_retried(tmp_path, mocker):
+    sleep = mocker.patch("mail_actions.gmail.service.time.sleep")
+    cassette = tmp_path / "session.jsonl"
+    error = '{"error": {"code": 503, "message": "Backend Error"}}'
+    profile = '{"emailAddress": "user@example.com", "historyId": "1000"}'
+    cassette.write_text(
+        "\n".join([interaction(503, error), interaction(200, profile)]) + "\n"
+    )
+    metrics.reset()
+    argv = ["--replay", str(cassette), "--replay-latency", "0"]
+    http = http_options(parse_args([*argv, "--db", str(tmp_path / "replay.db")]))
+    service = build_service(*open_transport(http), http)
+    assert service.max_retries == MAX_RETRIES
+
+    assert service.get_profile()["historyId"] == "1000"
+    assert sleep.call_count == 1
+    data = metrics.to_dict()
+    assert data["counters"]["gmail_api_retries_total"][0]["value"] == 1
+
+
+def test_max_retries_option():
+    http = http_options(parse_args(["--max-retries", "0"]))
+    assert (
+        build_service(*open_transport({"replay": "/dev/null"}), http).max_retries == 0
+    )
+
+
+def test_restore_snapshot_skips_leased_database(tmp_path):
+    cassette = str(tmp_path / "session.jsonl")
+    with sqlite3.connect(snapshot_path(cassette)) as conn:
+        conn.execute("CREATE TABLE messages (id TEXT)")
+    db = str(tmp_path / "replay.db")
+    args = parse_args(["--replay", cassette, "--db", db])
+
+    with RunLock(db) as lock:
+        assert lock.try_acquire()
+        with pytest.raises(SystemExit, match="Another run is using"):
+            restore_snapshot(args)
+        assert lock.renew()
+    with sqlite3.connect(db) as conn:
+        tables = [name for (name,) in conn.execute("SELECT name FROM sqlite_master")]
+    assert "messages" not in tables
+
+    restore_snapshot(args)
+    with sqlite3.connect(db) as conn:
+        tables = [name for (name,) in conn.execute("SELECT name FROM sqlite_master")]
+    assert "messages" in tables
+    assert RunLock(db).holder() is None
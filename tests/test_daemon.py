@@ -0,0 +1,92 @@
+import threading
+import pytest
+from benchmarks.fake_service import FakeGMailService
+import mail_actions.ruleparser as ruleparser
+from mail_actions.daemon import Daemon
+from mail_actions.gmail.mailbox import MailBox
+
+RULES = """
+rules:
+  - name: "Read GitHub"
+    match: "all"
+    filters:
+      - field: "from"
+        operator: "contains"
+        value: "github.com"
+    actions:
+      - type: "read"
+"""
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    rules_file = tmp_path / "rules.yaml"
+    rules_file.write_text(RULES)
+    service = FakeGMailService(20)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"))
+    mailbox.init_db()
+    return Daemon(mailbox, service, str(rules_file), interval=60)
+
+
+def test_first_poll_runs_full_sync(daemon):
+    historyId = daemon.service.historyId
+    assert daemon.poll() is None
+    assert daemon.mailbox.get_stats()["totalMessages"] == 20
+    assert daemon.mailbox.get_state("historyId") == str(historyId)
+
+
+def test_poll_applies_rules_to_new_messages_only(daemon):
+    service = daemon.service
+    daemon.poll()
+    daemon.poll()
+    get_calls = service.calls["messages.get"]
+
+    added = service.add_messages(8)
+    removed = service.remove_messages(2)
+    changed = daemon.poll()
+
+    assert set(added) <= changed
+    assert daemon.mailbox.get_stats()["totalMessages"] == 26
+    assert not daemon.mailbox.scan_db() & set(removed)
+    # only the changed messages were fetched, plus refetches after rule actions
+    assert service.calls["messages.get"] - get_calls >= len(added)
+    assert service.calls["messages.list"] == 1
+    for id in added:
+        message = service.get_message(id)
+        sender = next(h for h in message["payload"]["headers"] if h["name"] == "From")
+        if "github.com" in sender["value"]:
+            assert "UNREAD" not in message["labelIds"]
+
+
+def test_poll_without_changes(daemon):
+    daemon.poll()
+    # the second poll sees the label changes made by the rules of the first one
+    daemon.poll()
+    assert daemon.poll() == set()
+
+
+def test_expired_history_falls_back_to_full_sync(daemon):
+    daemon.poll()
+    daemon.mailbox.set_state("historyId", "1")
+    assert daemon.poll() is None
+
+
+def test_rules_are_reloaded_only_when_changed(daemon, mocker):
+    parse = mocker.spy(ruleparser, "load_rules")
+    first = daemon.load_rules()
+    assert daemon.load_rules() is first
+    assert parse.call_count == 1
+
+    with open(daemon.rules_file, "a") as f:
+        f.write("\n# changed\n")
+    daemon.load_rules()
+    assert parse.call_count == 2
+
+
+def test_run_stops_gracefully(daemon):
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    daemon.notify()
+    daemon.stop()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
@@ -0,0 +1,98 @@
+import json
+
+import pytest
+from benchmarks.fake_service import FakeGMailService
+from mail_actions.dispatcher import Dispatcher, coalesce
+from mail_actions.gmail.mailbox import MailBox
+
+
+@pytest.fixture
+def mailbox(tmp_path):
+    service = FakeGMailService(12)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"))
+    mailbox.init_db()
+    mailbox.sync()
+    service.calls.clear()
+    return mailbox
+
+
+def labels(mailbox: MailBox, id: str) -> list[str]:
+    (labelIds,) = (
+        mailbox.connection()
+        .execute("SELECT labelIds FROM messages WHERE id=?", (id,))
+        .fetchone()
+    )
+    return json.loads(labelIds)
+
+
+def test_coalesce():
+    entries = [
+        (1, "message", "a", ["Label_1"], ["INBOX"], 0),
+        (2, "message", "a", [], ["Label_1"], 0),
+        (3, "message", "b", ["UNREAD"], [], 0),
+        (4, "message", "b", [], ["UNREAD"], 0),
+    ]
+    assert coalesce(entries) == {
+        ("message", "a"): (set(), {"INBOX", "Label_1"}, [1, 2]),
+        ("message", "b"): (set(), {"UNREAD"}, [3, 4]),
+    }
+
+
+def test_drain_batches_and_updates_local_labels(mailbox):
+    service = mailbox.gmail_service
+    ids = sorted(mailbox.scan_db())
+    mailbox.enqueue_label_changes("message", ids, [(["Label_3"], ["INBOX"])])
+    # cancelled by the second change, nothing is sent for this message
+    mailbox.enqueue_label_changes(
+        "message", ids[:1], [(["UNREAD"], []), ([], ["UNREAD"])]
+    )
+
+    summary = Dispatcher(mailbox, service, batch_size=5).drain()
+    assert summary == {"sent": 14, "pending": 0, "failed": 0}
+    # 11 messages share one change, 1 has its own, in batches of 5
+    assert service.calls == {"messages.batchModify": 4}
+    for id in ids:
+        assert "Label_3" in labels(mailbox, id)
+        assert "INBOX" not in labels(mailbox, id)
+        assert service.labels_of(int(id, 16) - int(ids[0], 16)) == labels(mailbox, id)
+
+
+def test_failed_sends_are_retried(mailbox):
+    service = mailbox.gmail_service
+    ids = sorted(mailbox.scan_db())[:3]
+    mailbox.enqueue_label_changes("message", ids, [([], ["UNREAD"])])
+    service.error_rate = 1.0
+    dispatcher = Dispatcher(mailbox, service, backoff=0.0, max_attempts=3)
+    assert dispatcher.drain() == {"sent": 0, "pending": 3, "failed": 0}
+
+    # a new dispatcher, as after a crash, picks up the pending changes
+    service.error_rate = 0.0
+    assert Dispatcher(mailbox, service).drain() == {
+        "sent": 3,
+        "pending": 0,
+        "failed": 0,
+    }
+    assert all("UNREAD" not in labels(mailbox, id) for id in ids)
+
+
+def test_sends_are_marked_failed_after_max_attempts(mailbox):
+    service = mailbox.gmail_service
+    ids = sorted(mailbox.scan_db())[:2]
+    mailbox.enqueue_label_changes("message", ids, [(["UNREAD"], [])])
+    service.error_rate = 1.0
+    # every attempt of the dispatcher is a single call
+    service.max_retries = 0
+    dispatcher = Dispatcher(mailbox, service, backoff=0.0, max_attempts=2)
+    assert dispatcher.drain(wait=True) == {"sent": 0, "pending": 0, "failed": 2}
+    assert service.calls["messages.batchModify"] == 2
+
+
+def test_backing_off_changes_hold_newer_ones(mailbox):
+    service = mailbox.gmail_service
+    [id] = sorted(mailbox.scan_db())[:1]
+    mailbox.enqueue_label_changes("message", [id], [(["UNREAD"], [])])
+    service.error_rate = 1.0
+    Dispatcher(mailbox, service, backoff=60.0).drain()
+    service.error_rate = 0.0
+    mailbox.enqueue_label_changes("message", [id], [([], ["UNREAD"])])
+    assert Dispatcher(mailbox, service).drain()["sent"] == 0
@@ -0,0 +1,166 @@
+import json
+import time
+from email.message import EmailMessage
+
+from benchmarks.fake_service import FakeGMailService, message_id
+from mail_actions.gmail.mailbox import MailBox
+from mail_actions.importer import (
+    SYSTEM_LABELS,
+    import_mbox,
+    iter_mbox,
+    parse_labels,
+    parse_separator,
+    user_labels,
+)
+
+LABEL_NAMES = {id: name for (name, id) in SYSTEM_LABELS.items()}
+
+
+def export(service: FakeGMailService, path, indexes, extra: bytes = b""):
+    """
+    Writes the given messages of the fake service as a Takeout style mbox file.
+    """
+    names = {id: name for (name, id) in user_labels(service).items()}
+    with open(path, "wb") as f:
+        for index in indexes:
+            msg = service.build_message(index)
+            headers = {h["name"]: h["value"] for h in msg["payload"]["headers"]}
+            email = EmailMessage()
+            email["X-GM-THRID"] = str(int(msg["threadId"], 16))
+            email["X-Gmail-Labels"] = ",".join(
+                LABEL_NAMES.get(id) or names[id] for id in msg["labelIds"]
+            )
+            for name in ("From", "To", "Subject", "Date"):
+                email[name] = headers[name]
+            email.set_content(f"Hello,\nFrom the export of {msg['id']}\n")
+            date = time.strftime(
+                "%a %b %d %H:%M:%S +0000 %Y",
+                time.gmtime(int(msg["internalDate"]) / 1000),
+            )
+            f.write(f"From {int(msg['id'], 16)}@xxx {date}\n".encode())
+            f.write(email.as_bytes().replace(b"\nFrom ", b"\n>From "))
+            f.write(b"\n")
+        f.write(extra)
+
+
+def test_parse_separator():
+    (id, internalDate) = parse_separator(
+        b"From 1670744183473958209@xxx Thu Jun 16 12:34:56 +0000 2022"
+    )
+    assert id == format(1670744183473958209, "x")
+    assert internalDate == 1655382896000
+    assert parse_separator(b"From someone@example.com Thu Jun 16 2022") == (None, None)
+
+
+def test_parse_labels():
+    labels = {"Receipts": "Label_1", "Work, Team": "Label_9"}
+    assert parse_labels('Inbox,Unread,Receipts,"Work, Team",Opened', labels) == (
+        ["INBOX", "UNREAD", "Label_1", "Label_9"],
+        False,
+    )
+    assert parse_labels("Trash,Receipts", labels)[1] is True
+    assert parse_labels("Deleted label", labels) == ([], False)
+
+
+def test_iter_mbox_unquotes_from_lines(tmp_path):
+    path = tmp_path / "export.mbox"
+    path.write_bytes(
+        b"From 1@xxx Thu Jun 16 12:34:56 +0000 2022\nSubject: a\n\n>From here\n"
+        b"From 2@xxx Thu Jun 16 12:34:57 +0000 2022\nSubject: b\n\nbody\n"
+    )
+    messages = list(iter_mbox(str(path)))
+    assert [separator.split()[1] for (separator, _) in messages] == [b"1@xxx", b"2@xxx"]
+    assert messages[0][1].endswith(b"\nFrom here\n")
+
+
+def test_import_then_sync_fetches_only_the_delta(tmp_path):
+    service = FakeGMailService(20)
+    path = tmp_path / "export.mbox"
+    spam = b"From 42@xxx Thu Jun 16 12:34:56 +0000 2022\nX-Gmail-Labels: Spam\n\nspam\n"
+    export(service, path, range(20), extra=spam)
+    # mail received and deleted after the export
+    service.add_messages(5)
+    service.remove_messages(3)
+
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"), scan_limit=0)
+    mailbox.init_db()
+    summary = import_mbox(mailbox, str(path), user_labels(service), batch_size=8)
+    assert summary == {"read": 21, "imported": 20, "existing": 0, "skipped": 1}
+
+    row = (
+        mailbox.connection()
+        .execute(
+            'SELECT threadId, labelIds, "from" FROM messages WHERE id = ?',
+            (message_id(4),),
+        )
+        .fetchone()
+    )
+    expected = service.build_message(4)
+    assert row[0] == expected["threadId"]
+    assert sorted(json.loads(row[1])) == sorted(expected["labelIds"])
+    assert row[2] is not None
+    (text,) = (
+        mailbox.connection()
+        .execute("SELECT text FROM bodies WHERE message_id = ?", (message_id(4),))
+        .fetchone()
+    )
+    assert f"From the export of {message_id(4)}" in text
+
+    mailbox.sync()
+    assert service.calls["messages.get"] == 5
+    assert mailbox.get_stats()["totalMessages"] == 22
+
+    # importing again leaves the stored messages alone, the ones deleted since the export
+    # come back until the next sync
+    summary = import_mbox(mailbox, str(path), user_labels(service))
+    assert summary["imported"] == 3
+    assert summary["existing"] == 17
+
+
+def test_import_decodes_bodies_in_their_charset(tmp_path):
+    service = FakeGMailService(1)
+    path = tmp_path / "export.mbox"
+    path.write_bytes(
+        b"From 1670744183473958209@xxx Thu Jun 16 12:34:56 +0000 2022\n"
+        b"Subject: Menu\n"
+        b"Content-Type: text/plain; charset=iso-8859-1\n"
+        b"Content-Transfer-Encoding: quoted-printable\n\n"
+        b"Caf=E9 cr=E8me\n"
+    )
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"), scan_limit=0)
+    mailbox.init_db()
+    assert import_mbox(mailbox, str(path), {})["imported"] == 1
+
+    id = format(1670744183473958209, "x")
+    conn = mailbox.connection()
+    (text,) = conn.execute(
+        "SELECT text FROM bodies WHERE message_id = ?", (id,)
+    ).fetchone()
+    (snippet,) = conn.execute(
+        "SELECT snippet FROM messages WHERE id = ?", (id,)
+    ).fetchone()
+    assert text.strip() == "Café crème"
+    assert snippet == "Café crème"
+
+
+def test_sync_after_import_keeps_messages_beyond_scan_limit(tmp_path):
+    service = FakeGMailService(10_100)
+    path = tmp_path / "export.mbox"
+    # an export of the oldest mail, which the default scan_limit (the newest 10000) misses
+    export(service, path, range(100))
+    service.add_messages(5)
+    deleted = message_id(10_099)
+    service.indexes.remove(10_099)
+
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"))
+    mailbox.init_db()
+    import_mbox(mailbox, str(path), user_labels(service))
+    # the newer mail, as stored by an earlier sync
+    mailbox.save_messages(service.build_message(i) for i in range(100, 10_100))
+    mailbox.sync()
+    assert service.calls["messages.get"] == 5
+    ids = mailbox.scan_db()
+    assert {message_id(i) for i in range(100)} <= ids
+    # deletions are still applied within the listing
+    assert deleted not in ids
+    assert len(ids) == 10_104
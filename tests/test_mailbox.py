@@ -1,5 +1,20 @@
+import sqlite3
+import time
+
 import pytest
-from mail_actions.gmail.mailbox import parse_email_address
+from benchmarks.fake_service import (
+    FAKE_START_MS,
+    INTERVAL_MS,
+    FakeGMailService,
+    message_id,
+)
+from mail_actions.gmail.mailbox import (
+    MailBox,
+    MessageRow,
+    parse_date_header,
+    parse_email_address,
+)
+from mail_actions.ruleengine import build_sql
 
 
 def test_parse_email_address():
@@ -26,3 +41,264 @@ def test_parse_email_address():
     # Test with email without domain
     email = "john.doe"
     assert parse_email_address(email) == "john.doe"
+
+
+def test_parse_date_header():
+    assert parse_date_header("Fri, 23 Dec 2022 01:00:00 +0100") == 1671753600
+    # a date without a timezone is taken as UTC
+    assert parse_date_header("Fri, 23 Dec 2022 00:00:00 -0000") == 1671753600
+    assert parse_date_header("not a date") is None
+    assert parse_date_header("") is None
+
+
+def test_save_message_stores_epoch_dates(tmp_path):
+    service = FakeGMailService(3)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"))
+    mailbox.init_db()
+    mailbox.sync()
+    rows = mailbox.connection().execute(
+        "SELECT internalTimestamp, receivedAt, sentAt FROM messages"
+    )
+    for internalTimestamp, receivedAt, sentAt in rows:
+        assert receivedAt == int(internalTimestamp) // 1000
+        assert sentAt is not None
+    bodies = mailbox.connection().execute("SELECT text FROM bodies").fetchall()
+    assert len(bodies) == 3
+    assert all(text.startswith("Hello,") for (text,) in bodies)
+
+
+def test_init_db_migrates_date_columns(tmp_path):
+    db_path = str(tmp_path / "store.db")
+    service = FakeGMailService(3)
+    mailbox = MailBox(service, db_path=db_path)
+    mailbox.init_db()
+    mailbox.sync()
+    mailbox.close()
+    # simulate a database created before the epoch columns existed
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("DROP INDEX idx_messages_receivedAt")
+        conn.execute("DROP INDEX idx_messages_sentAt")
+        conn.execute("ALTER TABLE messages DROP COLUMN receivedAt")
+        conn.execute("ALTER TABLE messages DROP COLUMN sentAt")
+        conn.execute("DROP TABLE bodies")
+    conn.close()
+
+    mailbox = MailBox(service, db_path=db_path)
+    mailbox.init_db()
+    rows = (
+        mailbox.connection()
+        .execute("SELECT internalTimestamp, receivedAt, sentAt FROM messages")
+        .fetchall()
+    )
+    assert len(rows) == 3
+    for internalTimestamp, receivedAt, sentAt in rows:
+        assert receivedAt == int(internalTimestamp) // 1000
+        assert sentAt is not None
+    bodies = mailbox.connection().execute("SELECT text FROM bodies").fetchall()
+    assert len(bodies) == 3
+    assert all(text.startswith("Hello,") for (text,) in bodies)
+
+
+def test_sync_diffs_ids_in_sql(tmp_path):
+    service = FakeGMailService(30)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"), scan_limit=0)
+    mailbox.init_db()
+    mailbox.sync()
+    assert mailbox.get_stats()["totalMessages"] == 30
+
+    added = service.add_messages(5)
+    removed = service.remove_messages(3)
+    service.calls.clear()
+    mailbox.sync()
+    ids = mailbox.scan_db()
+    assert len(ids) == 32
+    assert set(added) <= ids
+    assert not ids & set(removed)
+    # only the new messages are fetched
+    assert service.calls["messages.get"] == 5
+    conn = mailbox.connection()
+    assert (
+        conn.execute(
+            "SELECT name FROM sqlite_temp_master WHERE name = 'remote_ids'"
+        ).fetchone()
+        is None
+    )
+
+
+def test_sync_fetches_newest_first(tmp_path):
+    service = FakeGMailService(1200)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"), scan_limit=0)
+    mailbox.init_db()
+    fetched = []
+    get_message = service.get_message
+    service.get_message = lambda id: fetched.append(id) or get_message(id)
+    mailbox.sync()
+    assert fetched == [message_id(i) for i in range(1199, -1, -1)]
+
+
+def test_windowed_sync_then_backfill(tmp_path, monkeypatch):
+    service = FakeGMailService(1000)
+    # a clock a minute after the newest message, a day holds 288 messages
+    now = (FAKE_START_MS + 999 * INTERVAL_MS) / 1000 + 60
+    monkeypatch.setattr(time, "time", lambda: now)
+    mailbox = MailBox(
+        service,
+        db_path=str(tmp_path / "store.db"),
+        scan_limit=0,
+        sync_window_days=1,
+        backfill_batch=300,
+    )
+    mailbox.init_db()
+    mailbox.sync()
+    recent = mailbox.scan_db()
+    assert recent == {message_id(i) for i in range(1000 - 288, 1000)}
+    assert mailbox.backfill_pending()
+
+    first = mailbox.backfill()
+    # a listing page from the oldest message of the window is fetched, newest first
+    assert first == [message_id(i) for i in range(711, 212, -1)]
+    second = mailbox.backfill()
+    assert second == [message_id(i) for i in range(212, -1, -1)]
+    assert not mailbox.backfill_pending()
+    assert mailbox.backfill() == []
+
+    # the messages older than the window are kept by the next windowed sync
+    service.add_messages(2)
+    mailbox.sync()
+    assert mailbox.get_stats()["totalMessages"] == 1002
+
+
+def test_iter_ids_batches(tmp_path):
+    service = FakeGMailService(25)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"))
+    mailbox.init_db()
+    mailbox.sync()
+    ids = list(
+        mailbox.iter_ids("id", "FROM messages WHERE 1", op="test", batch_size=10)
+    )
+    assert ids == sorted(mailbox.scan_db())
+
+
+def test_get_messages_sql_returns_compact_rows(tmp_path):
+    service = FakeGMailService(3)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"))
+    mailbox.init_db()
+    mailbox.sync()
+    (sql, args) = build_sql(
+        {
+            "match": "all",
+            "filters": [{"field": "size", "operator": "gte", "value": "0"}],
+        }
+    )
+    rows = list(mailbox.get_messages_sql(sql, args))
+    assert len(rows) == 3
+    row = rows[0]
+    assert isinstance(row, MessageRow)
+    expected = service.get_message(row.id)
+    assert row["id"] == row.id == row[0] == expected["id"]
+    assert row.get("threadId") == expected["threadId"]
+    assert row.labelIds == expected["labelIds"]
+    assert row.get("missing", "default") == "default"
+    with pytest.raises(KeyError):
+        row["missing"]
+
+    message = row.to_dict()
+    assert message["subject"] == row.subject
+    assert message["labelIds"] == row["labelIds"]
+    assert message["payload"]["mimeType"] == expected["payload"]["mimeType"]
+    assert message["payload"]["parts"] == row.payload["parts"]
+
+
+def test_archive_to_cold_db(tmp_path):
+    service = FakeGMailService(40)
+    mailbox = MailBox(
+        service,
+        db_path=str(tmp_path / "store.db"),
+        cold_db_path=str(tmp_path / "cold.db"),
+    )
+    mailbox.init_db()
+    mailbox.sync()
+    conn = mailbox.connection()
+    (before,) = conn.execute(
+        "SELECT receivedAt FROM messages ORDER BY receivedAt LIMIT 1 OFFSET 30"
+    ).fetchone()
+
+    assert mailbox.archive_messages(before) == 30
+    assert conn.execute("SELECT COUNT(*) FROM main.messages").fetchone() == (10,)
+    assert conn.execute("SELECT COUNT(*) FROM cold.messages").fetchone() == (30,)
+    assert conn.execute("SELECT COUNT(*) FROM cold.bodies").fetchone() == (30,)
+    assert conn.execute(
+        "SELECT COUNT(*) FROM main.headers WHERE message_id NOT IN "
+        "(SELECT id FROM main.messages)"
+    ).fetchone() == (0,)
+    assert mailbox.get_stats()["totalMessages"] == 40
+
+    sql, args = build_sql(
+        {
+            "match": "all",
+            "filters": [{"field": "body", "operator": "contains", "value": "Hello"}],
+        }
+    )
+    assert len(list(mailbox.get_messages_sql(sql, args))) == 10
+    assert len(list(mailbox.get_messages_sql(sql, args, "all"))) == 40
+
+    # archived messages are neither fetched again nor kept once deleted remotely
+    service.calls.clear()
+    service.add_messages(2)
+    removed = service.remove_messages(5)
+    mailbox.sync()
+    assert service.calls["messages.get"] == 2
+    assert mailbox.get_stats()["totalMessages"] == 37
+    assert mailbox.missing_ids(removed) == removed
+
+    # label changes sent through the outbox update archived messages too
+    cold = mailbox.cold_connection()
+    ids = [id for (id,) in cold.execute("SELECT id FROM messages")]
+    mailbox.complete_outbox([], "message", ids, ["Label_9"], [])
+    assert cold.execute(
+        "SELECT COUNT(*) FROM messages WHERE labelIds LIKE '%Label_9%'"
+    ).fetchone() == (len(ids),)
+
+
+def test_archive_metadata_only(tmp_path):
+    service = FakeGMailService(20)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"))
+    mailbox.init_db()
+    mailbox.sync()
+    with pytest.raises(Exception):
+        mailbox.archive_messages(2**40, "cold")
+
+    assert mailbox.archive_messages(2**40, "metadata") == 20
+    assert mailbox.archive_messages(2**40, "metadata") == 0
+    conn = mailbox.connection()
+    assert conn.execute("SELECT COUNT(*) FROM headers").fetchone() == (0,)
+    assert conn.execute("SELECT COUNT(*) FROM bodies").fetchone() == (0,)
+    sql, args = build_sql(
+        {
+            "match": "all",
+            "filters": [{"field": "from", "operator": "contains", "value": "@"}],
+        }
+    )
+    rows = list(mailbox.get_messages_sql(sql, args))
+    assert len(rows) == 20
+    assert rows[0].to_dict()["payload"]["parts"] is None
+    assert rows[0].subject is not None
+
+
+def test_maintain_runs_once_per_interval(tmp_path):
+    mailbox = MailBox(
+        FakeGMailService(10),
+        db_path=str(tmp_path / "store.db"),
+        cold_db_path=str(tmp_path / "cold.db"),
+        retention_days=0,
+    )
+    mailbox.init_db()
+    mailbox.sync()
+    conn = mailbox.connection()
+    assert conn.execute("PRAGMA main.auto_vacuum").fetchone() == (2,)
+
+    assert mailbox.maintain(now=2e9)
+    assert conn.execute("SELECT COUNT(*) FROM cold.messages").fetchone() == (10,)
+    assert not mailbox.maintain(now=2e9 + 60)
+    assert mailbox.maintain(now=2e9 + 60, force=True)
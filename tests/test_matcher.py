@@ -0,0 +1,144 @@
+import contextlib
+import io
+import random
+
+import pytest
+from benchmarks.bench_matcher import build_rules
+from benchmarks.fake_service import SENDERS, FakeGMailService
+from mail_actions.gmail.mailbox import MailBox
+from mail_actions.matcher import AhoCorasick, RuleIndex, is_indexable
+from mail_actions.metrics import metrics
+from mail_actions.ruleengine import RuleEngine, bind_params, compile_rule
+
+
+@pytest.fixture
+def mailbox(tmp_path):
+    mailbox = MailBox(
+        FakeGMailService(120), db_path=str(tmp_path / "store.db"), scan_limit=0
+    )
+    mailbox.init_db()
+    with contextlib.redirect_stdout(io.StringIO()):
+        mailbox.sync()
+    return mailbox
+
+
+def rule(filters, match="all", **extra):
+    return compile_rule(
+        {
+            "name": "test",
+            "match": match,
+            "filters": filters,
+            "actions": [{"type": "read"}],
+            **extra,
+        }
+    )
+
+
+def test_aho_corasick_finds_overlapping_patterns():
+    automaton = AhoCorasick(["he", "she", "his", "hers", "xyz"])
+    assert automaton.search("ushers") == {0, 1, 3}
+    assert automaton.search("this") == {2}
+    assert automaton.search("") == set()
+
+
+def test_is_indexable():
+    assert is_indexable(rule([{"field": "from", "operator": "eq", "value": "a"}]))
+    assert is_indexable(
+        rule([{"field": "subject", "operator": "ncontains", "value": "a"}], "any")
+    )
+    # left to SQLite: LIKE wildcards, other fields, threads and the cold partition
+    assert not is_indexable(
+        rule([{"field": "subject", "operator": "contains", "value": "50%"}])
+    )
+    assert not is_indexable(rule([{"field": "body", "operator": "eq", "value": "a"}]))
+    assert not is_indexable(
+        rule([{"field": "from", "operator": "eq", "value": "a"}], scope="thread")
+    )
+    assert not is_indexable(
+        rule([{"field": "from", "operator": "eq", "value": "a"}], partition="all")
+    )
+
+
+def random_rules(count: int) -> list:
+    rng = random.Random(7)
+    values = {
+        "from": [address for (_, address) in SENDERS] + ["GitHub.com", "noreply@"],
+        "to": ["me@example.com", "ME@EXAMPLE", "nobody@example.com"],
+        "subject": ["Invoice", "invoice #1", "Lunch tomorrow?", "ALERT", "digest: 1"],
+    }
+    rules = []
+    for _ in range(count):
+        filters = []
+        for _ in range(rng.randint(1, 3)):
+            field = rng.choice(list(values))
+            filters.append(
+                {
+                    "field": field,
+                    "operator": rng.choice(["eq", "ne", "contains", "ncontains"]),
+                    "value": rng.choice(values[field]),
+                }
+            )
+        rules.append(rule(filters, rng.choice(["all", "any"])))
+    return rules
+
+
+def test_index_matches_the_rule_queries(mailbox):
+    rules = random_rules(60) + build_rules(20)
+    matches = RuleIndex(rules).match(mailbox)
+    assert sorted(matches) == list(range(len(rules)))
+    for i, compiled in enumerate(rules):
+        expected = [
+            row["id"]
+            for row in mailbox.get_messages_sql(
+                compiled["sql"], bind_params(compiled["params"])
+            )
+        ]
+        assert sorted(matches[i]) == sorted(expected), compiled["rule"]
+    assert any(matches.values())
+
+
+def test_index_restricted_to_ids(mailbox):
+    ids = {
+        row[0]
+        for row in mailbox.connection().execute("SELECT id FROM messages LIMIT 10")
+    }
+    compiled = rule([{"field": "to", "operator": "eq", "value": "me@example.com"}])
+    assert set(RuleIndex([compiled]).match(mailbox, ids)[0]) == ids
+
+
+def test_apply_rules_matches_every_rule_in_one_pass(tmp_path, mailbox):
+    rules = [
+        rule([{"field": "from", "operator": "eq", "value": SENDERS[0][1]}]),
+        rule([{"field": "subject", "operator": "contains", "value": "invoice"}]),
+        rule([{"field": "date_received", "operator": "gt", "value": "2016-06-01"}]),
+        compile_rule(
+            {
+                "name": "archive",
+                "match": "any",
+                "filters": [
+                    {"field": "from", "operator": "contains", "value": "SLACK"}
+                ],
+                "actions": [{"type": "move", "value": "Archive"}],
+            }
+        ),
+    ]
+    metrics.reset()
+    with contextlib.redirect_stdout(io.StringIO()):
+        RuleEngine(mailbox, mailbox.gmail_service).apply_rules(rules)
+    scanned = metrics.to_dict()["counters"]["db_rows_scanned_total"]
+    assert {"labels": {"op": "rule_index"}, "value": 120} in scanned
+
+    other = MailBox(
+        FakeGMailService(120), db_path=str(tmp_path / "other.db"), scan_limit=0
+    )
+    other.init_db()
+    with contextlib.redirect_stdout(io.StringIO()):
+        other.sync()
+        engine = RuleEngine(other, other.gmail_service)
+        for compiled in rules:
+            engine.apply_compiled_rule(compiled)
+    query = "SELECT id, labelIds FROM messages ORDER BY id"
+    assert (
+        mailbox.connection().execute(query).fetchall()
+        == other.connection().execute(query).fetchall()
+    )
@@ -0,0 +1,97 @@
+import json
+import pytest
+from benchmarks.fake_service import FakeGMailService, message_id
+from mail_actions.metrics import Histogram, Metrics, metrics
+
+
+def test_histogram():
+    hist = Histogram(buckets=(0.1, 1.0))
+    hist.observe(0.05)
+    hist.observe(0.5)
+    hist.observe(5)
+
+    assert hist.count == 3
+    assert hist.sum == pytest.approx(5.55)
+    assert hist.cumulative() == [("0.1", 1), ("1.0", 2), ("+Inf", 3)]
+
+
+def test_counters_and_phases():
+    m = Metrics()
+    m.inc("gmail_api_calls_total", method="messages.get")
+    m.inc("gmail_api_calls_total", 2, method="messages.get")
+    m.inc("gmail_api_calls_total", method="messages.list")
+    with m.phase("sync"):
+        pass
+    with m.phase("sync"):
+        pass
+
+    data = m.to_dict()
+    calls = {
+        c["labels"]["method"]: c["value"]
+        for c in data["counters"]["gmail_api_calls_total"]
+    }
+    assert calls == {"messages.get": 3, "messages.list": 1}
+    assert "sync" in data["phases"]
+    json.loads(m.to_json())
+
+    m.reset()
+    assert m.to_dict()["counters"] == {}
+
+
+def test_to_prometheus():
+    m = Metrics()
+    m.describe("rule_seconds", "Time spent applying a rule")
+    m.inc("rule_messages_matched_total", 4, rule='Say "hi"')
+    with m.timer("rule_seconds", rule="r1"):
+        pass
+
+    text = m.to_prometheus()
+    assert "# TYPE mail_actions_rule_messages_matched_total counter" in text
+    assert 'mail_actions_rule_messages_matched_total{rule="Say \\"hi\\""} 4' in text
+    assert "# HELP mail_actions_rule_seconds Time spent applying a rule" in text
+    assert 'mail_actions_rule_seconds_bucket{rule="r1",le="+Inf"} 1' in text
+    assert 'mail_actions_rule_seconds_count{rule="r1"} 1' in text
+
+
+def test_write_files(tmp_path):
+    m = Metrics()
+    m.inc("db_rows_written_total", 3, op="save_message")
+    m.write_json(tmp_path / "metrics.json")
+    m.write_prometheus(tmp_path / "metrics.prom")
+
+    assert json.loads((tmp_path / "metrics.json").read_text())["counters"]
+    assert "db_rows_written_total" in (tmp_path / "metrics.prom").read_text()
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "metrics.json",
+        "metrics.prom",
+    ]
+
+
+def test_service_calls_are_recorded():
+    metrics.reset()
+    service = FakeGMailService(5)
+    service.get_message(message_id(1))
+
+    data = metrics.to_dict()
+    [calls] = data["counters"]["gmail_api_calls_total"]
+    assert calls == {"labels": {"method": "messages.get"}, "value": 1}
+    [quota] = data["counters"]["gmail_api_quota_units_total"]
+    assert quota["value"] == 5
+    [size] = data["counters"]["gmail_api_response_bytes_total"]
+    assert size["value"] > 0
+    assert data["histograms"]["gmail_api_seconds"][0]["count"] == 1
+
+
+def test_service_retries_are_recorded(mocker):
+    metrics.reset()
+    service = FakeGMailService(5, error_rate=1.0)
+    service.max_retries = 2
+    mocker.patch("mail_actions.gmail.service.time.sleep")
+
+    with pytest.raises(Exception):
+        service.get_profile()
+
+    data = metrics.to_dict()
+    assert data["counters"]["gmail_api_calls_total"][0]["value"] == 3
+    assert data["counters"]["gmail_api_retries_total"][0]["value"] == 2
+    assert data["counters"]["gmail_api_errors_total"][0]["value"] == 3
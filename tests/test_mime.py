@@ -0,0 +1,89 @@
+import base64
+
+from mail_actions.gmail.mime import (
+    decode_part,
+    extract_attachments,
+    extract_body_text,
+    strip_html,
+)
+
+
+def encode(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip("=")
+
+
+def test_extract_body_text_prefers_plain_text():
+    payload = {
+        "mimeType": "multipart/mixed",
+        "body": {"size": 0},
+        "parts": [
+            {
+                "mimeType": "multipart/alternative",
+                "body": {"size": 0},
+                "parts": [
+                    {"mimeType": "text/plain", "body": {"data": encode("Hello plain")}},
+                    {"mimeType": "text/html", "body": {"data": encode("<p>Hi</p>")}},
+                ],
+            },
+            {
+                "mimeType": "text/plain",
+                "filename": "notes.txt",
+                "body": {"attachmentId": "a1", "size": 10},
+            },
+        ],
+    }
+    assert extract_body_text(payload) == "Hello plain"
+
+
+def test_extract_body_text_falls_back_to_html():
+    html = "<html><head><style>p {}</style></head><body><p>Hello&amp;  <b>bye</b></p><script>x()</script></body></html>"
+    payload = {"mimeType": "text/html", "body": {"data": encode(html)}}
+    assert extract_body_text(payload) == "Hello& bye"
+    assert strip_html("") == ""
+
+
+def test_extract_body_text_caps_size():
+    payload = {"mimeType": "text/plain", "body": {"data": encode("é" * 100)}}
+    assert extract_body_text(payload, limit=10) == "é" * 10
+    # data is cut before decoding, a split character is replaced
+    assert decode_part(payload, limit=6) == "é\ufffd"
+    assert extract_body_text({"mimeType": "multipart/mixed", "body": {}}) == ""
+
+
+def test_extract_attachments():
+    payload = {
+        "mimeType": "multipart/mixed",
+        "filename": "",
+        "body": {"size": 0},
+        "parts": [
+            {"mimeType": "text/plain", "filename": "", "body": {"data": encode("Hi")}},
+            {
+                "mimeType": "application/pdf",
+                "filename": "invoice.pdf",
+                "body": {"attachmentId": "a1", "size": 2048},
+            },
+        ],
+    }
+    assert extract_attachments(payload) == [
+        {"filename": "invoice.pdf", "mimeType": "application/pdf", "size": 2048}
+    ]
+
+
+def test_decode_part_uses_declared_charset():
+    def part(text: str, charset: str) -> dict:
+        data = base64.urlsafe_b64encode(text.encode(charset)).decode()
+        return {
+            "mimeType": "text/plain",
+            "headers": [
+                {"name": "Content-Type", "value": f'text/plain; charset="{charset}"'}
+            ],
+            "body": {"data": data},
+        }
+
+    assert decode_part(part("Café déjà vu", "iso-8859-1")) == "Café déjà vu"
+    assert decode_part(part("“Quoted” €5", "windows-1252")) == "“Quoted” €5"
+    assert decode_part(part("こんにちは", "iso-2022-jp")) == "こんにちは"
+    # an unknown charset falls back to UTF-8
+    unknown = part("plain", "utf-8")
+    unknown["headers"][0]["value"] = "text/plain; charset=x-unknown"
+    assert decode_part(unknown) == "plain"
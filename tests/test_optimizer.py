@@ -0,0 +1,165 @@
+import pytest
+from benchmarks.fake_service import FakeGMailService
+from mail_actions.gmail.mailbox import MailBox
+from mail_actions.optimizer import Predicate, fold_ranges, index_lookup
+from mail_actions.ruleengine import RuleEngine, bind_params, build_sql, compile_rule
+
+
+@pytest.fixture
+def engine(tmp_path):
+    service = FakeGMailService(200)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"), scan_limit=0)
+    mailbox.init_db()
+    mailbox.sync()
+    mailbox.analyze()
+    return RuleEngine(mailbox, service)
+
+
+def date(operator: str, value) -> Predicate:
+    sql = {"gt": ">", "gte": ">=", "lt": "<", "lte": "<="}[operator]
+    return Predicate(
+        field="date_received",
+        operator=operator,
+        sql=f'"receivedAt" {sql} ?',
+        params=[value],
+    )
+
+
+def test_fold_ranges():
+    subject = Predicate(
+        field="subject", operator="eq", sql='"subject" = ?', params=["a"]
+    )
+    folded = fold_ranges([date("gt", 100), subject, date("gte", 50), date("lt", 200)])
+    assert folded == [
+        subject,
+        Predicate(
+            field="date_received", operator="gte", sql='"receivedAt" >= ?', params=[101]
+        ),
+        Predicate(
+            field="date_received", operator="lte", sql='"receivedAt" <= ?', params=[199]
+        ),
+    ]
+    assert fold_ranges([date("gt", 100), date("lt", 101)]) is None
+
+
+def test_index_lookup():
+    assert (
+        index_lookup(date("gt", 1)) == 'SELECT id FROM messages WHERE "receivedAt" > ?'
+    )
+    assert index_lookup(
+        Predicate(field="from", operator="eq", sql='"from" = ?', params=["a"])
+    )
+    assert not index_lookup(
+        Predicate(
+            field="from", operator="contains", sql='"from" LIKE ?', params=["%a%"]
+        )
+    )
+
+
+RULES = [
+    {
+        "match": "any",
+        "filters": [
+            {"field": "from", "operator": "eq", "value": "order-update@amazon.in"},
+            {"field": "size", "operator": "gt", "value": "1MB"},
+            {"field": "has_attachment", "operator": "eq", "value": "true"},
+        ],
+    },
+    {
+        "match": "any",
+        "filters": [
+            {"field": "subject", "operator": "matches", "value": "^Invoice"},
+            {"field": "body", "operator": "contains", "value": "Lunch"},
+            {"field": "from", "operator": "eq", "value": "noreply@swiggy.in"},
+        ],
+    },
+    {
+        "match": "all",
+        "filters": [
+            {"field": "body", "operator": "contains", "value": "Regards"},
+            {"field": "from", "operator": "contains", "value": "github.com"},
+            {
+                "field": "date_received",
+                "operator": "lt",
+                "value": "2016-05-30 21:00:00",
+            },
+            {"field": "date_received", "operator": "lt", "value": "2016-06-30"},
+        ],
+    },
+    {
+        "match": "all",
+        "filters": [
+            {"field": "date_received", "operator": "gt", "value": "2 days"},
+            {"field": "date_received", "operator": "lt", "value": "5 days"},
+        ],
+    },
+    {
+        "match": "all",
+        "scope": "thread",
+        "thread_match": "any",
+        "filters": [
+            {"field": "from", "operator": "eq", "value": "jane.smith@example.com"},
+            {"field": "date_received", "operator": "gt", "value": "2021-01-01"},
+        ],
+    },
+]
+
+
+@pytest.mark.parametrize("rule", RULES)
+def test_optimized_query_matches_the_same_messages(engine, rule):
+    compiled = compile_rule({"name": "test", "actions": [], **rule})
+    conn = engine.mailbox.connection()
+    sql, params = engine.rule_sql(compiled)
+    plain, plain_params = build_sql(compiled["rule"])
+    expected = conn.execute(plain, bind_params(plain_params)).fetchall()
+    assert sorted(conn.execute(sql, params).fetchall()) == sorted(expected)
+
+
+def test_any_of_indexed_predicates_is_a_union_of_index_lookups(engine):
+    sql, params = engine.rule_sql(
+        compile_rule({"name": "test", "actions": [], **RULES[0]})
+    )
+    assert " UNION " in sql
+    plan = " ".join(
+        row[-1]
+        for row in engine.mailbox.connection().execute(
+            f"EXPLAIN QUERY PLAN {sql}", params
+        )
+    )
+    assert "USING INDEX idx_messages_from" in plan
+    assert "USING INDEX idx_messages_sizeEstimate" in plan
+
+
+def test_predicates_are_ordered_by_cost_and_selectivity(engine):
+    compiled = compile_rule({"name": "test", "actions": [], **RULES[2]})
+    sql, params = engine.rule_sql(compiled)
+    where = sql.split(" WHERE ", 1)[1]
+    # the selective date range (the first few fake messages) first, the body lookup last
+    assert where.startswith('("receivedAt" <= ?)')
+    assert where.index('"from" LIKE ?') < where.index("FROM bodies")
+
+
+def test_empty_date_range_matches_nothing(engine):
+    sql, params = engine.rule_sql(
+        compile_rule({"name": "test", "actions": [], **RULES[3]})
+    )
+    assert sql.endswith(" WHERE 0")
+    assert params == []
+
+
+def test_any_of_indexed_columns_is_left_to_sqlite(engine):
+    rule = {**RULES[0], "filters": RULES[0]["filters"][:2]}
+    sql, _ = engine.rule_sql(compile_rule({"name": "test", "actions": [], **rule}))
+    assert " UNION " not in sql
+    assert '("from" = ?) OR ' in sql or ' OR ("from" = ?)' in sql
+
+
+def test_apply_rules_loads_stats_once(engine, mocker):
+    load_stats = mocker.spy(engine.optimizer, "load_stats")
+    rules = [
+        compile_rule({"name": f"test {i}", "actions": [], **rule})
+        for (i, rule) in enumerate(RULES)
+    ]
+    engine.read_only = True
+    engine.apply_rules(rules)
+    assert load_stats.call_count == 1
@@ -0,0 +1,133 @@
+import pytest
+from benchmarks.fake_service import FakeGMailService
+from mail_actions.gmail.mailbox import MailBox
+from mail_actions.planner import Planner, build_query
+from mail_actions.ruleengine import RuleEngine, compile_rule
+
+GITHUB = {
+    "name": "Read GitHub",
+    "match": "all",
+    "filters": [
+        {"field": "from", "operator": "eq", "value": "notifications@github.com"}
+    ],
+    "actions": [{"type": "read"}],
+}
+
+
+def test_build_query():
+    assert build_query(GITHUB) == 'from:"notifications@github.com"'
+    rule = {
+        "match": "any",
+        "filters": [
+            {"field": "subject", "operator": "ncontains", "value": "digest"},
+            {"field": "date_received", "operator": "gt", "value": "2 days"},
+            {"field": "date_received", "operator": "lt", "value": "2022-12-23"},
+            {"field": "size", "operator": "gt", "value": "1MB"},
+            {"field": "has_attachment", "operator": "eq", "value": "true"},
+        ],
+    }
+    assert (
+        build_query(rule)
+        == '{-subject:"digest" newer_than:3d before:2022/12/25 larger:1048575 has:attachment}'
+    )
+    # filters without a Gmail search equivalent run locally
+    for filter in [
+        {"field": "date_sent", "operator": "gt", "value": "2 days"},
+        {"field": "body", "operator": "contains", "value": "invoice"},
+        {"field": "date_received", "operator": "gt", "value": "3 hours"},
+        {"field": "subject", "operator": "gt", "value": "a"},
+        {"field": "subject", "operator": "contains", "value": 'say "hi"'},
+        # Gmail matches whole words, "hub" would miss "github.com"
+        {"field": "from", "operator": "contains", "value": "hub"},
+        {"field": "attachment_name", "operator": "contains", "value": "invoice"},
+        # -from: would also exclude the senders merely containing the value
+        {"field": "from", "operator": "ne", "value": "github.com"},
+    ]:
+        assert build_query({"match": "all", "filters": [filter]}) is None
+    assert build_query({"match": "all", "filters": []}) is None
+    assert build_query({**GITHUB, "scope": "thread", "thread_match": "all"}) is None
+
+
+@pytest.fixture
+def planner(tmp_path):
+    service = FakeGMailService(400)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"), scan_limit=0)
+    mailbox.init_db()
+    return Planner(mailbox, service)
+
+
+def test_plan_remote_when_not_synced(planner):
+    profile = planner.service.get_profile()
+    plan = planner.plan(compile_rule(GITHUB), profile)
+    assert plan["mode"] == "remote"
+    assert plan["query"] == 'from:"notifications@github.com"'
+    assert plan["remote_cost"] < plan["sync_cost"]
+
+    # a rule without a search equivalent needs the local mirror
+    rule = {
+        **GITHUB,
+        "filters": [{"field": "body", "operator": "contains", "value": "x"}],
+    }
+    assert planner.plan(compile_rule(rule), profile)["mode"] == "local"
+
+
+def test_plan_local_when_fresh(planner):
+    planner.mailbox.sync()
+    profile = planner.service.get_profile()
+    planner.service.calls.clear()
+    plan = planner.plan(compile_rule(GITHUB), profile)
+    assert plan["mode"] == "local"
+    assert planner.service.calls["messages.list"] == 0
+
+
+def test_apply_remote_rule_fetches_candidates_only(planner):
+    service = planner.service
+    engine = RuleEngine(planner.mailbox, service)
+    expected = service.get_message_list(
+        maxResults=500, q='from:"notifications@github.com"'
+    )
+    service.calls.clear()
+    engine.apply_remote_rule(compile_rule(GITHUB), 'from:"notifications@github.com"')
+    assert service.calls["messages.get"] == len(expected["messages"])
+    assert service.calls["messages.batchModify"] == 1
+    assert planner.mailbox.get_stats()["totalMessages"] == len(expected["messages"])
+
+
+@pytest.fixture(scope="module")
+def synced(tmp_path_factory):
+    service = FakeGMailService(200)
+    db_path = tmp_path_factory.mktemp("synced") / "store.db"
+    mailbox = MailBox(service, db_path=str(db_path), scan_limit=0)
+    mailbox.init_db()
+    mailbox.sync()
+    return (service, mailbox)
+
+
+@pytest.mark.parametrize(
+    "filter",
+    [
+        {"field": field, "operator": operator, "value": value}
+        for (field, values) in [
+            ("from", ["github.com", "notifications@github.com", "GitHub", "hub"]),
+            ("to", ["me@example.com", "example"]),
+            ("subject", ["Lunch tomorrow?", "digest", "Your order has been shipped"]),
+        ]
+        for value in values
+        for operator in ["eq", "ne", "contains", "ncontains"]
+    ],
+)
+def test_remote_candidates_contain_local_matches(synced, filter):
+    (service, mailbox) = synced
+    rule = {"name": "Superset", "match": "all", "filters": [filter], "actions": []}
+    query = build_query(rule)
+    if query is None:
+        return
+    (sql, opts) = RuleEngine(mailbox, service, read_only=True).rule_sql(
+        compile_rule(rule)
+    )
+    local = {message["id"] for message in mailbox.get_messages_sql(sql, opts)}
+    remote = {
+        message["id"]
+        for message in service.get_message_list(maxResults=500, q=query)["messages"]
+    }
+    assert local <= remote
@@ -0,0 +1,78 @@
+import json
+import pytest
+import mail_actions.rulecache as rulecache
+import mail_actions.ruleparser as ruleparser
+from mail_actions.rulecache import default_cache_file, load_compiled_rules
+from mail_actions.ruleengine import build_sql
+
+RULES = """
+rules:
+  - name: "Read GitHub"
+    match: "all"
+    filters:
+      - field: "from"
+        operator: "contains"
+        value: "github.com"
+    actions:
+      - type: "read"
+"""
+
+
+@pytest.fixture
+def rules_file(tmp_path, mocker):
+    mocker.patch.object(rulecache, "_memory", {})
+    path = tmp_path / "rules.yaml"
+    path.write_text(RULES)
+    return str(path)
+
+
+def test_compiles_rules(rules_file):
+    [compiled] = load_compiled_rules(rules_file)
+    rule = compiled["rule"]
+    assert rule["name"] == "Read GitHub"
+    assert (compiled["sql"], compiled["params"]) == build_sql(rule)
+
+
+def test_memory_cache(rules_file, mocker):
+    parse = mocker.spy(ruleparser, "load_rules")
+    first = load_compiled_rules(rules_file)
+    assert load_compiled_rules(rules_file) is first
+    assert parse.call_count == 1
+
+
+def test_file_cache(rules_file, mocker):
+    load_compiled_rules(rules_file)
+    cache = json.loads(open(default_cache_file(rules_file)).read())
+    assert cache["rules"][0]["rule"]["name"] == "Read GitHub"
+
+    # a new process only has the file cache
+    mocker.patch.object(rulecache, "_memory", {})
+    parse = mocker.spy(ruleparser, "load_rules")
+    [compiled] = load_compiled_rules(rules_file)
+    assert parse.call_count == 0
+    assert compiled["rule"]["name"] == "Read GitHub"
+
+
+def test_rules_change_invalidates_cache(rules_file, mocker):
+    load_compiled_rules(rules_file)
+    with open(rules_file, "w") as f:
+        f.write(RULES.replace("Read GitHub", "Read GitLab"))
+
+    parse = mocker.spy(ruleparser, "load_rules")
+    [compiled] = load_compiled_rules(rules_file)
+    assert parse.call_count == 1
+    assert compiled["rule"]["name"] == "Read GitLab"
+
+
+def test_corrupt_cache_is_rebuilt(rules_file):
+    with open(default_cache_file(rules_file), "w") as f:
+        f.write("{not json")
+    [compiled] = load_compiled_rules(rules_file)
+    assert compiled["rule"]["name"] == "Read GitHub"
+
+
+def test_invalid_rules_are_not_cached(tmp_path, mocker):
+    mocker.patch.object(rulecache, "_memory", {})
+    with pytest.raises(Exception):
+        load_compiled_rules("./tests/invalid_rules.yaml", str(tmp_path / "cache.json"))
+    assert not (tmp_path / "cache.json").exists()
@@ -1,9 +1,19 @@
+import datetime
+import json
+import sqlite3
+
 import pytest
+from benchmarks.fake_service import FakeGMailService
+from mail_actions.gmail.mailbox import MailBox
 from mail_actions.ruleengine import (
+    RuleEngine,
+    build_attachment_filter_clause,
+    bind_params,
     is_relative_date,
     build_date_filter_clause,
     build_string_filter_clause,
     build_sql,
+    restrict_to_ids,
 )
 
 
@@ -34,8 +44,8 @@ def test_build_date_filter_clause():
     # Test with valid filter
     filter = {"field": "date_received", "operator": "gt", "value": "2 days"}
     clause, values = build_date_filter_clause(filter)
-    assert clause == "\"internalDate\" > datetime('now', ?)"
-    assert values == ["-2 days"]
+    assert clause == '"receivedAt" > ?'
+    assert values == [{"relative": "2 days"}]
 
     # Test with invalid field
     filter = {"field": "invalid_field", "operator": "gt", "value": "2 days"}
@@ -61,18 +71,56 @@ def test_build_date_filter_clause():
     filter = {"field": "date_received", "operator": "gt", "value": "2022-12-23"}
 
     clause, values = build_date_filter_clause(filter)
-    assert clause == '"internalDate" > ?'
-    assert values == ["2022-12-23"]
+    assert clause == '"receivedAt" > ?'
+    assert values == [1671753600]
 
-    # Test date_sent field to have labelIds LIKE %"SENT"%
+    # Test date only equality covers the whole day
+    filter = {"field": "date_received", "operator": "eq", "value": "2022-12-23"}
+    clause, values = build_date_filter_clause(filter)
+    assert clause == '"receivedAt" >= ? AND "receivedAt" < ?'
+    assert values == [1671753600, 1671840000]
 
-    filter = {"field": "date_sent", "operator": "gt", "value": "2 days"}
+    # Test with date and time
+    filter = {
+        "field": "date_received",
+        "operator": "eq",
+        "value": "2022-12-23 01:00:00",
+    }
+    clause, values = build_date_filter_clause(filter)
+    assert clause == '"receivedAt" = ?'
+    assert values == [1671757200]
 
+    # Test with invalid date
+    filter = {"field": "date_received", "operator": "gt", "value": "23/12/2022"}
+    with pytest.raises(Exception):
+        build_date_filter_clause(filter)
+
+    # Test date_sent field uses the Date header column
+    filter = {"field": "date_sent", "operator": "gt", "value": "2 days"}
     clause, values = build_date_filter_clause(filter)
-    assert (
-        clause == '( "internalDate" > datetime(\'now\', ?) AND labelIds LIKE %"SENT"% )'
+    assert clause == '"sentAt" > ?'
+    assert values == [{"relative": "2 days"}]
+
+
+def test_bind_params():
+    now = datetime.datetime(2024, 3, 31, 12, 0, 0, tzinfo=datetime.UTC)
+    params = ["%important%", {"relative": "2 days"}, 5]
+    assert bind_params(params, now) == [
+        "%important%",
+        int(now.timestamp()) - 2 * 86400,
+        5,
+    ]
+    # months are calendar months, clamped to the length of the month
+    [value] = bind_params([{"relative": "1 month"}], now)
+    assert value == int(
+        datetime.datetime(2024, 2, 29, 12, tzinfo=datetime.UTC).timestamp()
+    )
+    [value] = bind_params([{"relative": "2 years"}], now)
+    assert value == int(
+        datetime.datetime(2022, 3, 31, 12, tzinfo=datetime.UTC).timestamp()
     )
-    assert values == ["-2 days"]
+    [value] = bind_params([{"relative": "30 minutes"}], now)
+    assert value == int(now.timestamp()) - 1800
 
 
 def test_build_string_filter_clause():
@@ -117,9 +165,9 @@ def test_build_sql():
     sql, options = build_sql(rule)
     assert (
         sql
-        == 'SELECT "id", "threadId", "historyId", "internalDate", "internalTimestamp", "from", "to", "subject", "labelIds", "payload__body__data", "payload__body__size", "payload__body__attachmentId", "payload__filename", "payload__mimeType", "payload__partId", "payload__parts", "raw", "sizeEstimate", "snippet" FROM messages WHERE "subject" LIKE ? AND "internalDate" > datetime(\'now\', ?)'
+        == 'SELECT "id", "threadId", "historyId", "internalDate", "internalTimestamp", "from", "to", "subject", "labelIds", "payload__body__data", "payload__body__size", "payload__body__attachmentId", "payload__filename", "payload__mimeType", "payload__partId", "payload__parts", "raw", "sizeEstimate", "snippet" FROM messages WHERE "subject" LIKE ? AND "receivedAt" > ?'
     )
-    assert options == ["%important%", "-2 days"]
+    assert options == ["%important%", {"relative": "2 days"}]
 
     # Test with valid filters and match criteria "any"
     rule = {
@@ -132,9 +180,9 @@ def test_build_sql():
     sql, options = build_sql(rule)
     assert (
         sql
-        == 'SELECT "id", "threadId", "historyId", "internalDate", "internalTimestamp", "from", "to", "subject", "labelIds", "payload__body__data", "payload__body__size", "payload__body__attachmentId", "payload__filename", "payload__mimeType", "payload__partId", "payload__parts", "raw", "sizeEstimate", "snippet" FROM messages WHERE "subject" LIKE ? OR "internalDate" > datetime(\'now\', ?)'
+        == 'SELECT "id", "threadId", "historyId", "internalDate", "internalTimestamp", "from", "to", "subject", "labelIds", "payload__body__data", "payload__body__size", "payload__body__attachmentId", "payload__filename", "payload__mimeType", "payload__partId", "payload__parts", "raw", "sizeEstimate", "snippet" FROM messages WHERE "subject" LIKE ? OR "receivedAt" > ?'
     )
-    assert options == ["%important%", "-2 days"]
+    assert options == ["%important%", {"relative": "2 days"}]
 
     # Test with invalid filter match criteria
     rule = {
@@ -155,3 +203,251 @@ def test_build_sql():
         == 'SELECT "id", "threadId", "historyId", "internalDate", "internalTimestamp", "from", "to", "subject", "labelIds", "payload__body__data", "payload__body__size", "payload__body__attachmentId", "payload__filename", "payload__mimeType", "payload__partId", "payload__parts", "raw", "sizeEstimate", "snippet" FROM messages WHERE '
     )
     assert options == []
+
+
+def test_restrict_to_ids():
+    rule = {
+        "filters": [
+            {"field": "subject", "operator": "contains", "value": "a"},
+            {"field": "from", "operator": "eq", "value": "b"},
+        ],
+        "match": "any",
+    }
+    sql, options = build_sql(rule)
+    restricted, restricted_options = restrict_to_ids(sql, options, {"2", "1"})
+    assert restricted == (
+        f"SELECT * FROM ({sql}) WHERE id IN (SELECT value FROM json_each(?))"
+    )
+    assert restricted_options == ["%a%", "b", '["1", "2"]']
+
+
+def test_build_sql_thread_scope():
+    rule = {
+        "filters": [{"field": "subject", "operator": "contains", "value": "digest"}],
+        "match": "all",
+        "scope": "thread",
+    }
+    sql, options = build_sql(rule)
+    assert (
+        sql
+        == 'SELECT "id", "historyId", "messageCount", "lastReceivedAt" FROM threads WHERE id IN (SELECT threadId FROM messages WHERE "subject" LIKE ?)'
+    )
+    assert options == ["%digest%"]
+
+    rule["thread_match"] = "all"
+    sql, options = build_sql(rule)
+    assert (
+        sql
+        == 'SELECT "id", "historyId", "messageCount", "lastReceivedAt" FROM threads WHERE id IN (SELECT threadId FROM messages GROUP BY threadId HAVING MIN(CASE WHEN ("subject" LIKE ?) THEN 1 ELSE 0 END) = 1)'
+    )
+
+    rule["thread_match"] = "invalid"
+    with pytest.raises(Exception):
+        build_sql(rule)
+
+    rule = {"filters": [], "match": "all", "scope": "invalid"}
+    with pytest.raises(Exception):
+        build_sql(rule)
+
+
+def test_apply_thread_rule(tmp_path):
+    service = FakeGMailService(8)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"))
+    mailbox.init_db()
+    mailbox.sync()
+    conn = mailbox.connection()
+    assert conn.execute(
+        "SELECT COUNT(*), SUM(messageCount) FROM threads"
+    ).fetchone() == (2, 8)
+    (threadId,) = conn.execute("SELECT threadId FROM messages LIMIT 1").fetchone()
+    rule = {
+        "name": "Read thread",
+        "match": "all",
+        "scope": "thread",
+        "filters": [{"field": "from", "operator": "contains", "value": "@"}],
+        "actions": [{"type": "read"}],
+    }
+    service.calls.clear()
+    engine = RuleEngine(mailbox, service)
+    # only the thread of the changed message is processed
+    engine.apply_rule(
+        rule,
+        {
+            conn.execute(
+                "SELECT id FROM messages WHERE threadId=? LIMIT 1", (threadId,)
+            ).fetchone()[0]
+        },
+    )
+    # the stored messages are updated in place, the thread is not fetched again
+    assert service.calls == {"threads.modify": 1}
+    rows = conn.execute(
+        "SELECT labelIds FROM messages WHERE threadId=?", (threadId,)
+    ).fetchall()
+    assert len(rows) == 4
+    assert all("UNREAD" not in json.loads(labels) for (labels,) in rows)
+    assert conn.execute(
+        "SELECT messageCount FROM threads WHERE id=?", (threadId,)
+    ).fetchone() == (4,)
+
+
+def test_body_filter(tmp_path):
+    service = FakeGMailService(10)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"))
+    mailbox.init_db()
+    mailbox.sync()
+    clause, values = build_string_filter_clause(
+        {"field": "body", "operator": "contains", "value": "Regards"}
+    )
+    assert clause == "(SELECT text FROM bodies WHERE message_id = messages.id) LIKE ?"
+    sql, options = build_sql(
+        {
+            "match": "all",
+            "filters": [{"field": "body", "operator": "contains", "value": "Regards"}],
+        }
+    )
+    assert len(list(mailbox.get_messages_sql(sql, options))) == 10
+    sql, options = build_sql(
+        {
+            "match": "all",
+            "filters": [{"field": "body", "operator": "contains", "value": "<html>"}],
+        }
+    )
+    assert list(mailbox.get_messages_sql(sql, options)) == []
+
+
+def test_build_attachment_filter_clause():
+    clause, values = build_attachment_filter_clause(
+        {"field": "size", "operator": "gt", "value": "5MB"}
+    )
+    assert clause == '"sizeEstimate" > ?'
+    assert values == [5 * 1024 * 1024]
+
+    clause, values = build_attachment_filter_clause(
+        {"field": "has_attachment", "operator": "eq", "value": "false"}
+    )
+    assert (
+        clause
+        == "NOT EXISTS (SELECT 1 FROM attachments WHERE message_id = messages.id)"
+    )
+    assert values == []
+
+    clause, values = build_attachment_filter_clause(
+        {"field": "attachment_name", "operator": "ncontains", "value": ".pdf"}
+    )
+    assert (
+        clause
+        == 'NOT EXISTS (SELECT 1 FROM attachments WHERE message_id = messages.id AND "filename" LIKE ?)'
+    )
+    assert values == ["%.pdf%"]
+
+    for filter in [
+        {"field": "size", "operator": "contains", "value": "5MB"},
+        {"field": "size", "operator": "gt", "value": "big"},
+        {"field": "has_attachment", "operator": "eq", "value": "yes"},
+        {"field": "attachment_type", "operator": "invalid", "value": "x"},
+    ]:
+        with pytest.raises(Exception):
+            build_attachment_filter_clause(filter)
+
+
+def test_attachment_filters(tmp_path):
+    service = FakeGMailService(40)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"))
+    mailbox.init_db()
+    mailbox.sync()
+    (expected,) = (
+        mailbox.connection()
+        .execute("SELECT COUNT(DISTINCT message_id) FROM attachments")
+        .fetchone()
+    )
+    assert expected > 0
+
+    def count(filters):
+        sql, options = build_sql({"match": "all", "filters": filters})
+        return len(list(mailbox.get_messages_sql(sql, options)))
+
+    assert (
+        count([{"field": "has_attachment", "operator": "eq", "value": "true"}])
+        == expected
+    )
+    assert (
+        count(
+            [{"field": "attachment_type", "operator": "eq", "value": "application/pdf"}]
+        )
+        == expected
+    )
+    assert (
+        count([{"field": "attachment_name", "operator": "contains", "value": ".pdf"}])
+        == expected
+    )
+    assert count([{"field": "size", "operator": "gte", "value": "10KB"}]) >= expected
+
+
+def test_regex_filters(tmp_path):
+    rule = {
+        "match": "all",
+        "filters": [
+            {"field": "subject", "operator": "matches", "value": r"Invoice #\d+"},
+            {"field": "from", "operator": "contains", "value": "amazon"},
+        ],
+    }
+    sql, options = build_sql(rule)
+    # the LIKE predicate is evaluated before the regular expression
+    assert sql.endswith('WHERE "from" LIKE ? AND "subject" REGEXP ?')
+    assert options == ["%amazon%", r"Invoice #\d+"]
+
+    service = FakeGMailService(40)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"))
+    mailbox.init_db()
+    mailbox.sync()
+
+    def subjects(filter):
+        sql, options = build_sql({"match": "all", "filters": [filter]})
+        return [m["subject"] for m in mailbox.get_messages_sql(sql, options)]
+
+    matched = subjects({"field": "subject", "operator": "matches", "value": r"#\d+ "})
+    assert matched and all("#" in subject for subject in matched)
+    unmatched = subjects(
+        {"field": "subject", "operator": "nmatches", "value": r"#\d+ "}
+    )
+    assert len(matched) + len(unmatched) == 40
+    assert subjects({"field": "body", "operator": "matches", "value": r"^Hello,\n"})
+
+
+def test_build_sql_partition():
+    rule = {
+        "match": "all",
+        "filters": [{"field": "from", "operator": "eq", "value": "a@example.com"}],
+    }
+    assert build_sql({**rule, "partition": "all"}) == build_sql(rule)
+    with pytest.raises(Exception):
+        build_sql({**rule, "partition": "cold"})
+    with pytest.raises(Exception):
+        build_sql({**rule, "scope": "thread", "partition": "all"})
+
+
+def test_read_only_engine_does_not_modify(tmp_path):
+    service = FakeGMailService(8)
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"))
+    mailbox.init_db()
+    mailbox.sync()
+    mailbox.close()
+    service.calls.clear()
+    # a write to the read-only connection would raise
+    mailbox = MailBox(service, db_path=str(tmp_path / "store.db"), read_only=True)
+    engine = RuleEngine(mailbox, service, read_only=True)
+    for scope in ("message", "thread"):
+        engine.apply_rule(
+            {
+                "name": "Move",
+                "match": "all",
+                "scope": scope,
+                "filters": [{"field": "from", "operator": "contains", "value": "@"}],
+                "actions": [{"type": "move", "value": "Receipts"}, {"type": "read"}],
+            }
+        )
+    assert service.calls == {}
+    (queued,) = mailbox.connection().execute("SELECT COUNT(*) FROM outbox").fetchone()
+    assert queued == 0
+    with pytest.raises(sqlite3.OperationalError, match="readonly"):
+        mailbox.set_state("lastSyncAt", "0")
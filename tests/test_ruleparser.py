@@ -12,3 +12,27 @@ def test_load_rules():
     # Test that the function raises an exception if the rules file is missing
     with pytest.raises(Exception):
         ruleparser.load_rules("./tests/missing_file.yaml")
+
+
+def test_load_rules_validates_patterns(tmp_path, monkeypatch):
+    monkeypatch.setattr(ruleparser, "SCHEMA_FILE", "schema.json")
+    rules_file = tmp_path / "rules.yaml"
+    rules_file.write_text(
+        """
+rules:
+  - name: "Invoices"
+    match: "all"
+    filters:
+      - field: "subject"
+        operator: "matches"
+        value: "Invoice #[0-9]+("
+    actions:
+      - type: "read"
+"""
+    )
+    with pytest.raises(Exception, match="Invalid regular expression"):
+        ruleparser.load_rules(str(rules_file))
+
+    rules_file.write_text(rules_file.read_text().replace("+(", "+"))
+    [rule] = ruleparser.load_rules(str(rules_file))
+    assert rule["filters"][0]["operator"] == "matches"
@@ -0,0 +1,77 @@
+import subprocess
+import sys
+import threading
+import time
+
+import mail_actions.runlock as runlock
+from mail_actions.runlock import RunLock
+
+
+def test_lease_is_exclusive(tmp_path):
+    db = str(tmp_path / "store.db")
+    first = RunLock(db)
+    second = RunLock(db)
+    assert first.try_acquire()
+    assert not second.try_acquire()
+    assert second.holder()["owner"] == first.owner
+    # taking the lease again is a renewal
+    assert first.try_acquire()
+    first.release()
+    assert second.holder() is None
+    assert second.try_acquire()
+    second.release()
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    db = str(tmp_path / "store.db")
+    first = RunLock(db, ttl=60)
+    second = RunLock(db, ttl=60)
+    now = time.time()
+    assert first.try_acquire(now)
+    assert not second.try_acquire(now + 30)
+    assert second.try_acquire(now + 61)
+    # the first run learns it lost the lease on its next renewal
+    assert not first.renew()
+    first.release()
+    assert second.holder()["owner"] == second.owner
+    second.release()
+
+
+def test_lease_of_a_dead_process_is_taken_over(tmp_path):
+    db = str(tmp_path / "store.db")
+    first = RunLock(db)
+    assert first.try_acquire()
+    first._stop_heartbeat()
+    dead = subprocess.run(
+        [sys.executable, "-c", "import os; print(os.getpid())"],
+        capture_output=True,
+        text=True,
+    )
+    conn = first._connect()
+    conn.execute("UPDATE run_leases SET pid = ?", (int(dead.stdout),))
+    conn.close()
+    second = RunLock(db)
+    assert second.try_acquire()
+    second.release()
+
+
+def test_acquire_waits_for_the_holder(tmp_path, monkeypatch):
+    monkeypatch.setattr(runlock, "LEASE_POLL", 0.05)
+    db = str(tmp_path / "store.db")
+    first = RunLock(db)
+    second = RunLock(db)
+    assert first.try_acquire()
+    assert not second.acquire(timeout=0)
+    threading.Timer(0.2, first.release).start()
+    assert second.acquire(timeout=5)
+    second.release()
+
+
+def test_heartbeat_renews_the_lease(tmp_path):
+    lock = RunLock(str(tmp_path / "store.db"), ttl=0.3)
+    with lock:
+        assert lock.try_acquire()
+        time.sleep(0.5)
+        assert lock.holder()["expires_at"] > time.time()
+        assert lock.held
+    assert lock.holder() is None
@@ -0,0 +1,40 @@
+import subprocess
+import sys
+import pytest
+from google.oauth2.credentials import Credentials
+import mail_actions.gmail.service as service_module
+from mail_actions.gmail.service import GMailService, discovery_document
+
+
+def test_discovery_client_is_built_lazily(mocker):
+    build = mocker.patch("googleapiclient.discovery.build_from_document")
+    service = GMailService(Credentials(token="token"))
+    assert build.call_count == 0
+
+    service.service.users()
+    service.service.users()
+    assert build.call_count == 1
+    assert build.call_args.args[0] is discovery_document()
+
+
+def test_discovery_document_is_parsed_once(mocker):
+    mocker.patch.object(service_module, "_discovery_document", None)
+    first = discovery_document()
+    assert first["name"] == "gmail"
+    assert discovery_document() is first
+
+
+def test_close_without_api_calls():
+    # nothing was built, nothing to close
+    GMailService(Credentials(token="token")).close()
+
+
+def test_cli_import_is_lazy():
+    code = (
+        "import sys, mail_actions.cli; "
+        "print(any(m.startswith(('googleapiclient', 'jsonschema', 'google.auth')) for m in sys.modules))"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert out.stdout.strip() == "False"
@@ -0,0 +1,64 @@
+import json
+from mail_actions.metrics import Metrics
+from mail_actions.tracing import Tracer, traced, tracer
+
+
+def test_span_disabled():
+    t = Tracer()
+    with t.span("noop"):
+        pass
+    assert t.events == []
+
+
+def test_span_records_complete_event():
+    t = Tracer()
+    t.start()
+    with t.span("mailbox.save_message", id="abc"):
+        pass
+    t.stop()
+
+    [event] = t.events
+    assert event["name"] == "mailbox.save_message"
+    assert event["ph"] == "X"
+    assert event["dur"] >= 0
+    assert event["args"] == {"id": "abc"}
+
+
+def test_traced_function_and_generator():
+    @traced("double")
+    def double(x):
+        return x * 2
+
+    @traced("numbers")
+    def numbers():
+        yield 1
+        yield 2
+
+    tracer.start()
+    try:
+        assert double(2) == 4
+        assert list(numbers()) == [1, 2]
+    finally:
+        tracer.stop()
+    assert [e["name"] for e in tracer.events] == ["double", "numbers"]
+
+    # disabled tracer still calls through
+    assert double(3) == 6
+    assert list(numbers()) == [1, 2]
+    assert len(tracer.events) == 2
+
+
+def test_phases_are_traced_and_written(tmp_path):
+    m = Metrics()
+    tracer.start()
+    try:
+        with m.phase("sync"):
+            pass
+    finally:
+        tracer.stop()
+    tracer.write(tmp_path / "trace.json")
+
+    data = json.loads((tmp_path / "trace.json").read_text())
+    [event] = data["traceEvents"]
+    assert event["name"] == "sync"
+    assert event["cat"] == "phase"
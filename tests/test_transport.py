@@ -0,0 +1,104 @@
+import gzip
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from google.oauth2.credentials import Credentials
+from mail_actions.gmail.service import GMailService
+from mail_actions.gmail.transport import HttpPool
+from mail_actions.metrics import metrics
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+            server.requests.append({k.lower(): v for (k, v) in self.headers.items()})
+        time.sleep(float(self.path.strip("/") or 0))
+        body = b'{"ok": true}'
+        self.send_response(200)
+        if "gzip" in self.headers.get("user-agent", ""):
+            body = gzip.compress(body)
+            self.send_header("content-encoding", "gzip")
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with server.lock:
+            server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.active = server.peak = 0
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, path="/"):
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+def test_pool_keeps_connections_alive_and_asks_for_gzip(server):
+    metrics.reset()
+    pool = HttpPool(Credentials(token="token"))
+    for _ in range(3):
+        with pool.connection() as http:
+            response, content = http.request(url(server))
+        assert response.status == 200
+        assert content == b'{"ok": true}'
+    pool.close()
+
+    counters = metrics.to_dict()["counters"]
+    assert counters["http_connections_opened_total"][0]["value"] == 1
+    assert all("(gzip)" in headers["user-agent"] for headers in server.requests)
+    assert all(
+        headers["authorization"] == "Bearer token" for headers in server.requests
+    )
+
+
+def test_read_timeout(server):
+    pool = HttpPool(Credentials(token="token"), connect_timeout=1, read_timeout=0.1)
+    with pool.connection() as http:
+        with pytest.raises(TimeoutError):
+            http.request(url(server, "/0.5"))
+    pool.close()
+
+
+def test_pool_bounds_concurrent_connections(server):
+    pool = HttpPool(Credentials(token="token"), size=2)
+
+    def fetch():
+        with pool.connection() as http:
+            http.request(url(server, "/0.05"))
+
+    threads = [threading.Thread(target=fetch) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool.close()
+
+    assert len(server.requests) == 8
+    assert server.peak <= 2
+    assert len(pool._clients) == 2
+
+
+def test_service_closes_its_transport(mocker):
+    transport = mocker.Mock()
+    GMailService(Credentials(token="token"), transport=transport).close()
+    transport.close.assert_called_once()